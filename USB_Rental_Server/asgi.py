@@ -12,5 +12,9 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'USB_Rental_Server.settings')
+# ASGIでは読み取りの多いページを非同期ビューで処理する
+os.environ.setdefault('ASYNC_READ_VIEWS', 'True')
+# 非同期ビューのORMはリクエストごとに別のスレッドで動くため、接続を使い回さずリクエストの終わりに閉じる
+os.environ.setdefault('DATABASE_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
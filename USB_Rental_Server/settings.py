@@ -14,6 +14,9 @@ import os
 from pathlib import Path
 from dotenv import load_dotenv
 
+# .envファイルを読み込み（以降の os.getenv で .env の値も使えるよう、設定を読む前に読み込む）
+load_dotenv()
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -44,6 +47,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # リクエストごとのSQL・テンプレートの時間を計測する（他のミドルウェアの処理も含めるため先頭に置く）
+    'main_app.instrumentation.RequestMetricsMiddleware',
+    # 読み取りを複製に振り分けてよいリクエストかを判定する（セッションなどの読み取りより前に置く）
+    'main_app.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,7 +64,8 @@ ROOT_URLCONF = 'USB_Rental_Server.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates と同じだが、描画時間を RequestMetricsMiddleware に記録する
+        'BACKEND': 'main_app.instrumentation.InstrumentedDjangoTemplates',
         'DIRS': ['templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -77,13 +85,106 @@ WSGI_APPLICATION = 'USB_Rental_Server.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# 接続ごとに最初に実行するSQLiteの設定。WALにして読み取りと書き込みを並行させ、
+# ロック待ちは busy_timeout まで待つ（SQLITE_* の環境変数で変更できる）
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 20000))
+SQLITE_INIT_COMMAND = ';'.join([
+    f"PRAGMA journal_mode={os.getenv('SQLITE_JOURNAL_MODE', 'WAL')}",
+    f"PRAGMA synchronous={os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')}",
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+])
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.getenv('DATABASE_PATH', BASE_DIR / 'db.sqlite3'),
+        # 接続をリクエストをまたいで使い回す秒数（0でリクエストごとに閉じる）。切れた接続は使う前に確認する
+        'CONN_MAX_AGE': int(os.getenv('DATABASE_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # 書き込みトランザクションは開始時にロックを取り、同時申請はロック待ちで直列化する
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000,
+            'init_command': SQLITE_INIT_COMMAND,
+        },
+        'TEST': {
+            # 同時実行テストでスレッド間のロック待ちを再現するため、テストDBもファイルにする
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
+    }
+}
+
+# 読み取り専用の複製。DATABASE_REPLICA_PATH を指定すると、GETなどの読み取りをこちらに振り分ける
+# （main_app.routers）。ローカルでは sync_replica コマンドで書き込み側のファイルを複製して試せる
+if os.getenv('DATABASE_REPLICA_PATH'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.getenv('DATABASE_REPLICA_PATH'),
+        'CONN_MAX_AGE': DATABASES['default']['CONN_MAX_AGE'],
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000,
+            # 誤って書き込まないよう、接続ごとに読み取り専用にする
+            'init_command': SQLITE_INIT_COMMAND + ';PRAGMA query_only=ON',
+        },
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    }
+
+DATABASE_ROUTERS = ['main_app.routers.PrimaryReplicaRouter']
+# 書き込みの後、この秒数の間は同じブラウザからの読み取りも書き込み側から行う（複製の遅れを隠す）
+DATABASE_REPLICA_PIN_SECONDS = int(os.getenv('DATABASE_REPLICA_PIN_SECONDS', 5))
+
+
+# Cache
+# 複数プロセスで共有する場合は CACHE_BACKEND / CACHE_LOCATION で Redis や Memcached を指定する
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
     }
 }
 
+# メーカーのホワイトリストをプロセス内に保持する秒数（他プロセスでの変更はこの秒数以内に反映される）
+WHITELIST_LOCAL_CACHE_SECONDS = int(os.getenv('WHITELIST_LOCAL_CACHE_SECONDS', 30))
+
+# USBデバイス一覧の返却期限切れ警告をユーザーごとにキャッシュする秒数（0でキャッシュしない）
+OVERDUE_CACHE_SECONDS = int(os.getenv('OVERDUE_CACHE_SECONDS', 24 * 60 * 60))
+
+# USBデバイス一覧の各行とデバイスのレンタル履歴を断片キャッシュする秒数（キーに更新日時を含むので変更は即時に反映される）
+FRAGMENT_CACHE_SECONDS = int(os.getenv('FRAGMENT_CACHE_SECONDS', 10 * 60))
+
+# ホームページのユーザーごとの状況（レンタル・利用PC・承認待ち）をキャッシュする秒数。
+# 自分のレンタルやPCの変更では即時に消えるが、他のユーザーの申請による承認待ちの件数はこの秒数だけ遅れる
+DASHBOARD_CACHE_SECONDS = int(os.getenv('DASHBOARD_CACHE_SECONDS', 60))
+# 返却期日までこの日数以内のレンタルを「期限間近」として表示する
+DASHBOARD_DUE_SOON_DAYS = int(os.getenv('DASHBOARD_DUE_SOON_DAYS', 3))
+
+# 返却期日からこの日数が過ぎた返却済みレンタルを archive_rentals コマンドでアーカイブテーブルに移す
+RENTAL_ARCHIVE_AFTER_DAYS = int(os.getenv('RENTAL_ARCHIVE_AFTER_DAYS', 365))
+
+# 読み取りの多いページとJSON APIに非同期ビュー（main_app.async_views）を使うかどうか。
+# ASGIで動かす場合（asgi.py）は既定で有効になる。WSGIでは同期ビューのままにする
+ASYNC_READ_VIEWS = os.getenv('ASYNC_READ_VIEWS', 'False') == 'True'
+
+# 貸出状況の変化の配信（/events/devices/、ASGIのみ）。
+# プロセスごとにこの秒数の間隔で新しいイベントを読む（接続しているクライアント数には比例しない）
+DEVICE_EVENTS_POLL_SECONDS = float(os.getenv('DEVICE_EVENTS_POLL_SECONDS', 1))
+# イベントが無いときに接続を保つためのコメント行を送る間隔（秒）
+DEVICE_EVENTS_HEARTBEAT_SECONDS = float(os.getenv('DEVICE_EVENTS_HEARTBEAT_SECONDS', 15))
+# 1本の接続を保つ秒数。過ぎたら閉じ、ブラウザは DEVICE_EVENTS_RETRY_MS 後に続きから再接続する
+DEVICE_EVENTS_STREAM_SECONDS = float(os.getenv('DEVICE_EVENTS_STREAM_SECONDS', 5 * 60))
+DEVICE_EVENTS_RETRY_MS = int(os.getenv('DEVICE_EVENTS_RETRY_MS', 3000))
+# この時間より古いイベントを prune_device_events コマンドで消す
+DEVICE_EVENTS_RETENTION_HOURS = int(os.getenv('DEVICE_EVENTS_RETENTION_HOURS', 24))
+
+# レンタルの操作の記録（RentalEvent）から貸出状況を組み立て直す起点。snapshot_rentals コマンドを定期的に実行して作り、
+# 新しい方からこの件数だけ残す（組み立て直すときは最新のスナップショット以降の記録だけを再生する）
+RENTAL_SNAPSHOTS_KEEP = int(os.getenv('RENTAL_SNAPSHOTS_KEEP', 7))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -129,9 +230,6 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_REDIRECT_URL = '/'  # ログイン後にリダイレクトするURL
 LOGOUT_REDIRECT_URL = 'login'    # ログアウト後にリダイレクトするURL
 
-# .envファイルを読み込み
-load_dotenv()
-
 # メール設定
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = os.getenv('EMAIL_HOST', 'smtp.gmail.com')
@@ -141,4 +239,17 @@ EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER', '')  # 環境変数から取得
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', '')  # 環境変数から取得
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
-
+# 送信待ちメール（send_outbox コマンド）の再送間隔。失敗するたびに倍になり、上限で頭打ちになる
+OUTBOX_RETRY_BASE_SECONDS = int(os.getenv('OUTBOX_RETRY_BASE_SECONDS', 60))
+OUTBOX_RETRY_MAX_SECONDS = int(os.getenv('OUTBOX_RETRY_MAX_SECONDS', 6 * 60 * 60))
+# send_outbox が取り出したメールを他の send_outbox に渡さない時間。送信中に止まった場合はこの時間の後に再送する
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', 10 * 60))
+
+# リクエストの計測（main_app.instrumentation.RequestMetricsMiddleware）
+# Server-Timing ヘッダーを返すかどうか（ブラウザの開発者ツールで内訳を確認できる）
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'True') == 'True'
+# この時間（ミリ秒）以上かかったリクエストを、時間のかかったクエリと共にログに残す
+SLOW_REQUEST_MS = int(os.getenv('SLOW_REQUEST_MS', 500))
+# /metrics/ はスタッフユーザーか、Authorization: Bearer <METRICS_TOKEN> を付けたリクエスト（収集サーバー）だけが参照できる。
+# 空の場合はトークンでは参照できない
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
@@ -1,7 +1,8 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import USBDevice, RentalRequest
+from .models import USBDevice, RentalRequest, AntivirusPolicy
 
 admin.site.register(USBDevice)
-admin.site.register(RentalRequest)
\ No newline at end of file
+admin.site.register(RentalRequest)# 最低バージョンを変えたら evaluate_antivirus コマンドで全てのPCの判定を更新する
+admin.site.register(AntivirusPolicy)
@@ -0,0 +1,230 @@
+# rentals/api.py
+import json
+
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse
+from django.views.generic import View
+
+from .forms import MAX_ID
+from .models import USBDevice, RentalRequest, ArchivedRentalRequest, UserPC, ManufacturerWhitelist
+from .pagination import KeysetPaginator, InvalidCursor
+from .search import search
+
+
+class ApiListView(LoginRequiredMixin, View):
+    """
+    読み取り専用のJSON一覧APIの基底クラス。
+    モデルのインスタンスは作らず values() の射影だけで応答を組み立てる。
+    ?fields=id,name で返す項目を選べ、?cursor= で次のページを取得する（キーセット方式、OFFSETなし）。
+    """
+    raise_exception = True  # 未ログインはログイン画面へのリダイレクトではなく403にする
+    model = None
+    # 公開する項目名 → values() に渡す参照名。結合が必要な項目は選ばれたときだけ結合する
+    fields = {}
+    ordering = ('id',)
+    default_limit = 100
+    max_limit = 1000
+
+    def get_queryset(self):
+        return self.model.objects.all()
+
+    def get(self, request):
+        try:
+            paginator, pairs = self.build_paginator(request)
+            page = paginator.get_page(request.GET.get('cursor'))
+        except (ValueError, InvalidCursor) as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return self.page_response(page, pairs)
+
+    def build_paginator(self, request):
+        """クエリパラメーターから values() の射影とページ分割を組み立てる。不正な値は ValueError"""
+        selected = self.selected_fields(request.GET.get('fields'))
+        limit = self.limit(request.GET.get('limit'))
+
+        # カーソルの組み立てに必要な並び替えキーは、選ばれていなくても取得する
+        lookups = [self.fields[name] for name in selected]
+        keys = [key.lstrip('-') for key in self.ordering if key.lstrip('-') not in lookups]
+        paginator = KeysetPaginator(self.get_queryset().values(*lookups, *keys), self.ordering, limit)
+        return paginator, [(name, self.fields[name]) for name in selected]
+
+    def page_response(self, page, pairs):
+        body = {
+            'results': [{name: row[lookup] for name, lookup in pairs} for row in page.object_list],
+            'next_cursor': page.next_cursor,
+        }
+        return HttpResponse(
+            json.dumps(body, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':')),
+            content_type='application/json',
+        )
+
+    def selected_fields(self, value):
+        if not value:
+            return list(self.fields)
+        names = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise ValueError(f"不明な項目です: {', '.join(unknown)}（指定できる項目: {', '.join(self.fields)}）")
+        return list(dict.fromkeys(names))
+
+    def limit(self, value):
+        if not value:
+            return self.default_limit
+        try:
+            limit = int(value)
+        except ValueError:
+            raise ValueError("limit は整数で指定してください。")
+        if not 1 <= limit <= self.max_limit:
+            raise ValueError(f"limit は1から{self.max_limit}の範囲で指定してください。")
+        return limit
+
+    def id_param(self, name):
+        """?usb_device=ID のような絞り込み用のIDを読む。未指定は None、整数でない値や範囲外の値は ValueError"""
+        value = self.request.GET.get(name)
+        if not value:
+            return None
+        try:
+            pk = int(value)
+        except ValueError:
+            raise ValueError(f"{name} は整数で指定してください。")
+        if not 1 <= pk <= MAX_ID:
+            raise ValueError(f"{name} は1から{MAX_ID}の範囲で指定してください。")
+        return pk
+
+
+class DeviceApiView(ApiListView):
+    model = USBDevice
+    fields = {
+        'id': 'id',
+        'name': 'name',
+        'description': 'description',
+        'is_available': 'is_available',
+        'manufacturer_id': 'manufacturer_id',
+        'manufacturer': 'manufacturer__name',
+        'purchase_date': 'purchase_date',
+        'capacity': 'capacity',
+        'updated_at': 'updated_at',
+    }
+
+
+class DeviceSearchApiView(ApiListView):
+    """
+    ?q= の検索語（空白区切りで全てを含む）に一致するデバイスを関連度の高い順に返す。
+    全文検索の索引を使うため、デバイス数が増えても応答時間はほぼ変わらない。ページ送りは無く上位 limit 件のみ。
+    """
+    model = USBDevice
+    fields = {
+        'id': 'id',
+        'name': 'name',
+        'description': 'description',
+        'is_available': 'is_available',
+        'manufacturer': 'manufacturer__name',
+    }
+    default_limit = 20
+    max_limit = 100
+
+    def get(self, request):
+        try:
+            queryset, query, limit, selected = self.search_params(request)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return self.search_response(search(queryset, query, limit), selected)
+
+    def search_params(self, request):
+        """クエリパラメーターから検索対象・検索語・件数・項目を取り出す。不正な値は ValueError"""
+        query = request.GET.get('q', '').strip()
+        if not query:
+            raise ValueError("q に検索語を指定してください。")
+        selected = self.selected_fields(request.GET.get('fields'))
+        limit = self.limit(request.GET.get('limit'))
+        queryset = self.get_queryset().values('id', *[self.fields[name] for name in selected])
+        return queryset, query, limit, selected
+
+    def search_response(self, results, selected):
+        body = {
+            'results': [
+                {**{name: row[self.fields[name]] for name in selected}, 'score': round(score, 6)}
+                for row, score in results
+            ],
+        }
+        return HttpResponse(
+            json.dumps(body, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':')),
+            content_type='application/json',
+        )
+
+
+class RentalApiView(ApiListView):
+    model = RentalRequest
+    fields = {
+        'id': 'id',
+        'usb_device_id': 'usb_device_id',
+        'usb_device': 'usb_device__name',
+        'user': 'user__username',
+        'approver': 'approver__username',
+        'approved': 'approved',
+        'pc': 'pc__serial_number',
+        'requested_at': 'requested_at',
+        'start_date': 'start_date',
+        'end_date': 'end_date',
+        'is_returned': 'is_returned',
+        'updated_at': 'updated_at',
+    }
+
+    def get_queryset(self):
+        queryset = RentalRequest.objects.all()
+        # 未返却のみ、または特定デバイスのみに絞り込める（?active=1, ?usb_device=ID）
+        if self.request.GET.get('active') in ('1', 'true'):
+            queryset = queryset.filter(is_returned=False)
+        usb_device = self.id_param('usb_device')
+        if usb_device is not None:
+            queryset = queryset.filter(usb_device_id=usb_device)
+        return queryset
+
+
+class ArchivedRentalApiView(ApiListView):
+    """archive_rentals コマンドでアーカイブテーブルに移された古い返却済みレンタル"""
+    model = ArchivedRentalRequest
+    fields = {
+        'id': 'id',
+        'usb_device_id': 'usb_device_id',
+        'usb_device': 'usb_device__name',
+        'user': 'user__username',
+        'approver': 'approver__username',
+        'approved': 'approved',
+        'pc': 'pc__serial_number',
+        'requested_at': 'requested_at',
+        'start_date': 'start_date',
+        'end_date': 'end_date',
+        'archived_at': 'archived_at',
+    }
+
+    def get_queryset(self):
+        queryset = ArchivedRentalRequest.objects.all()
+        usb_device = self.id_param('usb_device')
+        if usb_device is not None:
+            queryset = queryset.filter(usb_device_id=usb_device)
+        return queryset
+
+
+class UserPCApiView(ApiListView):
+    model = UserPC
+    fields = {
+        'id': 'id',
+        'serial_number': 'serial_number',
+        'antivirus_version': 'antivirus_version',
+        'is_compliant': 'is_compliant',
+    }
+
+    def get_queryset(self):
+        # 画面と同じく、ログインユーザーのPCのみを返す
+        return UserPC.objects.filter(user=self.request.user)
+
+
+class WhitelistApiView(ApiListView):
+    model = ManufacturerWhitelist
+    fields = {
+        'id': 'id',
+        'manufacturer_id': 'manufacturer_id',
+        'manufacturer': 'manufacturer__name',
+        'added_at': 'added_at',
+    }
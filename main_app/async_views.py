@@ -0,0 +1,197 @@
+# rentals/async_views.py
+# 読み取りの多いページとJSON APIの非同期版。ASGIで動かす場合に urls.py がこちらを使う（ASYNC_READ_VIEWS）。
+# 同期版（views.py / api.py）を継承し、問い合わせだけを非同期ORMに置き換える。
+import inspect
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import render, aget_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control, quote_etag
+from django.utils.http import http_date
+
+from . import api, device_events, views
+from .models import RentalRequest, USBDevice
+from .overdue import aoverdue_rentals_for
+from .pagination import KeysetPaginator, InvalidCursor
+from .search import search
+
+
+class AsyncLoginRequiredMixin:
+    """
+    同期の LoginRequiredMixin より先にログインユーザーを非同期に読み込む。
+    以降は request.user が読み込み済みになるため、同期のミックスインやテンプレートからDBを参照しない。
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        return self._adispatch(request, *args, **kwargs)
+
+    async def _adispatch(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        response = super().dispatch(request, *args, **kwargs)
+        if inspect.isawaitable(response):
+            response = await response
+        return response
+
+
+class AsyncConditionalGetMixin:
+    """ConditionalGetMixin の非同期版。get_etag / get_last_modified は同期版のものを使う"""
+
+    async def prepare_conditional(self, request, *args, **kwargs):
+        """get_etag などが問い合わせを必要とする場合に、先に非同期で読み込んでおくためのフック"""
+
+    async def get(self, request, *args, **kwargs):
+        await self.prepare_conditional(request, *args, **kwargs)
+        etag = self.get_etag(request, *args, **kwargs)
+        last_modified = self.get_last_modified(request, *args, **kwargs)
+        etag = quote_etag(etag) if etag else None
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = await self.aget(request, *args, **kwargs)
+        if timestamp and not response.has_header('Last-Modified'):
+            response.headers['Last-Modified'] = http_date(timestamp)
+        if etag:
+            response.headers.setdefault('ETag', etag)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class USBListView(AsyncLoginRequiredMixin, AsyncConditionalGetMixin, views.USBListView):
+    async def aget(self, request):
+        if self.search_query():
+            # 全文検索は生のSQLを使うため、同期版の get_queryset をスレッドで実行する
+            devices = await sync_to_async(self.get_queryset)()
+            page = None
+        else:
+            paginator = KeysetPaginator(self.get_queryset(), self.keyset_ordering, self.paginate_by)
+            try:
+                page = await paginator.aget_page(request.GET.get(self.cursor_kwarg))
+            except InvalidCursor as e:
+                raise Http404(str(e))
+            devices = page.object_list
+
+        # テンプレートは先読み済みの値とキャッシュしか参照しないため、そのまま描画する
+        return render(request, self.template_name, {
+            'view': self,
+            'usb_devices': devices,
+            'object_list': devices,
+            'page_obj': page,
+            'is_paginated': page is not None and (page.has_next() or page.has_previous()),
+            'overdue_rentals': await aoverdue_rentals_for(request.user),
+            'fragment_cache_seconds': settings.FRAGMENT_CACHE_SECONDS,
+            'search_query': self.search_query(),
+            'device_filter': self.device_filter(),
+            'facets': None if self.search_query() else await self.device_filter().afacet_counts(USBDevice.objects.all()),
+        })
+
+
+class USBDeviceDetailView(AsyncLoginRequiredMixin, AsyncConditionalGetMixin, views.USBDeviceDetailView):
+    async def prepare_conditional(self, request, pk):
+        self._updated_at = await USBDevice.objects.filter(pk=pk).values_list('updated_at', flat=True).afirst()
+
+    async def aget(self, request, pk):
+        self.object = await aget_object_or_404(self.get_queryset(), pk=pk)
+        paginator = self.history_paginator()
+        cursor = self.history_cursor(paginator)
+
+        context = {'view': self, 'object': self.object, 'usb_device': self.object}
+        key = self.rentals_cache_key(cursor)
+        rentals_html = await cache.aget(key)
+        if rentals_html is None:
+            current_rental = await RentalRequest.objects.filter(
+                usb_device=self.object, is_returned=False
+            ).select_related('user').afirst()
+            history_page = await paginator.aget_page(cursor)
+            rentals_html = self.render_rentals(current_rental, history_page)
+            await cache.aset(key, rentals_html, settings.FRAGMENT_CACHE_SECONDS)
+            context['history_page'] = history_page
+
+        context['rentals_html'] = rentals_html
+        return render(request, self.template_name, context)
+
+
+class UserPCListView(AsyncLoginRequiredMixin, views.UserPCListView):
+    async def get(self, request):
+        user_pcs = [pc async for pc in self.get_queryset()]
+        return render(request, self.template_name, {'view': self, 'user_pcs': user_pcs, 'object_list': user_pcs})
+
+
+class ManufacturerWhitelistListView(AsyncLoginRequiredMixin, views.ManufacturerWhitelistListView):
+    async def get(self, request):
+        paginator = KeysetPaginator(self.get_queryset(), self.keyset_ordering, self.paginate_by)
+        try:
+            page = await paginator.aget_page(request.GET.get(self.cursor_kwarg))
+        except InvalidCursor as e:
+            raise Http404(str(e))
+        return render(request, self.template_name, {
+            'view': self,
+            'whitelisted_manufacturers': page.object_list,
+            'object_list': page.object_list,
+            'page_obj': page,
+            'is_paginated': page.has_next() or page.has_previous(),
+        })
+
+
+class DeviceEventStreamView(AsyncLoginRequiredMixin, views.DeviceEventStreamView):
+    """
+    貸出状況の変化を配信し続ける。一覧ページを再読み込みして空きを確かめる代わりに、
+    クライアントごとに1本の待ち受けの接続で済む（DBへの問い合わせはプロセスごとに1本、device_events）。
+    ?device=1&device=2 でデバイスを絞り込める
+    """
+
+    async def get(self, request):
+        try:
+            last_id = request.headers.get('Last-Event-ID') or request.GET.get('last_id')
+            after_id = int(last_id) if last_id else None
+            device_ids = {int(value) for value in request.GET.getlist('device')}
+        except ValueError:
+            return JsonResponse({'error': "Last-Event-ID と device は整数で指定してください。"}, status=400)
+        response = StreamingHttpResponse(device_events.stream(after_id, device_ids), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # nginx などのリバースプロキシにバッファリングさせず、イベントをすぐに届ける
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class AsyncApiMixin(AsyncLoginRequiredMixin):
+    async def get(self, request):
+        try:
+            paginator, pairs = self.build_paginator(request)
+            page = await paginator.aget_page(request.GET.get('cursor'))
+        except (ValueError, InvalidCursor) as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return self.page_response(page, pairs)
+
+
+class DeviceApiView(AsyncApiMixin, api.DeviceApiView):
+    pass
+
+
+class DeviceSearchApiView(AsyncLoginRequiredMixin, api.DeviceSearchApiView):
+    async def get(self, request):
+        try:
+            queryset, query, limit, selected = self.search_params(request)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        # 全文検索は生のSQLを使うため、スレッドで実行する
+        results = await sync_to_async(search)(queryset, query, limit)
+        return self.search_response(results, selected)
+
+
+class RentalApiView(AsyncApiMixin, api.RentalApiView):
+    pass
+
+
+class ArchivedRentalApiView(AsyncApiMixin, api.ArchivedRentalApiView):
+    pass
+
+
+class UserPCApiView(AsyncApiMixin, api.UserPCApiView):
+    pass
+
+
+class WhitelistApiView(AsyncApiMixin, api.WhitelistApiView):
+    pass
@@ -0,0 +1,61 @@
+# rentals/compliance.py
+import re
+
+from .models import AntivirusPolicy
+
+VERSION_PATTERN = re.compile(r'\d+(?:\.\d+)*')
+# 製品名とバージョン番号の間に書かれがちな語（"Defender ver 4.18" など）
+VERSION_PREFIX_PATTERN = re.compile(r'[\s:_-]*(?:v|ver|version)?[\s.:_-]*$', re.IGNORECASE)
+
+
+def parse(text):
+    """
+    ウイルス対策のバージョンの文字列を (製品名, バージョン) に分ける。
+    製品名は小文字にして前後の空白を除き、バージョンは数値のタプルにする（数字が無ければ None）。
+    "4.1.2" → ('', (4, 1, 2))、"Defender v4.18" → ('defender', (4, 18))
+    """
+    text = (text or '').strip()
+    match = VERSION_PATTERN.search(text)
+    if match is None:
+        return text.lower(), None
+    product = VERSION_PREFIX_PATTERN.sub('', text[:match.start()]).strip().lower()
+    return product, tuple(int(part) for part in match.group().split('.'))
+
+
+def is_at_least(version, minimum):
+    """桁数の違うバージョンは足りない桁を0として比べる（"4.1" と "4.1.0" は同じ）"""
+    width = max(len(version), len(minimum))
+    return version + (0,) * (width - len(version)) >= minimum + (0,) * (width - len(minimum))
+
+
+class Policies:
+    """
+    AntivirusPolicy を1回のクエリで読み、PCごとの判定はメモリ上で行う。
+    evaluate_antivirus コマンドは全てのPCをこの1つのインスタンスで判定する
+    """
+
+    def __init__(self, minimums):
+        # 製品名（小文字）→ 最低バージョンのタプル。'' は製品名の一致しないPCに使う
+        self.minimums = minimums
+
+    @classmethod
+    def load(cls):
+        minimums = {}
+        for product, min_version in AntivirusPolicy.objects.values_list('product', 'min_version'):
+            _, version = parse(min_version)
+            if version is not None:
+                minimums[product.strip().lower()] = version
+        return cls(minimums)
+
+    def minimum_for(self, product):
+        return self.minimums.get(product, self.minimums.get(''))
+
+    def is_compliant(self, antivirus_version):
+        """基準が無ければ満たすものとし、バージョンを読み取れなければ満たさないものとする"""
+        if not self.minimums:
+            return True
+        product, version = parse(antivirus_version)
+        minimum = self.minimum_for(product)
+        if minimum is None:
+            return True
+        return version is not None and is_at_least(version, minimum)
@@ -0,0 +1,75 @@
+# rentals/dashboard.py
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import BooleanField, Case, CharField, Count, ExpressionWrapper, Q, Value, When
+from django.utils import timezone
+
+from .models import RentalRequest, UserPC
+
+
+def _cache_key(user_id, today):
+    # 期限切れ・期限間近の区分は日付で変わるため、日付をキーに含める
+    return f'main_app:dashboard:{user_id}:{today.isoformat()}'
+
+
+def build(user, today):
+    """
+    ホームページに表示するログインユーザーの状況。件数に関わらず3回のクエリで組み立てる。
+    ・未返却のレンタル（期限切れ・期限間近・承認待ちの区分はSQLの注釈で求める）
+    ・登録済みの利用PCと、それぞれで利用中のレンタルの件数
+    ・自分が承認者になっている承認待ちの申請の件数
+    """
+    due_soon_until = today + timedelta(days=settings.DASHBOARD_DUE_SOON_DAYS)
+    rentals = list(
+        RentalRequest.objects.filter(user=user, is_returned=False)
+        .annotate(
+            status=Case(
+                When(end_date__lt=today, then=Value('overdue')),
+                When(end_date__lte=due_soon_until, then=Value('due_soon')),
+                default=Value('active'),
+                output_field=CharField(),
+            ),
+            awaiting_approval=ExpressionWrapper(Q(approved=False, decided_at__isnull=True), output_field=BooleanField()),
+        )
+        .order_by('end_date', 'id')
+        .values(
+            'id', 'usb_device_id', 'usb_device__name', 'start_date', 'end_date', 'pc__serial_number',
+            'status', 'awaiting_approval',
+        )
+    )
+    pcs = list(
+        UserPC.objects.filter(user=user)
+        .annotate(active_rentals=Count('rentalrequest', filter=Q(rentalrequest__is_returned=False)))
+        .order_by('serial_number')
+        .values('id', 'serial_number', 'antivirus_version', 'is_compliant', 'active_rentals')
+    )
+    return {
+        'today': today,
+        'rentals': rentals,
+        'overdue': [rental for rental in rentals if rental['status'] == 'overdue'],
+        'due_soon': [rental for rental in rentals if rental['status'] == 'due_soon'],
+        'awaiting_approval': [rental for rental in rentals if rental['awaiting_approval']],
+        'pcs': pcs,
+        'approvals_waiting': RentalRequest.objects.pending_for(user).count(),
+    }
+
+
+def dashboard_for(user):
+    """build の結果を DASHBOARD_CACHE_SECONDS の間キャッシュする（自分のレンタルやPCが変わると消す）"""
+    today = timezone.now().date()
+    key = _cache_key(user.id, today)
+    data = cache.get(key)
+    if data is None:
+        data = build(user, today)
+        cache.set(key, data, settings.DASHBOARD_CACHE_SECONDS)
+    return data
+
+
+def invalidate_dashboard(*user_ids):
+    """ユーザーのレンタルやPCが変わったときに呼ぶ。コミット前に読み直された古い値もコミット後に消す"""
+    keys = [_cache_key(user_id, timezone.now().date()) for user_id in user_ids if user_id]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,173 @@
+# rentals/device_events.py
+import asyncio
+import contextvars
+import json
+import logging
+import weakref
+from collections import deque
+
+from django.conf import settings
+from django.db import DatabaseError
+
+from .models import DeviceEvent
+
+logger = logging.getLogger(__name__)
+
+# プロセス内に保持する直近のイベント数。再接続したクライアントはこの範囲ならDBを読まずに続きを受け取れる
+BUFFER_SIZE = 1000
+# 1回のポーリングで読むイベント数の上限
+BATCH_SIZE = 500
+
+
+def record(usb_device_id, kind, is_available):
+    """呼び出し元のトランザクションでイベントを追記する（ロールバックされれば配信されない）"""
+    return DeviceEvent.objects.create(usb_device_id=usb_device_id, kind=kind, is_available=is_available)
+
+
+def record_many(device_ids, kind, is_available):
+    """複数のデバイスの同じ変化を1回のINSERTで追記する"""
+    return DeviceEvent.objects.bulk_create([
+        DeviceEvent(usb_device_id=device_id, kind=kind, is_available=is_available) for device_id in device_ids
+    ])
+
+
+def serialize(event):
+    return {
+        'id': event.id,
+        'device': event.usb_device_id,
+        'kind': event.kind,
+        'available': event.is_available,
+        'at': event.created_at.isoformat(),
+    }
+
+
+def format_event(event):
+    """text/event-stream の1件分。id は再接続時に Last-Event-ID として送り返される"""
+    data = json.dumps({key: value for key, value in event.items() if key != 'id'}, separators=(',', ':'))
+    return f'id: {event["id"]}\nevent: device\ndata: {data}\n\n'
+
+
+class DeviceEventBroker:
+    """
+    イベントループ（ASGIサーバーのプロセス）ごとに1つ。接続中のクライアントがいる間だけ
+    DEVICE_EVENTS_POLL_SECONDS ごとに新しいイベントを1回のクエリで読み、全てのクライアントに配る。
+    クライアントが何人いてもDBへの問い合わせは1本で済み、各クライアントは次のイベントまで待つだけになる。
+    SQLiteは書き込みを直列化するため、id の順にコミットされ、id の大小だけで続きを読める。
+    """
+
+    def __init__(self):
+        self.recent = deque()
+        # recent より前のイベントの最大の id（これ以前のイベントはDBから読み直す）
+        self.floor = None
+        self.last_id = None
+        self.arrived = asyncio.Event()
+        self.clients = 0
+        self.task = None
+
+    async def subscribe(self):
+        self.clients += 1
+        if self.last_id is None:
+            latest = await DeviceEvent.objects.order_by('-id').values_list('id', flat=True).afirst()
+            if self.last_id is None:
+                self.last_id = self.floor = latest or 0
+        if self.task is None:
+            # 最初のクライアントのリクエストの状態（複製への振り分けや計測）を引き継がないよう、空のコンテキストで動かす
+            self.task = asyncio.create_task(self.poll(), context=contextvars.Context())
+
+    def unsubscribe(self):
+        self.clients -= 1
+
+    async def poll(self):
+        try:
+            while self.clients > 0:
+                await asyncio.sleep(settings.DEVICE_EVENTS_POLL_SECONDS)
+                try:
+                    events = [
+                        serialize(event) async for event in
+                        DeviceEvent.objects.filter(id__gt=self.last_id).order_by('id')[:BATCH_SIZE]
+                    ]
+                except DatabaseError:
+                    logger.exception("デバイスのイベントを読み込めませんでした")
+                    continue
+                if events:
+                    self.publish(events)
+        finally:
+            self.task = None
+
+    def publish(self, events):
+        for event in events:
+            if len(self.recent) == BUFFER_SIZE:
+                self.floor = self.recent.popleft()['id']
+            self.recent.append(event)
+        self.last_id = events[-1]['id']
+        arrived, self.arrived = self.arrived, asyncio.Event()
+        arrived.set()
+
+    async def events_after(self, after_id):
+        """after_id より後の配信済みのイベント。古すぎて読み切れない場合は None"""
+        if after_id >= self.floor:
+            return [event for event in self.recent if event['id'] > after_id]
+        # 再接続までの間に手元の範囲から外れた分はDBから読む
+        floor = self.floor
+        missed = [
+            serialize(event) async for event in
+            DeviceEvent.objects.filter(id__gt=after_id, id__lte=floor).order_by('id')[:BUFFER_SIZE + 1]
+        ]
+        if len(missed) > BUFFER_SIZE:
+            return None
+        return missed + [event for event in self.recent if event['id'] > floor]
+
+    async def wait(self, after_id):
+        while self.last_id <= after_id:
+            await self.arrived.wait()
+
+
+_brokers = weakref.WeakKeyDictionary()
+
+
+def get_broker():
+    loop = asyncio.get_running_loop()
+    broker = _brokers.get(loop)
+    if broker is None:
+        broker = _brokers[loop] = DeviceEventBroker()
+    return broker
+
+
+async def stream(after_id=None, device_ids=None):
+    """
+    イベントストリームの本文。after_id（Last-Event-ID）より後のイベントから送り、
+    DEVICE_EVENTS_STREAM_SECONDS が過ぎたら終える（クライアントは Last-Event-ID を付けて自動で再接続する）。
+    device_ids を指定するとそのデバイスのイベントだけを送る。
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.DEVICE_EVENTS_STREAM_SECONDS
+    broker = get_broker()
+    await broker.subscribe()
+    try:
+        if after_id is None or after_id > broker.last_id:
+            after_id = broker.last_id
+        yield f'retry: {settings.DEVICE_EVENTS_RETRY_MS}\n\n'
+        while True:
+            events = await broker.events_after(after_id)
+            if events is None:
+                # 取りこぼしが多すぎる場合は、ページを読み直して最新の状態を表示してもらう
+                yield 'event: reload\ndata: {}\n\n'
+                after_id = broker.last_id
+                continue
+            for event in events:
+                if not device_ids or event['device'] in device_ids:
+                    yield format_event(event)
+                after_id = event['id']
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(
+                    broker.wait(after_id), min(settings.DEVICE_EVENTS_HEARTBEAT_SECONDS, remaining),
+                )
+            except TimeoutError:
+                # 途中のプロキシに切断されないよう、何も無いときもコメント行を送る
+                yield ': keepalive\n\n'
+    finally:
+        broker.unsubscribe()
@@ -0,0 +1,183 @@
+# rentals/facets.py
+import hashlib
+from collections import defaultdict
+from datetime import date
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, CharField, Count, IntegerField, Q, Value, When
+from django.db.models.functions import Cast, Substr
+
+from .forms import DeviceFilterForm
+from .usage import CAPACITY_BANDS, BAND_LABELS, UNKNOWN_BAND
+from .versions import inventory_version
+
+FACETS = ('manufacturer', 'capacity', 'purchased', 'availability')
+BAND_KEYS = [key for key, _label, _upper in CAPACITY_BANDS]
+# 区分ごとの容量の範囲 (下限（含まない）, 上限（含む）)。None は制限なし
+BAND_RANGES = {
+    key: (CAPACITY_BANDS[i - 1][2] if i else None, upper) for i, (key, _label, upper) in enumerate(CAPACITY_BANDS)
+}
+
+
+def purchase_year_expression():
+    """
+    購入年をSQLで求める式。ExtractYear はSQLiteではPythonの関数を行ごとに呼ぶため、
+    'YYYY-MM-DD' の先頭4文字を整数にして全件の集計でも遅くならないようにする
+    """
+    return Cast(Substr(Cast('purchase_date', CharField()), 1, 4), IntegerField())
+
+
+def capacity_band_expression():
+    """容量の区分をSQLで求める式（usage.capacity_band と同じ区切り）"""
+    return Case(
+        When(capacity__isnull=True, then=Value(UNKNOWN_BAND)),
+        *[When(capacity__lte=upper, then=Value(key)) for key, _label, upper in CAPACITY_BANDS if upper is not None],
+        default=Value(BAND_KEYS[-1]),
+    )
+
+
+class DeviceFilter:
+    """
+    USBデバイス一覧の絞り込みとファセットの件数。
+    件数は「そのファセット以外の条件」で絞り込んだ件数（選択中の値以外を選び直した場合の件数）にする。
+    全てのファセットの件数を、メーカー・状態・容量の区分・購入年でまとめた1回の集計クエリから求める。
+    """
+
+    def __init__(self, data):
+        self.form = DeviceFilterForm(data)
+        # 不正な条件はフォームにエラーを表示し、絞り込みには使わない
+        self.values = self.form.cleaned_data if self.form.is_valid() else {}
+
+    @property
+    def is_active(self):
+        return any(self.values.get(name) for name in self.form.fields)
+
+    def selected_bands(self):
+        first, last = self.values.get('capacity_from'), self.values.get('capacity_to')
+        if not first and not last:
+            return None
+        start = BAND_KEYS.index(first) if first else 0
+        end = BAND_KEYS.index(last) if last else len(BAND_KEYS) - 1
+        return BAND_KEYS[start:end + 1]
+
+    def availability(self):
+        return {'available': True, 'rented': False}.get(self.values.get('availability'))
+
+    def conditions(self):
+        """全ての絞り込み条件をまとめた Q"""
+        condition = Q()
+        if self.values.get('manufacturer'):
+            condition &= Q(manufacturer_id__in=self.values['manufacturer'])
+        bands = self.selected_bands()
+        if bands:
+            lower, upper = BAND_RANGES[bands[0]][0], BAND_RANGES[bands[-1]][1]
+            condition &= Q(capacity__isnull=False)
+            if lower is not None:
+                condition &= Q(capacity__gt=lower)
+            if upper is not None:
+                condition &= Q(capacity__lte=upper)
+        condition &= self.purchased_condition()
+        if self.availability() is not None:
+            condition &= Q(is_available=self.availability())
+        return condition
+
+    def purchased_condition(self):
+        condition = Q()
+        if self.values.get('purchased_from'):
+            condition &= Q(purchase_date__gte=self.values['purchased_from'])
+        if self.values.get('purchased_to'):
+            condition &= Q(purchase_date__lte=self.values['purchased_to'])
+        return condition
+
+    def apply(self, queryset):
+        return queryset.filter(self.conditions())
+
+    def grouped(self, queryset):
+        """
+        ファセットの値の組み合わせごとの件数を求める集計クエリ。
+        購入日の範囲は年の区切りと一致しないため、範囲内の件数を別の列で数える。
+        """
+        purchased = self.purchased_condition()
+        return (
+            queryset.order_by()
+            .values('manufacturer_id', 'manufacturer__name', 'is_available')
+            .annotate(
+                band=capacity_band_expression(), year=purchase_year_expression(),
+                total=Count('pk'), in_period=Count('pk', filter=purchased) if purchased else Count('pk'),
+            )
+        )
+
+    def cache_key(self):
+        raw = repr(sorted((name, str(value)) for name, value in self.values.items() if value))
+        return f'device_facets:{inventory_version()}:{hashlib.md5(raw.encode()).hexdigest()}'
+
+    def facet_counts(self, queryset):
+        """全てのファセットの件数。デバイスやレンタルが変わるまではキャッシュを使う"""
+        key = self.cache_key()
+        facets = cache.get(key)
+        if facets is None:
+            facets = self.build(list(self.grouped(queryset)))
+            cache.set(key, facets, settings.FRAGMENT_CACHE_SECONDS)
+        return facets
+
+    async def afacet_counts(self, queryset):
+        key = self.cache_key()
+        facets = await cache.aget(key)
+        if facets is None:
+            facets = self.build([row async for row in self.grouped(queryset)])
+            await cache.aset(key, facets, settings.FRAGMENT_CACHE_SECONDS)
+        return facets
+
+    def build(self, rows):
+        """集計クエリの行から、ファセットごとに他の条件を満たす行の件数を足し合わせる"""
+        manufacturers = set(self.values.get('manufacturer') or [])
+        bands = self.selected_bands()
+        availability = self.availability()
+        checks = {
+            'manufacturer': lambda row: not manufacturers or row['manufacturer_id'] in manufacturers,
+            'capacity': lambda row: not bands or row['band'] in bands,
+            'availability': lambda row: availability is None or row['is_available'] == availability,
+        }
+
+        counts = {facet: defaultdict(int) for facet in FACETS}
+        names = {}
+        total = 0
+        for row in rows:
+            passed = {facet: check(row) for facet, check in checks.items()}
+            # 購入日の範囲は in_period の列で数え、購入年のファセット自身では範囲を外した total を使う
+            for facet, value in (
+                ('manufacturer', row['manufacturer_id']), ('capacity', row['band']), ('availability', row['is_available']),
+            ):
+                if all(ok for other, ok in passed.items() if other != facet):
+                    counts[facet][value] += row['in_period']
+            if all(passed.values()):
+                counts['purchased'][row['year']] += row['total']
+                total += row['in_period']
+            if row['manufacturer_id'] is not None:
+                names[row['manufacturer_id']] = row['manufacturer__name']
+
+        return {
+            'total': total,
+            'manufacturer': sorted(
+                ({'id': m_id, 'name': name, 'count': counts['manufacturer'][m_id], 'selected': m_id in manufacturers}
+                 for m_id, name in names.items()),
+                key=lambda item: item['name'],
+            ),
+            'capacity': [
+                {'key': key, 'label': BAND_LABELS[key], 'count': counts['capacity'][key],
+                 'selected': bool(bands) and key in bands}
+                for key in [*BAND_KEYS, UNKNOWN_BAND]
+            ],
+            'purchased': [
+                {'year': year, 'count': count,
+                 'start': year and date(year, 1, 1).isoformat(), 'end': year and date(year, 12, 31).isoformat()}
+                for year, count in sorted(counts['purchased'].items(), key=lambda item: (item[0] is None, -(item[0] or 0)))
+            ],
+            'availability': [
+                {'value': 'available', 'label': '未レンタル', 'count': counts['availability'][True],
+                 'selected': availability is True},
+                {'value': 'rented', 'label': 'レンタル済み', 'count': counts['availability'][False],
+                 'selected': availability is False},
+            ],
+        }
@@ -3,7 +3,10 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from django.utils import timezone
-from .models import USBDevice, RentalRequest, UserPC, Manufacturer, ManufacturerWhitelist
+from .models import USBDevice, RentalRequest, UserPC, Manufacturer, ManufacturerWhitelist, Reservation, WaitlistEntry
+from .inventory import ENCODINGS
+from .usage import CAPACITY_BANDS
+from .whitelist import whitelisted_manufacturer_ids
 
 class USBDeviceForm(forms.ModelForm):
     class Meta:
@@ -24,8 +27,16 @@ class USBDeviceForm(forms.ModelForm):
             'name': {
                 'unique': "この名前のUSBデバイスは既に登録されています。",
             },
+            'manufacturer': {
+                'invalid_choice': "ホワイトリストに登録されたメーカーを選択してください。",
+            },
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # ホワイトリストに登録されたメーカーのみ選択・登録できる（IDの集合はキャッシュから取得）
+        self.fields['manufacturer'].queryset = Manufacturer.objects.filter(id__in=whitelisted_manufacturer_ids())
+
 class UserPCForm(forms.ModelForm):
     class Meta:
         model = UserPC
@@ -58,7 +69,12 @@ class RentalRequestForm(forms.ModelForm):
         user = kwargs.pop('user', None)
         super().__init__(*args, **kwargs)
         if user:
-            self.fields['pc'].queryset = UserPC.objects.filter(user=user)
+            # ウイルス対策の基準を満たすPCだけを選べる（判定済みの is_compliant をインデックスで引く）
+            self.fields['pc'].queryset = UserPC.objects.filter(user=user, is_compliant=True)
+            self.fields['pc'].help_text = "ウイルス対策のバージョンが基準を満たすPCのみ選択できます。"
+            self.fields['pc'].error_messages['invalid_choice'] = (
+                "ウイルス対策のバージョンが基準を満たすPCを選択してください。"
+            )
             
     def clean(self):
         cleaned_data = super().clean()
@@ -145,6 +161,11 @@ class ManufacturerWhitelistForm(forms.ModelForm):
         widgets = {
             'manufacturer': forms.Select(attrs={'class': 'form-control'}),
         }
+        error_messages = {
+            'manufacturer': {
+                'unique': "このメーカーは既にホワイトリストに登録されています。",
+            },
+        }
         
 class ExtensionRequestForm(forms.ModelForm):
     new_end_date = forms.DateField(
@@ -161,4 +182,164 @@ class ExtensionRequestForm(forms.ModelForm):
         if new_end_date <= timezone.now().date():
             raise forms.ValidationError("返却期日は今日以降の日付を指定してください。")
         return new_end_date
-    
\ No newline at end of file
+
+
+class ReservationForm(forms.ModelForm):
+    class Meta:
+        model = Reservation
+        fields = ['start_date', 'end_date']
+        labels = {
+            'start_date': '利用開始日',
+            'end_date': '返却予定日',
+        }
+        widgets = {
+            'start_date': forms.DateInput(attrs={'type': 'date'}),
+            'end_date': forms.DateInput(attrs={'type': 'date'}),
+        }
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start_date = cleaned_data.get("start_date")
+        end_date = cleaned_data.get("end_date")
+
+        if start_date and start_date < timezone.now().date():
+            self.add_error('start_date', "利用開始日は今日以降の日付を選択してください。")
+        if start_date and end_date and start_date > end_date:
+            self.add_error('end_date', "返却予定日は利用開始日より後の日付を選択してください。")
+        return cleaned_data
+
+
+class WaitlistForm(forms.ModelForm):
+    rental_days = forms.IntegerField(label="利用日数", min_value=1, max_value=90, required=False)
+
+    class Meta:
+        model = WaitlistEntry
+        fields = ['auto_reserve', 'rental_days', 'approver', 'pc']
+        labels = {
+            'auto_reserve': '空いたら自動でレンタルを申請する',
+            'approver': '承認者',
+            'pc': '利用PC',
+        }
+        help_texts = {
+            'auto_reserve': '選ばない場合は、返却されたときにメールでお知らせします。',
+        }
+
+    def __init__(self, *args, **kwargs):
+        user = kwargs.pop('user', None)
+        super().__init__(*args, **kwargs)
+        if user:
+            self.fields['pc'].queryset = UserPC.objects.filter(user=user, is_compliant=True)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        # 自動で申請するには、レンタル申請と同じ項目が揃っている必要がある
+        if cleaned_data.get('auto_reserve'):
+            for name in ('rental_days', 'approver', 'pc'):
+                if not cleaned_data.get(name) and name not in self.errors:
+                    self.add_error(name, "自動で申請する場合は入力してください。")
+        return cleaned_data
+
+
+class AvailabilitySearchForm(forms.Form):
+    start_date = forms.DateField(label="利用開始日", widget=forms.DateInput(attrs={'type': 'date'}))
+    end_date = forms.DateField(label="返却予定日", widget=forms.DateInput(attrs={'type': 'date'}))
+    manufacturer = forms.ModelChoiceField(
+        label="メーカー", queryset=Manufacturer.objects.order_by('name'), required=False,
+    )
+    min_capacity = forms.IntegerField(
+        label="最小容量（バイト数）", min_value=0, required=False,
+        widget=forms.NumberInput(attrs={'min': 0, 'step': 1}),
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start_date = cleaned_data.get("start_date")
+        end_date = cleaned_data.get("end_date")
+
+        if start_date and end_date and start_date > end_date:
+            self.add_error('end_date', "返却予定日は利用開始日より後の日付を選択してください。")
+        return cleaned_data
+
+
+class UsageReportForm(forms.Form):
+    start_date = forms.DateField(label="集計開始日", widget=forms.DateInput(attrs={'type': 'date'}))
+    end_date = forms.DateField(label="集計終了日", widget=forms.DateInput(attrs={'type': 'date'}))
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start_date = cleaned_data.get("start_date")
+        end_date = cleaned_data.get("end_date")
+
+        if start_date and end_date and start_date > end_date:
+            self.add_error('end_date', "集計終了日は集計開始日より後の日付を選択してください。")
+        return cleaned_data
+
+
+class DeviceImportForm(forms.Form):
+    file = forms.FileField(label="取り込むファイル")
+    format = forms.ChoiceField(
+        label="ファイル形式", choices=[('csv', 'CSV'), ('jsonl', 'JSON Lines')], initial='csv',
+    )
+    encoding = forms.ChoiceField(label="文字コード", choices=ENCODINGS, initial='utf-8-sig', required=False)
+
+    def clean_encoding(self):
+        # 指定の無い場合は UTF-8（BOM付きも可）として読む
+        return self.cleaned_data.get('encoding') or 'utf-8-sig'
+
+
+# id に使える最大値（SQLite の整数は符号付き64ビット）
+MAX_ID = 2 ** 63 - 1
+
+
+class IdListField(forms.Field):
+    """?manufacturer=1&manufacturer=2 のような複数の id。選択肢を問い合わせずに整数の一覧として受け取る"""
+    widget = forms.MultipleHiddenInput
+
+    def to_python(self, value):
+        if not value:
+            return []
+        try:
+            ids = sorted({int(v) for v in value})
+        except (TypeError, ValueError):
+            raise forms.ValidationError("id は整数で指定してください。")
+        # 範囲外の値はクエリの実行時に OverflowError になるため、ここで弾く
+        if ids[0] < 1 or ids[-1] > MAX_ID:
+            raise forms.ValidationError("id が範囲外です。")
+        return ids
+
+
+class DeviceFilterForm(forms.Form):
+    """USBデバイス一覧の絞り込み条件。容量は利用状況レポートと同じ区分（usage.CAPACITY_BANDS）の範囲で指定する"""
+    AVAILABILITY_CHOICES = [('', 'すべて'), ('available', '未レンタル'), ('rented', 'レンタル済み')]
+    CAPACITY_CHOICES = [('', '指定なし')] + [(key, label) for key, label, _ in CAPACITY_BANDS]
+
+    manufacturer = IdListField(label="メーカー", required=False)
+    capacity_from = forms.ChoiceField(label="容量（から）", choices=CAPACITY_CHOICES, required=False)
+    capacity_to = forms.ChoiceField(label="容量（まで）", choices=CAPACITY_CHOICES, required=False)
+    purchased_from = forms.DateField(label="購入日（から）", required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    purchased_to = forms.DateField(label="購入日（まで）", required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    availability = forms.ChoiceField(label="状態", choices=AVAILABILITY_CHOICES, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        purchased_from = cleaned_data.get('purchased_from')
+        purchased_to = cleaned_data.get('purchased_to')
+        if purchased_from and purchased_to and purchased_from > purchased_to:
+            self.add_error('purchased_to', "購入日の終わりは始まりより後の日付を指定してください。")
+        bands = [key for key, _label in self.CAPACITY_CHOICES]
+        capacity_from = cleaned_data.get('capacity_from')
+        capacity_to = cleaned_data.get('capacity_to')
+        if capacity_from and capacity_to and bands.index(capacity_from) > bands.index(capacity_to):
+            self.add_error('capacity_to', "容量の終わりは始まりより大きい区分を指定してください。")
+        return cleaned_data
+
+
+class ApprovalDecisionForm(forms.Form):
+    """承認待ちの一覧で選んだ申請をまとめて承認・却下する"""
+    ACTION_CHOICES = [('approve', '承認'), ('reject', '却下')]
+
+    ids = IdListField(label="申請", error_messages={'required': "申請を1件以上選択してください。"})
+    action = forms.ChoiceField(label="操作", choices=ACTION_CHOICES)
+    comment = forms.CharField(
+        label="申請者へのコメント", widget=forms.Textarea(attrs={'rows': 3}), required=False, max_length=1000,
+    )
@@ -0,0 +1,233 @@
+# rentals/instrumentation.py
+import hashlib
+import logging
+import re
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger(__name__)
+
+# 処理中のリクエストの計測値（テンプレートの描画時間を記録するために参照する）
+_current = ContextVar('request_metrics', default=None)
+
+# ルートごとのヒストグラムの区切り（ミリ秒）。プロセスごとに集計する
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_IN_LIST = re.compile(r'\((?:\s*%s\s*,)+\s*%s\s*\)')
+
+
+def fingerprint(sql):
+    """パラメーター数だけが違う IN (...) をまとめ、同じ形のクエリを同じ値にする"""
+    normalized = _IN_LIST.sub('(%s, ...)', sql)
+    return hashlib.md5(normalized.encode()).hexdigest()[:12], normalized
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = []  # (秒数, SQL)
+        self.template_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper として全てのクエリの実行時間を記録する
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((time.perf_counter() - started, sql))
+
+    @property
+    def sql_seconds(self):
+        return sum(seconds for seconds, _ in self.queries)
+
+    def duplicates(self):
+        """2回以上実行された同じ形のクエリ: {指紋: (回数, SQL)}"""
+        seen = {}
+        for _seconds, sql in self.queries:
+            key, normalized = fingerprint(sql)
+            count, _ = seen.get(key, (0, normalized))
+            seen[key] = (count + 1, normalized)
+        return {key: value for key, value in seen.items() if value[0] > 1}
+
+    def worst_queries(self, limit=3):
+        return sorted(self.queries, key=lambda query: query[0], reverse=True)[:limit]
+
+
+class RouteStats:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.sql_ms = 0.0
+        self.template_ms = 0.0
+        self.queries = 0
+
+    def observe(self, total_ms, sql_ms, template_ms, queries):
+        index = next((i for i, bound in enumerate(BUCKETS_MS) if total_ms <= bound), len(BUCKETS_MS))
+        self.buckets[index] += 1
+        self.count += 1
+        self.total_ms += total_ms
+        self.sql_ms += sql_ms
+        self.template_ms += template_ms
+        self.queries += queries
+
+
+_routes = {}
+_routes_lock = threading.Lock()
+
+
+def observe(route, total_ms, sql_ms, template_ms, queries):
+    with _routes_lock:
+        _routes.setdefault(route, RouteStats()).observe(total_ms, sql_ms, template_ms, queries)
+
+
+def reset():
+    with _routes_lock:
+        _routes.clear()
+
+
+def render_metrics():
+    """ルートごとの集計をPrometheusのテキスト形式で返す"""
+    with _routes_lock:
+        snapshot = sorted((route, vars(stats).copy()) for route, stats in _routes.items())
+
+    lines = [
+        '# HELP main_app_request_duration_ms Request duration in milliseconds.',
+        '# TYPE main_app_request_duration_ms histogram',
+    ]
+    for route, stats in snapshot:
+        cumulative = 0
+        for bound, count in zip((*BUCKETS_MS, '+Inf'), stats['buckets']):
+            cumulative += count
+            lines.append(f'main_app_request_duration_ms_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+        lines.append(f'main_app_request_duration_ms_sum{{route="{route}"}} {stats["total_ms"]:.3f}')
+        lines.append(f'main_app_request_duration_ms_count{{route="{route}"}} {stats["count"]}')
+    for name, key, help_text in (
+        ('main_app_request_sql_ms_total', 'sql_ms', 'Total SQL time in milliseconds.'),
+        ('main_app_request_template_ms_total', 'template_ms', 'Total template rendering time in milliseconds.'),
+        ('main_app_request_queries_total', 'queries', 'Total number of SQL queries.'),
+    ):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for route, stats in snapshot:
+            value = stats[key] if key == 'queries' else f'{stats[key]:.3f}'
+            lines.append(f'{name}{{route="{route}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class RequestMetricsMiddleware:
+    """
+    リクエストごとにクエリ数・SQL時間・重複クエリ・ビューとテンプレートの時間を計測し、
+    Server-Timing ヘッダーで返す。遅いリクエストは時間のかかったクエリと共にログに残し、
+    ルートごとのヒストグラムに集計する（/metrics/ で参照できる）。
+    MIDDLEWARE の先頭に置き、他のミドルウェアの処理も含めて計測する。
+    ASGIでは非同期のまま動き、非同期ビューを同期に変換させない。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        total = time.perf_counter() - metrics.started
+        self.record(request, response, metrics, total)
+        return response
+
+    async def __acall__(self, request):
+        # 非同期ORMのクエリは sync_to_async のスレッドで実行されるが、接続とコンテキスト変数は引き継がれる
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        total = time.perf_counter() - metrics.started
+        self.record(request, response, metrics, total)
+        return response
+
+    def record(self, request, response, metrics, total):
+        sql = metrics.sql_seconds
+        template = metrics.template_seconds
+        view = max(total - template, 0.0)
+        duplicates = metrics.duplicates()
+
+        if settings.SERVER_TIMING_ENABLED:
+            response['Server-Timing'] = ', '.join([
+                f'db;dur={sql * 1000:.1f};desc="SQL {len(metrics.queries)} queries"',
+                f'dup;desc="{sum(count for count, _ in duplicates.values())} duplicate queries"',
+                f'view;dur={view * 1000:.1f}',
+                f'tpl;dur={template * 1000:.1f}',
+                f'total;dur={total * 1000:.1f}',
+            ])
+
+        match = getattr(request, 'resolver_match', None)
+        route = match.view_name if match else 'unmatched'
+        observe(route, total * 1000, sql * 1000, template * 1000, len(metrics.queries))
+
+        if total * 1000 >= settings.SLOW_REQUEST_MS:
+            logger.warning(
+                "遅いリクエスト: %s %s (%s) %.1fms, SQL %d件 %.1fms, テンプレート %.1fms\n最も遅いクエリ:\n%s%s",
+                request.method, request.path, route, total * 1000, len(metrics.queries), sql * 1000, template * 1000,
+                '\n'.join(f'  {seconds * 1000:.1f}ms {query[:500]}' for seconds, query in metrics.worst_queries()),
+                ''.join(
+                    f'\n重複クエリ {key} ×{count}: {query[:200]}' for key, (count, query) in duplicates.items()
+                ),
+            )
+
+
+class TimedTemplate:
+    """描画時間を処理中のリクエストの計測値に加えるテンプレート"""
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics = _current.get()
+            if metrics is not None:
+                metrics.template_seconds += time.perf_counter() - started
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """
+    TEMPLATES の BACKEND に指定して、テンプレートの描画時間を計測する。
+    {% extends %} や {% include %} はテンプレートの中で処理されるので、二重には数えない。
+    """
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
@@ -0,0 +1,201 @@
+# rentals/inventory.py
+import csv
+import json
+from itertools import chain
+from dataclasses import dataclass, field
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Value
+from django.utils.dateparse import parse_date
+
+from .models import USBDevice, RentalRequest, ArchivedRentalRequest, Manufacturer
+from .versions import bump_inventory
+from .whitelist import whitelisted_manufacturer_ids
+
+FORMATS = ('csv', 'jsonl')
+# 取り込むファイルの文字コード。Excel で保存したCSVは cp932（Shift_JIS）になることが多い
+ENCODINGS = [('utf-8-sig', 'UTF-8'), ('cp932', 'Shift_JIS（Excel の CSV）')]
+
+DEVICE_COLUMNS = ['id', 'name', 'description', 'manufacturer', 'purchase_date', 'capacity', 'is_available']
+RENTAL_COLUMNS = [
+    'id', 'usb_device', 'user', 'requested_at', 'approved', 'approver', 'pc',
+    'start_date', 'end_date', 'is_returned',
+]
+
+
+@dataclass
+class ImportResult:
+    created: int = 0
+    errors: list = field(default_factory=list)  # (行番号, メッセージ) のリスト
+
+
+def read_rows(fileobj, fmt):
+    """CSV（ヘッダー行あり）またはJSON Linesを1行ずつ (行番号, dict) で返す"""
+    if fmt == 'csv':
+        reader = csv.DictReader(fileobj)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_num, line in enumerate(fileobj, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_num, row
+
+
+def parse_device(row, manufacturers, allowed_ids):
+    """1行分のデータから USBDevice を組み立てる。不正な場合は ValueError を送出する"""
+    if not isinstance(row, dict):
+        raise ValueError("行を解析できません。")
+    name = str(row.get('name') or '').strip()
+    if not name:
+        raise ValueError("デバイス名は必須です。")
+    if len(name) > USBDevice._meta.get_field('name').max_length:
+        raise ValueError("デバイス名が長すぎます。")
+
+    manufacturer_name = str(row.get('manufacturer') or '').strip()
+    if not manufacturer_name:
+        raise ValueError("メーカーは必須です。")
+    manufacturer_id = manufacturers.get(manufacturer_name)
+    if manufacturer_id is None:
+        raise ValueError(f"メーカー「{manufacturer_name}」は登録されていません。")
+    if manufacturer_id not in allowed_ids:
+        raise ValueError(f"メーカー「{manufacturer_name}」はホワイトリストに登録されていません。")
+
+    purchase_date = None
+    if row.get('purchase_date'):
+        try:
+            purchase_date = parse_date(str(row['purchase_date']))
+        except ValueError:
+            purchase_date = None
+        if purchase_date is None:
+            raise ValueError("購入日の形式が不正です（YYYY-MM-DD）。")
+
+    capacity = None
+    if row.get('capacity') not in (None, ''):
+        try:
+            capacity = int(row['capacity'])
+        except (TypeError, ValueError):
+            raise ValueError("容量は整数で指定してください。")
+        if capacity < 0:
+            raise ValueError("容量は0以上で指定してください。")
+
+    return USBDevice(
+        name=name, description=str(row.get('description') or ''),
+        manufacturer_id=manufacturer_id, purchase_date=purchase_date, capacity=capacity,
+    )
+
+
+def import_devices(rows, batch_size=1000):
+    """
+    (行番号, dict) の列からUSBデバイスを一括登録する。
+    メーカー名は最初に一度だけ読み込んだ対応表で解決し（ホワイトリスト外のメーカーはエラー）、
+    bulk_create でまとめて挿入する。
+    不正な行はエラーとして記録し、他の行の登録は続ける。
+    ファイルを指定の文字コードで読めなくなった場合は、そこまでの行だけを登録してエラーとして記録する。
+    """
+    result = ImportResult()
+    manufacturers = dict(Manufacturer.objects.values_list('name', 'id'))
+    allowed_ids = whitelisted_manufacturer_ids()
+    seen_names = set()
+    batch = []
+
+    line_num = 0
+    try:
+        for line_num, row in rows:
+            try:
+                device = parse_device(row, manufacturers, allowed_ids)
+            except ValueError as e:
+                result.errors.append((line_num, str(e)))
+                continue
+            if device.name in seen_names:
+                result.errors.append((line_num, f"デバイス名「{device.name}」がファイル内で重複しています。"))
+                continue
+            seen_names.add(device.name)
+            batch.append((line_num, device))
+            if len(batch) >= batch_size:
+                _flush(batch, result)
+                batch = []
+    except UnicodeDecodeError:
+        # 読み込みはまとめて行うため、読めなかった位置はおおよその行番号になる
+        result.errors.append((
+            line_num + 1,
+            "指定の文字コードで読み込めないため、この行以降は取り込んでいません。ファイルの文字コードを確認してください。",
+        ))
+    _flush(batch, result)
+    if result.created:
+        # bulk_create ではシグナルが送られないため、一覧のバージョンをここで進める
+        bump_inventory()
+    # 既存デバイスとの重複はバッチ単位で見つかるため、行番号順に並べ直す
+    result.errors.sort(key=lambda error: error[0])
+    return result
+
+
+def _flush(batch, result):
+    if not batch:
+        return
+    # 既存デバイスとの名前の重複はバッチごとに1回のクエリで確認する
+    existing = set(USBDevice.objects.filter(name__in=[d.name for _, d in batch]).values_list('name', flat=True))
+    devices = []
+    for line_num, device in batch:
+        if device.name in existing:
+            result.errors.append((line_num, f"デバイス名「{device.name}」は既に登録されています。"))
+        else:
+            devices.append((line_num, device))
+
+    try:
+        with transaction.atomic():
+            USBDevice.objects.bulk_create([d for _, d in devices])
+        result.created += len(devices)
+    except IntegrityError:
+        # 確認後に他から登録された場合などは、1件ずつ登録してエラーの行を特定する
+        for line_num, device in devices:
+            try:
+                with transaction.atomic():
+                    device.save()
+                result.created += 1
+            except IntegrityError as e:
+                result.errors.append((line_num, str(e)))
+
+
+class Echo:
+    """csv.writer の出力をそのまま返すための擬似ファイル"""
+
+    def write(self, value):
+        return value
+
+
+def stream_rows(columns, rows, fmt):
+    """タプルの列を1行ずつCSVまたはJSON Linesの文字列にして返すジェネレーター"""
+    if fmt == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(columns)
+        for row in rows:
+            yield writer.writerow(row)
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def export_devices(fmt, chunk_size=2000):
+    rows = USBDevice.objects.order_by('id').values_list(
+        'id', 'name', 'description', 'manufacturer__name', 'purchase_date', 'capacity', 'is_available',
+    ).iterator(chunk_size=chunk_size)
+    return stream_rows(DEVICE_COLUMNS, rows, fmt)
+
+
+def export_rentals(fmt, chunk_size=2000):
+    # アーカイブ済みの古いレンタルを先に、続けて現行テーブルのレンタルを書き出す
+    columns = ['id', 'usb_device__name', 'user__username', 'requested_at', 'approved', 'approver__username',
+               'pc__serial_number', 'start_date', 'end_date']
+    archived = ArchivedRentalRequest.objects.order_by('id').values_list(
+        *columns, Value(True),
+    ).iterator(chunk_size=chunk_size)
+    current = RentalRequest.objects.order_by('id').values_list(
+        *columns, 'is_returned',
+    ).iterator(chunk_size=chunk_size)
+    return stream_rows(RENTAL_COLUMNS, chain(archived, current), fmt)
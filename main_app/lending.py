@@ -0,0 +1,203 @@
+# rentals/lending.py
+# レンタルの状態を変える処理（貸出・返却・延長・承認・却下）。画面からの操作と、空き待ちの自動申請の両方から使う。
+# 状態の変化は同じトランザクションで DeviceEvent に追記してイベントストリームで配信し、
+# 操作の内容（コメントを含む）は RentalEvent に追記して残す（main_app.rental_log）
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import device_events, rental_log, versions
+from .dashboard import invalidate_dashboard
+from .models import DeviceEvent, RentalEvent, RentalRequest, Reservation, USBDevice, WaitlistEntry
+from .outbox import queue_mail, queue_mass_mail
+from .overdue import invalidate_overdue
+from .whitelist import whitelisted_manufacturer_ids
+
+
+def rent(rental_request):
+    """デバイスを貸出中にしてレンタル申請を保存する。他の申請に先を越された場合は False を返す"""
+    try:
+        with transaction.atomic():
+            # 貸出可能でメーカーがホワイトリストに登録されている場合だけ、条件付きUPDATEで貸出中にする。
+            # 同時に申請された場合は1件だけが成功する
+            reserved = USBDevice.objects.filter(
+                id=rental_request.usb_device_id, is_available=True, manufacturer_id__in=whitelisted_manufacturer_ids(),
+            ).update(is_available=False)
+            if not reserved:
+                return False
+            # 他のユーザーの予約と期間が重なる場合は取り消す
+            if Reservation.objects.overlapping(rental_request.start_date, rental_request.end_date).filter(
+                usb_device_id=rental_request.usb_device_id
+            ).exclude(user=rental_request.user).exists():
+                transaction.set_rollback(True)
+                return False
+            rental_request.save()
+            invalidate_overdue(rental_request.user_id)
+            device_events.record(rental_request.usb_device_id, DeviceEvent.RENTED, is_available=False)
+            rental_log.record(RentalEvent.RENTED, rental_request)
+            # 承認依頼メールは同じトランザクションで送信待ちに登録し、送信は send_outbox コマンドに任せる
+            queue_approval_email(rental_request)
+    except IntegrityError:
+        # 未返却レンタルの一意制約に引っかかった場合も競合として扱う
+        return False
+    return True
+
+
+def queue_approval_email(rental_request):
+    """承認者へのレンタル申請の通知メールを送信待ちに登録する"""
+    subject = "USBレンタル申請の承認が必要です"
+    message = (
+        f"{rental_request.user.username}さんがUSBデバイス『{rental_request.usb_device.name}』の"
+        "レンタルを申請しました。\n"
+        f"承認者であるあなたの承認が必要です。\n"
+        f"レンタル開始日: {rental_request.start_date}\n"
+        f"返却期日: {rental_request.end_date}\n\n"
+        "承認・却下を行ってください。"
+    )
+    recipient_list = [rental_request.approver.email]  # 承認者のメールアドレス
+    queue_mail(subject, message, recipient_list, settings.DEFAULT_FROM_EMAIL)
+
+
+@transaction.atomic
+def return_rental(rental_request, comment=''):
+    """
+    レンタルを返却済みにしてデバイスを貸出可能に戻し、空き待ちの先頭の1人に回す。
+    返却時のコメントは操作の記録に残す。空き待ちから自動で申請したレンタルがあれば返す
+    """
+    rental_request.is_returned = True
+    rental_request.returned_at = timezone.now()
+    rental_request.save()
+
+    usb_device = rental_request.usb_device
+    usb_device.is_available = True
+    usb_device.save()
+    invalidate_overdue(rental_request.user_id)
+    device_events.record(usb_device.id, DeviceEvent.RETURNED, is_available=True)
+    rental_log.record(RentalEvent.RETURNED, rental_request, comment=comment)
+    return serve_waitlist(usb_device)
+
+
+def extend_rental(rental_request, new_end_date):
+    """返却期日を延ばす"""
+    with transaction.atomic():
+        rental_request.end_date = new_end_date
+        rental_request.save()
+        invalidate_overdue(rental_request.user_id)
+        device_events.record(rental_request.usb_device_id, DeviceEvent.EXTENDED, is_available=False)
+        rental_log.record(RentalEvent.EXTENDED, rental_request)
+
+
+def decide(approver, rental_ids, approve, comment=''):
+    """
+    承認者に割り当てられた未判断の申請をまとめて承認または却下し、判断した申請を返す。
+    件数に関わらず、条件付きUPDATEと判断した行の読み込みと操作の記録が1回ずつ、通知メールは申請者ごとに1通で済む。
+    却下した申請は返却済みにしてデバイスを貸出可能に戻す。判断済みの申請や他の承認者の申請は対象にしない
+    """
+    now = timezone.now()
+    changes = {'decided_at': now, 'updated_at': now}
+    if approve:
+        changes['approved'] = True
+    else:
+        changes.update(is_returned=True, returned_at=now)
+
+    with transaction.atomic():
+        # 先にUPDATEし、判断日時で今回更新した行だけを読み戻す（同時に判断された行を二重に処理しない）
+        updated = RentalRequest.objects.pending_for(approver).filter(id__in=rental_ids).update(**changes)
+        if not updated:
+            return []
+        rentals = list(
+            RentalRequest.objects.filter(id__in=rental_ids, approver=approver, decided_at=now)
+            .select_related('user', 'usb_device').order_by('id')
+        )
+        device_ids = [rental.usb_device_id for rental in rentals]
+        rental_log.record_many(RentalEvent.APPROVED if approve else RentalEvent.REJECTED, rentals, approver.id, comment)
+        if approve:
+            versions.touch_devices(device_ids)
+        else:
+            USBDevice.objects.filter(id__in=device_ids).update(is_available=True, updated_at=now)
+            versions.bump_inventory()
+            device_events.record_many(device_ids, DeviceEvent.REJECTED, is_available=True)
+            for user_id in {rental.user_id for rental in rentals}:
+                invalidate_overdue(user_id)
+        # UPDATE ではシグナルが送られないため、ホームページのキャッシュはここで消す
+        invalidate_dashboard(approver.id, *{rental.user_id for rental in rentals})
+        queue_decision_emails(approver, rentals, approve, comment)
+
+        if not approve:
+            # 空き待ちのあるデバイスだけ、先頭の人に回す
+            waiting = set(
+                WaitlistEntry.objects.filter(usb_device_id__in=device_ids).values_list('usb_device_id', flat=True)
+            )
+            for rental in rentals:
+                if rental.usb_device_id in waiting:
+                    serve_waitlist(rental.usb_device)
+    return rentals
+
+
+def queue_decision_emails(approver, rentals, approve, comment):
+    """承認・却下の結果を、申請者ごとに1通にまとめて送信待ちに登録する"""
+    by_user = defaultdict(list)
+    for rental in rentals:
+        by_user[rental.user].append(rental)
+    result = "承認" if approve else "却下"
+    note = f"\n\n承認者からのコメント:\n{comment}" if comment else ""
+    queue_mass_mail([
+        (
+            f"USBレンタル申請が{result}されました",
+            f"{approver.username}さんが以下のUSBレンタル申請を{result}しました。\n\n"
+            + "\n".join(
+                f"・{rental.usb_device.name}（{rental.start_date} 〜 {rental.end_date}）" for rental in items
+            )
+            + ("" if approve else "\n\n却下された申請のデバイスは返却済みとして扱われます。")
+            + note,
+            settings.DEFAULT_FROM_EMAIL, [user.email],
+        )
+        for user, items in by_user.items()
+    ])
+
+
+def serve_waitlist(usb_device):
+    """
+    空き待ちの先頭の登録を取り出し、自動申請の指定があれば代わりにレンタルを申請する。
+    申請できなかった場合（PCや承認者の削除、PCのウイルス対策が基準を満たさない、予約との重なりなど）と通知だけの登録は、メールで知らせる。
+    登録は1度使えば消すため、次の返却では2番目の人に回る
+    """
+    entry = (
+        WaitlistEntry.objects.filter(usb_device=usb_device)
+        .select_related('user', 'approver', 'pc').order_by('id').first()
+    )
+    if entry is None:
+        return None
+    entry.delete()
+
+    if (
+        entry.auto_reserve and entry.approver and entry.pc
+        and entry.pc.user_id == entry.user_id and entry.pc.is_compliant
+    ):
+        today = timezone.now().date()
+        rental_request = RentalRequest(
+            usb_device=usb_device, user=entry.user, approver=entry.approver, pc=entry.pc,
+            start_date=today, end_date=today + timedelta(days=entry.rental_days or 1),
+        )
+        if rent(rental_request):
+            queue_mail(
+                "空き待ちのUSBデバイスのレンタルを申請しました",
+                f"空き待ちに登録していたUSBデバイス『{usb_device.name}』が返却されたため、"
+                "登録内容でレンタルを申請しました。\n"
+                f"レンタル開始日: {rental_request.start_date}\n"
+                f"返却期日: {rental_request.end_date}\n\n"
+                "承認者の承認をお待ちください。",
+                [entry.user.email], settings.DEFAULT_FROM_EMAIL,
+            )
+            return rental_request
+
+    queue_mail(
+        "空き待ちのUSBデバイスが返却されました",
+        f"空き待ちに登録していたUSBデバイス『{usb_device.name}』が返却され、レンタルできるようになりました。\n"
+        "他の人に先に申請される前に、レンタルを申請してください。",
+        [entry.user.email], settings.DEFAULT_FROM_EMAIL,
+    )
+    return None
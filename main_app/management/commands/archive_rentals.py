@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections, router, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from main_app.models import RentalRequest, ArchivedRentalRequest
+
+ARCHIVED_FIELDS = [
+    'id', 'usb_device_id', 'user_id', 'requested_at', 'approved',
+    'start_date', 'end_date', 'approver_id', 'pc_id', 'returned_at',
+]
+
+
+class Command(BaseCommand):
+    help = "返却期日から一定期間が過ぎた返却済みレンタルを、少しずつアーカイブテーブルへ移します"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days', type=int, default=settings.RENTAL_ARCHIVE_AFTER_DAYS,
+            help="返却期日からこの日数が過ぎた返却済みレンタルを移す（既定値は RENTAL_ARCHIVE_AFTER_DAYS）",
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help="1回のトランザクションで移す件数")
+        parser.add_argument('--dry-run', action='store_true', help="移さずに対象件数だけ表示する")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now().date() - timedelta(days=options['older_than_days'])
+        # 返却期日の無いレンタルは申請日時で判定する
+        targets = RentalRequest.objects.filter(is_returned=True).filter(
+            Q(end_date__lt=cutoff) | Q(end_date__isnull=True, requested_at__date__lt=cutoff)
+        )
+
+        if options['dry_run']:
+            self.stdout.write(f"アーカイブ対象: {targets.count()}件（返却期日が {cutoff} より前）")
+            return
+
+        using = router.db_for_write(RentalRequest)
+        table = connections[using].ops.quote_name(RentalRequest._meta.db_table)
+        moved = 0
+        while True:
+            # バッチごとに短いトランザクションで移し、現行テーブルへの書き込みを長く止めない
+            with transaction.atomic(using=using):
+                rows = list(targets.order_by('id').values(*ARCHIVED_FIELDS)[:options['batch_size']])
+                if not rows:
+                    break
+                ArchivedRentalRequest.objects.bulk_create([ArchivedRentalRequest(**row) for row in rows])
+                # QuerySet.delete() は post_delete の受信者があると全件を読み込んで1件ずつシグナルを送る
+                # （行ごとにデバイスの更新日時のUPDATEが走る）ため、生のSQLで1回のDELETEにする。
+                # 移した行は返却済みで、デバイスの履歴にはアーカイブから同じ内容で表示され、ホームページにも出ないため、
+                # シグナルで行う更新日時の更新やキャッシュの削除は要らない
+                ids = [row['id'] for row in rows]
+                with connections[using].cursor() as cursor:
+                    cursor.execute(
+                        f'DELETE FROM {table} WHERE id IN ({", ".join(["%s"] * len(ids))})', ids,
+                    )
+            moved += len(rows)
+            self.stdout.write(f"{moved}件をアーカイブしました")
+
+        self.stdout.write(self.style.SUCCESS(f"完了: {moved}件をアーカイブしました（返却期日が {cutoff} より前）"))
@@ -0,0 +1,209 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from io import BytesIO
+from types import ModuleType
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from django.urls import include, path, reverse
+
+from main_app.models import USBDevice
+from main_app.urls import build_urlpatterns
+from .benchmark_routes import percentile
+
+HOST = 'localhost'
+
+# 非同期ビューに切り替わる読み取りの多いURL（URL名, URL引数を作る関数, クエリ文字列）
+READ_ROUTES = [
+    ('usb_list', lambda device: [], ''),
+    ('usb_device_detail', lambda device: [device.id], ''),
+    ('user_pc_list', lambda device: [], ''),
+    ('whitelist_list', lambda device: [], ''),
+    ('api_devices', lambda device: [], ''),
+    ('api_device_search', lambda device: [], 'q=usb'),
+    ('api_rentals', lambda device: [], 'active=1'),
+    ('api_user_pcs', lambda device: [], ''),
+    ('api_whitelist', lambda device: [], ''),
+]
+
+
+def build_urlconf(async_reads):
+    urlconf = ModuleType('benchmark_urls_async' if async_reads else 'benchmark_urls_sync')
+    urlconf.urlpatterns = [
+        path('', include(build_urlpatterns(async_reads=async_reads))),
+        path('accounts/', include('django.contrib.auth.urls')),
+    ]
+    return urlconf
+
+
+class Command(BaseCommand):
+    help = (
+        "読み取りの多いURLを、同期ビュー＋WSGIハンドラー（スレッド）と非同期ビュー＋ASGIハンドラー（イベントループ）で"
+        "同時に多数呼び出し、スループットとレイテンシを比較します。現在のデータベースをそのまま読むため、"
+        "先に seed_data コマンドでデータを登録してください（書き込みはログイン用のセッションのみで、最後に削除します）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="URLごと・方式ごとのリクエスト数")
+        parser.add_argument('--concurrency', type=int, default=64, help="同時に処理中にするリクエスト数（WSGIではスレッド数）")
+        parser.add_argument('--warmup', type=int, default=5, help="計測前に1件ずつ捨てるリクエスト数")
+        parser.add_argument('--username', help="ログインするユーザー（省略時は最初のユーザー）")
+        parser.add_argument('--routes', help="計測するURL名をカンマ区切りで指定（省略時は全て）")
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--requests と --concurrency は1以上で指定してください")
+        user = self.get_user(options['username'])
+        device = USBDevice.objects.order_by('id').first()
+        if device is None:
+            raise CommandError("USBデバイスがありません。先に seed_data コマンドでデータを登録してください")
+        routes = self.select_routes(options['routes'])
+        targets = [(name, reverse(name, args=args(device)), query) for name, args, query in routes]
+
+        session = self.login(user)
+        cookie = f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+        # 計測中は遅いリクエストのログを止める（同時実行数が多いと全件が遅い扱いになるため）
+        overrides = {'ALLOWED_HOSTS': [HOST, *settings.ALLOWED_HOSTS], 'SLOW_REQUEST_MS': 10 ** 9}
+        try:
+            results = {}
+            with override_settings(ROOT_URLCONF=build_urlconf(async_reads=False), **overrides):
+                handler = WSGIHandler()
+                for name, url, query in targets:
+                    results[(name, 'wsgi')] = self.run_wsgi(handler, url, query, cookie, options)
+            with override_settings(ROOT_URLCONF=build_urlconf(async_reads=True), **overrides):
+                handler = ASGIHandler()
+                for name, url, query in targets:
+                    results[(name, 'asgi')] = asyncio.run(self.run_asgi(handler, url, query, cookie, options))
+        finally:
+            session.delete()
+
+        self.report([name for name, _, _ in targets], results, options)
+
+    def get_user(self, username):
+        users = User.objects.filter(is_active=True)
+        user = users.filter(username=username).first() if username else users.order_by('id').first()
+        if user is None:
+            raise CommandError("ログインに使うユーザーがいません。--username を確認するか seed_data でデータを登録してください")
+        return user
+
+    def select_routes(self, names):
+        if not names:
+            return READ_ROUTES
+        by_name = {route[0]: route for route in READ_ROUTES}
+        selected = [name.strip() for name in names.split(',') if name.strip()]
+        unknown = [name for name in selected if name not in by_name]
+        if unknown:
+            raise CommandError(f"計測対象に無いURL名です: {', '.join(unknown)}")
+        return [by_name[name] for name in selected]
+
+    def login(self, user):
+        """ハンドラーに直接渡すリクエスト用に、ログイン済みのセッションを作る"""
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        return session
+
+    def run_wsgi(self, handler, url, query, cookie, options):
+        def request():
+            environ = {
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': url, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+                'SERVER_NAME': HOST, 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'REMOTE_ADDR': '127.0.0.1',
+                'HTTP_HOST': HOST, 'HTTP_COOKIE': cookie,
+                'wsgi.input': BytesIO(), 'wsgi.errors': self.stderr, 'wsgi.url_scheme': 'http',
+                'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False, 'wsgi.version': (1, 0),
+            }
+            status = []
+            started = time.perf_counter()
+            response = handler(environ, lambda s, headers, exc_info=None: status.append(int(s.split()[0])))
+            try:
+                for _chunk in response:
+                    pass
+            finally:
+                response.close()
+            return status[0], time.perf_counter() - started
+
+        for _ in range(options['warmup']):
+            request()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            started = time.perf_counter()
+            samples = list(pool.map(lambda _: request(), range(options['requests'])))
+            wall = time.perf_counter() - started
+        return self.summarize(samples, wall)
+
+    async def run_asgi(self, handler, url, query, cookie, options):
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': url, 'raw_path': url.encode(), 'query_string': query.encode(), 'root_path': '',
+            'headers': [(b'host', HOST.encode()), (b'cookie', cookie.encode())],
+            'client': ('127.0.0.1', 0), 'server': (HOST, 80),
+        }
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def request():
+            finished = asyncio.Event()
+            status = []
+            body_read = False
+
+            async def receive():
+                nonlocal body_read
+                if not body_read:
+                    body_read = True
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                # 応答を送り終えるまでは切断しない
+                await finished.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+                elif message['type'] == 'http.response.body' and not message.get('more_body'):
+                    finished.set()
+
+            async with semaphore:
+                started = time.perf_counter()
+                await handler(dict(scope), receive, send)
+                return status[0], time.perf_counter() - started
+
+        for _ in range(options['warmup']):
+            await request()
+        started = time.perf_counter()
+        samples = await asyncio.gather(*[request() for _ in range(options['requests'])])
+        wall = time.perf_counter() - started
+        return self.summarize(samples, wall)
+
+    @staticmethod
+    def summarize(samples, wall):
+        timings = [elapsed * 1000 for _status, elapsed in samples]
+        return {
+            'rps': len(samples) / wall,
+            'p50_ms': percentile(timings, 50),
+            'p95_ms': percentile(timings, 95),
+            'p99_ms': percentile(timings, 99),
+            'errors': sum(1 for status, _elapsed in samples if status != 200),
+        }
+
+    def report(self, names, results, options):
+        self.stdout.write(f"同時実行数 {options['concurrency']}、URLごとに {options['requests']} リクエスト")
+        self.stdout.write(
+            f"{'URL名':<20} {'方式':<5} {'req/s':>9} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'エラー':>6}"
+        )
+        for name in names:
+            for mode in ('wsgi', 'asgi'):
+                r = results[(name, mode)]
+                self.stdout.write(
+                    f"{name:<20} {mode:<5} {r['rps']:>9.1f} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} "
+                    f"{r['p99_ms']:>9.2f} {r['errors']:>6}"
+                )
+            ratio = results[(name, 'asgi')]['rps'] / results[(name, 'wsgi')]['rps']
+            self.stdout.write(f"{'':<20} ASGI/WSGI スループット比 {ratio:.2f}")
+        if any(r['errors'] for r in results.values()):
+            self.stderr.write("200以外の応答がありました。ログインユーザーやデータを確認してください")
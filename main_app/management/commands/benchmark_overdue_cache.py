@@ -0,0 +1,68 @@
+import statistics
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from main_app.instrumentation import RequestMetrics
+from main_app.models import RentalRequest
+from main_app.synthetic import SyntheticData
+from main_app.views import USBListView
+
+
+class Command(BaseCommand):
+    help = "USBデバイス一覧の返却期限切れ警告について、キャッシュ有無でのDB時間を比較します（データはロールバックされます）"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rentals', type=int, default=200_000, help="生成するレンタル件数")
+        parser.add_argument('--users', type=int, default=500, help="生成するユーザー数")
+        parser.add_argument('--devices', type=int, default=1000, help="生成するデバイス数")
+        parser.add_argument('--requests', type=int, default=200, help="計測するリクエスト数")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            user = self.seed(options)
+            request = RequestFactory().get(reverse('usb_list'))
+            request.user = user
+            view = USBListView.as_view()
+
+            rows = []
+            for label, seconds in (("キャッシュなし", 0), ("キャッシュあり", 24 * 60 * 60)):
+                with override_settings(OVERDUE_CACHE_SECONDS=seconds):
+                    cache.clear()
+                    rows.append((label, *self.measure(view, request, options['requests'])))
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"{'':<12} {'クエリ数/件':>10} {'DB時間 p50(ms)':>14} {'DB時間 p95(ms)':>14}")
+        for label, queries, p50, p95 in rows:
+            self.stdout.write(f"{label:<12} {queries:>10.1f} {p50:>14.3f} {p95:>14.3f}")
+
+    def measure(self, view, request, count):
+        timings, queries = [], []
+        for _ in range(count):
+            # 画面のリクエストごとの計測（RequestMetricsMiddleware）と同じ方法でSQLの件数と時間を数える
+            metrics = RequestMetrics()
+            with connection.execute_wrapper(metrics):
+                view(request).render()
+            timings.append(metrics.sql_seconds * 1000)
+            queries.append(len(metrics.queries))
+        timings.sort()
+        return statistics.mean(queries), timings[len(timings) // 2], timings[int(len(timings) * 0.95) - 1]
+
+    def seed(self, options):
+        SyntheticData('bench').populate(
+            manufacturers=10, users=options['users'], devices=options['devices'], rentals=options['rentals'],
+            reservations=0,
+        )
+        # 計測対象は返却期限切れのレンタルが最も多いユーザー（警告の一覧が空にならないようにする）
+        overdue = (
+            RentalRequest.objects.filter(is_returned=False, end_date__lt=timezone.now().date())
+            .values('user_id').annotate(count=Count('id')).order_by('-count', 'user_id').first()
+        )
+        return User.objects.get(id=overdue['user_id']) if overdue else User.objects.filter(username__startswith='bench-user-').first()
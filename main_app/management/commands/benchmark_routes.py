@@ -0,0 +1,239 @@
+import json
+import statistics
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from main_app import urls as main_urls
+from main_app.models import USBDevice, RentalRequest, UserPC, Reservation, WaitlistEntry
+from main_app.synthetic import SyntheticData
+
+DEFAULT_BASELINE = Path(settings.BASE_DIR) / 'benchmark_baseline.json'
+
+
+@dataclass
+class Route:
+    """計測するURL。args / data は計測用データ（Fixtures）からURL引数と送信内容を作る"""
+    name: str
+    method: str = 'get'
+    args: callable = lambda f: []
+    data: callable = lambda f: {}
+    expect: tuple = (200,)
+
+
+@dataclass
+class Fixtures:
+    user: User
+    pc: UserPC
+    free_device: USBDevice
+    rented_device: USBDevice
+    rental: RentalRequest
+    reservation: Reservation
+    waitlist_entry: WaitlistEntry
+    today: object = field(default_factory=lambda: timezone.now().date())
+
+    def day(self, offset):
+        return self.today + timedelta(days=offset)
+
+
+ROUTES = [
+    Route('index'),
+    Route('signup'),
+    Route('usb_device_create'),
+    Route('usb_device_import'),
+    Route('inventory_export', args=lambda f: ['devices']),
+    Route('usb_device_detail', args=lambda f: [f.rented_device.id]),
+    Route('usb_device_edit', args=lambda f: [f.rented_device.id]),
+    Route('usb_device_delete', args=lambda f: [f.rented_device.id]),
+    Route('usb_list'),
+    Route('request_rental', method='post', args=lambda f: [f.free_device.id], data=lambda f: {
+        'start_date': f.today, 'end_date': f.day(3), 'approver': f.user.id, 'pc': f.pc.id,
+    }, expect=(302,)),
+    Route('return_usb', method='post', args=lambda f: [f.rented_device.id], data=lambda f: {
+        'comments': 'benchmark',
+    }, expect=(302,)),
+    Route('extension_request', method='post', args=lambda f: [f.rental.id], data=lambda f: {
+        'new_end_date': f.day(7),
+    }, expect=(302,)),
+    Route('device_availability', data=lambda f: {'start_date': f.day(1), 'end_date': f.day(3)}),
+    Route('reservation_create', method='post', args=lambda f: [f.free_device.id], data=lambda f: {
+        'start_date': f.day(100), 'end_date': f.day(101),
+    }, expect=(302,)),
+    Route('reservation_list'),
+    Route('reservation_cancel', args=lambda f: [f.reservation.id]),
+    Route('waitlist_join', args=lambda f: [f.rented_device.id]),
+    Route('waitlist_cancel', args=lambda f: [f.waitlist_entry.id]),
+    # WSGIのテストクライアントでは配信せずに204を返す（ASGIでの配信は benchmark_asgi の対象外）
+    Route('device_events', expect=(204,)),
+    Route('approval_queue'),
+    Route('add_user_pc'),
+    Route('user_pc_list'),
+    Route('user_pc_edit', args=lambda f: [f.pc.id]),
+    Route('user_pc_delete', args=lambda f: [f.pc.id]),
+    Route('whitelist_add'),
+    Route('whitelist_list'),
+    Route('usage_report'),
+    Route('usage_report_export', args=lambda f: ['devices']),
+    Route('request_metrics'),
+    Route('api_devices'),
+    Route('api_device_search', data=lambda f: {'q': 'benchmark'}),
+    Route('api_rentals'),
+    Route('api_archived_rentals'),
+    Route('api_user_pcs'),
+    Route('api_whitelist'),
+]
+
+
+def percentile(values, pct):
+    if len(values) < 2:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[pct - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        "main_app の各URLをテストクライアントで呼び出し、レイテンシのパーセンタイルとクエリ数を計測します。"
+        "保存済みのベースラインより悪化したURLがあれば失敗します（計測中の変更はロールバックされます）。"
+        "大規模データでの計測には先に seed_data コマンドでデータを登録してください"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=30, help="URLごとの計測リクエスト数")
+        parser.add_argument('--warmup', type=int, default=3, help="計測前に捨てるリクエスト数")
+        parser.add_argument('--routes', help="計測するURL名をカンマ区切りで指定（省略時は全て）")
+        parser.add_argument('--baseline', default=str(DEFAULT_BASELINE), help="ベースラインのJSONファイル")
+        parser.add_argument('--save-baseline', action='store_true', help="今回の結果をベースラインとして保存する")
+        parser.add_argument('--output', help="今回の結果をJSONで保存するファイル")
+        parser.add_argument('--tolerance', type=float, default=0.25, help="p95レイテンシの許容する悪化率")
+        parser.add_argument('--min-delta-ms', type=float, default=2.0, help="これ以下のp95の悪化は揺らぎとして無視する")
+
+    def handle(self, *args, **options):
+        routes = self.select_routes(options['routes'])
+        self.warn_uncovered()
+
+        with override_settings(ALLOWED_HOSTS=['testserver', *settings.ALLOWED_HOSTS]), transaction.atomic():
+            fixtures = self.create_fixtures()
+            client = Client()
+            client.force_login(fixtures.user)
+            results = {
+                route.name: self.measure(client, route, fixtures, options['requests'], options['warmup'])
+                for route in routes
+            }
+            transaction.set_rollback(True)
+
+        self.report(results)
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2, ensure_ascii=False))
+
+        baseline_path = Path(options['baseline'])
+        if options['save_baseline']:
+            baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+            baseline.update(results)
+            baseline_path.write_text(json.dumps(baseline, indent=2, ensure_ascii=False))
+            self.stdout.write(self.style.SUCCESS(f"ベースラインを {baseline_path} に保存しました"))
+            return
+        if not baseline_path.exists():
+            self.stdout.write(f"ベースライン {baseline_path} が無いため比較しません（--save-baseline で保存できます）")
+            return
+
+        regressions = self.compare(results, json.loads(baseline_path.read_text()), options)
+        if regressions:
+            raise CommandError("ベースラインより悪化したURLがあります:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS("ベースラインからの悪化はありません"))
+
+    def select_routes(self, names):
+        if not names:
+            return ROUTES
+        by_name = {route.name: route for route in ROUTES}
+        selected = [name.strip() for name in names.split(',') if name.strip()]
+        unknown = [name for name in selected if name not in by_name]
+        if unknown:
+            raise CommandError(f"計測対象に無いURL名です: {', '.join(unknown)}")
+        return [by_name[name] for name in selected]
+
+    def warn_uncovered(self):
+        covered = {route.name for route in ROUTES}
+        missing = [p.name for p in main_urls.urlpatterns if p.name and p.name not in covered]
+        if missing:
+            self.stderr.write(f"計測対象に含まれていないURLがあります: {', '.join(missing)}")
+
+    def create_fixtures(self):
+        """計測用のユーザー・PC・デバイスを合成データとして作り、レンタル・予約・空き待ちを付ける（最後にロールバックされる）"""
+        data = SyntheticData('benchmark')
+        data.populate(manufacturers=1, users=1, devices=2, rentals=0, reservations=0)
+        today = data.today
+
+        # /metrics/ も計測できるようスタッフにする
+        user = User.objects.get(username__startswith='benchmark-user-')
+        user.is_staff = True
+        user.save(update_fields=['is_staff'])
+        pc = UserPC.objects.get(user=user)
+        free_device, rented_device = USBDevice.objects.filter(name__startswith='benchmark-usb-').order_by('id')
+        USBDevice.objects.filter(id=rented_device.id).update(is_available=False)
+        rental = RentalRequest.objects.create(
+            usb_device=rented_device, user=user, approver=user, pc=pc,
+            start_date=today - timedelta(days=10), end_date=today - timedelta(days=1),
+        )
+        reservation = Reservation.objects.create(
+            usb_device=free_device, user=user, start_date=today + timedelta(days=60), end_date=today + timedelta(days=61),
+        )
+        waitlist_entry = WaitlistEntry.objects.create(usb_device=rented_device, user=user)
+        return Fixtures(user, pc, free_device, rented_device, rental, reservation, waitlist_entry, today)
+
+    def measure(self, client, route, fixtures, requests, warmup):
+        url = reverse(route.name, args=route.args(fixtures))
+        data = route.data(fixtures)
+        send = getattr(client, route.method)
+        timings, query_counts = [], []
+
+        for i in range(warmup + requests):
+            # 書き込みを伴うURLも毎回同じ状態から計測できるよう、1リクエストごとに巻き戻す
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as ctx:
+                    started = time.perf_counter()
+                    response = send(url, data)
+                    if response.streaming:
+                        for _chunk in response.streaming_content:
+                            pass
+                    elapsed = time.perf_counter() - started
+                transaction.set_rollback(True)
+            if response.status_code not in route.expect:
+                raise CommandError(f"{route.name}: ステータス {response.status_code}（期待値: {route.expect}）")
+            if i >= warmup:
+                timings.append(elapsed * 1000)
+                query_counts.append(len(ctx.captured_queries))
+
+        return {
+            'p50_ms': round(percentile(timings, 50), 3),
+            'p95_ms': round(percentile(timings, 95), 3),
+            'p99_ms': round(percentile(timings, 99), 3),
+            'queries': max(query_counts),
+        }
+
+    def report(self, results):
+        self.stdout.write(f"{'URL名':<24} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'クエリ数':>8}")
+        for name, r in results.items():
+            self.stdout.write(f"{name:<24} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['queries']:>8}")
+
+    def compare(self, results, baseline, options):
+        regressions = []
+        for name, result in results.items():
+            base = baseline.get(name)
+            if not base:
+                continue
+            if result['queries'] > base['queries']:
+                regressions.append(f"{name}: クエリ数 {base['queries']} → {result['queries']}")
+            limit = base['p95_ms'] * (1 + options['tolerance'])
+            if result['p95_ms'] > limit and result['p95_ms'] - base['p95_ms'] > options['min_delta_ms']:
+                regressions.append(f"{name}: p95 {base['p95_ms']:.2f}ms → {result['p95_ms']:.2f}ms")
+        return regressions
@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from main_app.models import RentalRequest
+from main_app.overdue import overdue_queryset
+from main_app.synthetic import SyntheticData
+
+
+class Command(BaseCommand):
+    help = "大量のレンタルデータ上で、主要なRentalRequest検索がインデックスを使うかをEXPLAINで確認します（データはロールバックされます）"
+
+    # 検索名: (クエリを組み立てる関数, 使われるべきインデックス名の候補)
+    checks = {
+        # 画面の返却期限切れ警告が実行するクエリそのもの（結合と並び替えを含む）
+        'usb_list overdue': (
+            lambda user, device: overdue_queryset(user, timezone.now().date()),
+            {'rental_user_end_idx'},
+        ),
+        'return_usb lookup': (
+            lambda user, device: RentalRequest.objects.filter(usb_device=device, user=user, is_returned=False),
+            {'rental_active_device_user_idx', 'unique_active_rental_per_device'},
+        ),
+        'overdue reminder sweep': (
+            lambda user, device: RentalRequest.objects.filter(is_returned=False, end_date__lt=timezone.now().date()),
+            {'rental_active_end_idx'},
+        ),
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rentals', type=int, default=1_000_000, help="生成するレンタル件数")
+        parser.add_argument('--devices', type=int, default=10_000, help="生成するデバイス数")
+        parser.add_argument('--users', type=int, default=1_000, help="生成するユーザー数")
+        parser.add_argument('--manufacturers', type=int, default=50, help="生成するメーカー数")
+        parser.add_argument('--batch-size', type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        failures = []
+        with transaction.atomic():
+            user, device = self.seed(options)
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+            for label, (build, expected) in self.checks.items():
+                plan = build(user, device).explain()
+                used = sorted(name for name in expected if name in plan)
+                self.stdout.write(f"[{label}]\n{plan}\n")
+                if not used:
+                    failures.append(f"{label}: {', '.join(sorted(expected))} のいずれも使われていません")
+
+            # 生成したデータは残さない
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError("\n".join(failures))
+        self.stdout.write(self.style.SUCCESS("すべての検索がインデックスを使用しています。"))
+
+    def seed(self, options):
+        # seed_data コマンドと同じ合成データ（返却済みの履歴が大半で、デバイスの約1割に未返却レンタル）
+        started = time.monotonic()
+        SyntheticData('plan', batch_size=options['batch_size']).populate(
+            options['manufacturers'], options['users'], options['devices'], options['rentals'], reservations=0,
+        )
+        self.stdout.write(f"データ生成: {time.monotonic() - started:.1f}秒")
+        active = RentalRequest.objects.filter(is_returned=False).select_related('usb_device', 'user').first()
+        return active.user, active.usb_device
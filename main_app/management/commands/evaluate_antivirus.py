@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main_app.compliance import Policies
+from main_app.dashboard import invalidate_dashboard
+from main_app.models import UserPC
+
+
+class Command(BaseCommand):
+    help = (
+        "全てのPCのウイルス対策のバージョンを最低バージョン（AntivirusPolicy）と比べ、判定結果を保存します。"
+        "最低バージョンを変えたときや、定期的に実行してください"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="1回のUPDATEで更新するPCの件数")
+        parser.add_argument('--dry-run', action='store_true', help="保存せずに判定が変わる件数だけ表示する")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        # 基準は1回だけ読み、全てのPCを1回の走査でメモリ上で判定する
+        policies = Policies.load()
+        changed = {True: [], False: []}
+        total = compliant = 0
+        rows = UserPC.objects.order_by('id').values_list('id', 'user_id', 'antivirus_version', 'is_compliant')
+        for pc_id, user_id, version, current in rows.iterator(chunk_size=batch_size):
+            result = policies.is_compliant(version)
+            total += 1
+            compliant += result
+            if result != current:
+                changed[result].append((pc_id, user_id))
+
+        updated = len(changed[True]) + len(changed[False])
+        if options['dry_run']:
+            self.stdout.write(
+                f"{total}件中 {compliant}件が基準を満たします（判定が変わるPC: {updated}件。"
+                f"満たすようになる {len(changed[True])}件・満たさなくなる {len(changed[False])}件）"
+            )
+            return
+
+        for result, pcs in changed.items():
+            for start in range(0, len(pcs), batch_size):
+                batch = pcs[start:start + batch_size]
+                with transaction.atomic():
+                    # 判定の変わったPCだけを、結果ごとにまとめて1回のUPDATEで更新する（シグナルは送らない）
+                    UserPC.objects.filter(id__in=[pc_id for pc_id, _ in batch]).update(is_compliant=result)
+                    # ホームページに表示するPCの状態が変わる
+                    invalidate_dashboard(*{user_id for _, user_id in batch})
+
+        self.stdout.write(self.style.SUCCESS(
+            f"完了: {total}件中 {compliant}件が基準を満たします（{updated}件の判定を更新しました）"
+        ))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from main_app.inventory import FORMATS, export_devices, export_rentals
+
+
+class Command(BaseCommand):
+    help = "USBデバイスまたはレンタル履歴をCSV/JSON Linesで標準出力に書き出します（全件をメモリに載せずに逐次出力します）"
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=('devices', 'rentals'))
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+
+    def handle(self, *args, **options):
+        export = export_devices if options['target'] == 'devices' else export_rentals
+        for chunk in export(options['format']):
+            self.stdout.write(chunk, ending='')
@@ -0,0 +1,40 @@
+import io
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main_app.inventory import ENCODINGS, FORMATS, import_devices, read_rows
+
+
+class Command(BaseCommand):
+    help = "CSVまたはJSON LinesファイルからUSBデバイスを一括登録します（不正な行はスキップして報告します）"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="取り込むファイル（- で標準入力）")
+        parser.add_argument('--format', choices=FORMATS, help="ファイル形式（省略時は拡張子から判定）")
+        parser.add_argument(
+            '--encoding', choices=[code for code, _label in ENCODINGS],
+            help="ファイルの文字コード（省略時は UTF-8、標準入力はその文字コード。Excel で保存したCSVは cp932）",
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('jsonl' if Path(path).suffix in ('.jsonl', '.ndjson') else 'csv')
+
+        if path == '-':
+            stdin = sys.stdin
+            if options['encoding']:
+                stdin = io.TextIOWrapper(sys.stdin.buffer, encoding=options['encoding'], newline='')
+            result = import_devices(read_rows(stdin, fmt), options['batch_size'])
+        else:
+            try:
+                with open(path, newline='', encoding=options['encoding'] or 'utf-8-sig') as f:
+                    result = import_devices(read_rows(f, fmt), options['batch_size'])
+            except OSError as e:
+                raise CommandError(str(e))
+
+        for line_num, message in result.errors:
+            self.stderr.write(f"{line_num}行目: {message}")
+        self.stdout.write(f"登録: {result.created}件, エラー: {len(result.errors)}件")
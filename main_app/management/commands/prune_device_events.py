@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main_app.models import DeviceEvent
+
+
+class Command(BaseCommand):
+    help = (
+        "配信済みの古いデバイスのイベント（貸出・返却・延長・却下）を消します。"
+        "再接続したクライアントに送る分だけ残れば足りるため、定期的に実行してください"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-hours', type=int, default=settings.DEVICE_EVENTS_RETENTION_HOURS,
+            help="この時間より古いイベントを消す（既定値は DEVICE_EVENTS_RETENTION_HOURS）",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['older_than_hours'])
+        # 作成日時のインデックスで範囲を絞る。DeviceEvent には参照する行もシグナルの受信者も無いため、
+        # delete() は行を読み込まずに1回のDELETEで消す
+        deleted, _ = DeviceEvent.objects.filter(created_at__lt=cutoff).delete()
+        self.stdout.write(self.style.SUCCESS(f"{deleted}件のイベントを消しました（{cutoff} より前）"))
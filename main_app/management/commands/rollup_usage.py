@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from main_app.usage import refresh_rollups
+
+
+class Command(BaseCommand):
+    help = "前回の実行以降に変わった日だけ、デバイス・メーカー・容量帯ごとの日次利用状況の集計を作り直します"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="この日（YYYY-MM-DD）以降を全て作り直す")
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_date(options['since'])
+            if since is None:
+                raise CommandError("--since は YYYY-MM-DD 形式で指定してください。")
+        days = refresh_rollups(since=since)
+        self.stdout.write(self.style.SUCCESS(f"{days}日分の集計を作り直しました"))
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main_app.outbox import deliver_pending
+
+
+class Command(BaseCommand):
+    help = "送信待ちの通知メールを1つのSMTP接続でまとめて配送します（失敗したメールは指数バックオフで再送）"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="1回の接続で送信する最大件数")
+        parser.add_argument('--max-attempts', type=int, default=5, help="これ以上失敗したメールは再送しない")
+        parser.add_argument('--loop', action='store_true', help="終了せずに送信待ちを監視し続ける")
+        parser.add_argument('--interval', type=float, default=10.0, help="--loop 時に送信待ちが無いときの待機秒数")
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = deliver_pending(options['batch_size'], options['max_attempts'])
+            if sent or failed:
+                self.stdout.write(f"送信: {sent}件, 失敗: {failed}件")
+            if not options['loop']:
+                break
+            # バッチが満杯だった場合はすぐに次を処理する。1件も送れなかった場合（SMTPサーバーの停止など）は待つ
+            if sent + failed < options['batch_size'] or not sent:
+                time.sleep(options['interval'])
@@ -0,0 +1,81 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from main_app.models import RentalRequest
+from main_app.outbox import queue_mass_mail
+
+
+class Command(BaseCommand):
+    help = "返却期限切れの未返却レンタルを一括で洗い出し、借用者と承認者ごとに督促メールを1通ずつ送信待ちに登録します"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval-days', type=int, default=1, help="同じレンタルを再度督促するまでの日数")
+        parser.add_argument('--dry-run', action='store_true', help="送信待ちに登録せず、対象件数だけ表示する")
+        parser.add_argument('--chunk-size', type=int, default=500, help="督促日を更新する際の1回あたりの件数")
+
+    def handle(self, *args, **options):
+        today = timezone.now().date()
+        remind_before = today - timedelta(days=options['interval_days'])
+
+        with transaction.atomic():
+            # 未返却かつ期限切れで、まだ督促していない（または督促間隔を過ぎた）レンタルを1回のクエリで取得する
+            rentals = list(
+                RentalRequest.objects.filter(is_returned=False, end_date__lt=today)
+                .filter(Q(last_reminded_on__isnull=True) | Q(last_reminded_on__lte=remind_before))
+                .order_by('end_date', 'id')
+                .values(
+                    'id', 'end_date', 'usb_device__name',
+                    'user_id', 'user__username', 'user__email',
+                    'approver_id', 'approver__email',
+                )
+            )
+
+            borrowers = defaultdict(list)
+            approvers = defaultdict(list)
+            for rental in rentals:
+                borrowers[(rental['user_id'], rental['user__email'])].append(rental)
+                if rental['approver_id']:
+                    approvers[(rental['approver_id'], rental['approver__email'])].append(rental)
+
+            if options['dry_run']:
+                self.stdout.write(
+                    f"対象レンタル: {len(rentals)}件, 借用者: {len(borrowers)}人, 承認者: {len(approvers)}人"
+                )
+                transaction.set_rollback(True)
+                return
+
+            messages = [
+                (
+                    "USBデバイスの返却期限が過ぎています",
+                    "以下のUSBデバイスの返却期限が過ぎています。速やかに返却してください。\n\n"
+                    + "\n".join(f"・{r['usb_device__name']}（返却期日: {r['end_date']}）" for r in items),
+                    settings.DEFAULT_FROM_EMAIL, [email],
+                )
+                for (_user_id, email), items in borrowers.items()
+            ] + [
+                (
+                    "承認したUSBレンタルの返却期限が過ぎています",
+                    "あなたが承認した以下のレンタルが返却期限を過ぎています。\n\n"
+                    + "\n".join(
+                        f"・{r['user__username']}さん: {r['usb_device__name']}（返却期日: {r['end_date']}）" for r in items
+                    ),
+                    settings.DEFAULT_FROM_EMAIL, [email],
+                )
+                for (_approver_id, email), items in approvers.items()
+            ]
+            queued = len(queue_mass_mail(messages))
+
+            # 督促済みとして記録し、再実行時に同じレンタルを対象にしないようにする
+            ids = [rental['id'] for rental in rentals]
+            for start in range(0, len(ids), options['chunk_size']):
+                RentalRequest.objects.filter(id__in=ids[start:start + options['chunk_size']]).update(last_reminded_on=today)
+
+        self.stdout.write(
+            f"対象レンタル: {len(rentals)}件, 借用者: {len(borrowers)}人, 承認者: {len(approvers)}人, 登録したメール: {queued}通"
+        )
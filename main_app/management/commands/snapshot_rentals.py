@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main_app import rental_log
+
+
+class Command(BaseCommand):
+    help = (
+        "レンタルの操作の記録（RentalEvent）を前回のスナップショットから再生し、現在の貸出状況のスナップショットを保存します。"
+        "組み立て直すときに再生する記録が増えすぎないよう、定期的に実行してください"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep', type=int, default=settings.RENTAL_SNAPSHOTS_KEEP,
+            help="新しい方から残すスナップショットの件数（既定値は RENTAL_SNAPSHOTS_KEEP）",
+        )
+        parser.add_argument(
+            '--verify', action='store_true',
+            help="保存せずに、記録から組み立て直した貸出可否と現在のデバイスの貸出可否を比べて食い違いを表示する",
+        )
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            devices, last_id = rental_log.rebuild()
+            mismatches = rental_log.mismatches(devices)
+            for device_id, recorded, current in mismatches:
+                self.stdout.write(
+                    f"デバイス {device_id}: 記録では{'貸出可能' if recorded else '貸出中'}、"
+                    f"現在は{'貸出可能' if current else '貸出中'}"
+                )
+            style = self.style.WARNING if mismatches else self.style.SUCCESS
+            self.stdout.write(style(f"記録 {last_id} までを反映: 食い違い {len(mismatches)}件"))
+            return
+
+        snapshot = rental_log.take_snapshot()
+        if snapshot is None:
+            self.stdout.write("前回のスナップショットから記録が増えていないため、作りませんでした")
+        else:
+            self.stdout.write(f"記録 {snapshot.last_event_id} までのスナップショットを保存しました（デバイス {len(snapshot.devices)}台）")
+        pruned = rental_log.prune_snapshots(max(options['keep'], 1))
+        self.stdout.write(self.style.SUCCESS(f"完了: 古いスナップショットを{pruned}件消しました"))
@@ -0,0 +1,47 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from main_app.routers import REPLICA
+
+
+class Command(BaseCommand):
+    help = (
+        "書き込み側のSQLiteファイルを読み取り用の複製（DATABASE_REPLICA_PATH）へ丸ごと写します。"
+        "SQLiteのオンラインバックアップを使うため、サーバーを止めずに実行できます。"
+        "--interval を指定すると、その秒数ごとに繰り返します"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=1024, help="1回にコピーするページ数（間に他の接続の処理を挟む）")
+        parser.add_argument('--interval', type=float, default=0, help="繰り返す間隔（秒）。0なら1回だけ実行する")
+
+    def handle(self, *args, **options):
+        if REPLICA not in settings.DATABASES:
+            raise CommandError("複製が設定されていません。環境変数 DATABASE_REPLICA_PATH を指定してください")
+        source = connections[DEFAULT_DB_ALIAS]
+        if source.vendor != 'sqlite':
+            raise CommandError("sync_replica はSQLiteのみ対応しています。他のデータベースは標準のレプリケーションを使ってください")
+
+        while True:
+            started = time.perf_counter()
+            self.copy(source, settings.DATABASES[REPLICA]['NAME'], options['pages'])
+            self.stdout.write(f"複製を更新しました（{(time.perf_counter() - started) * 1000:.0f}ms）")
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
+
+    @staticmethod
+    def copy(source, target_path, pages):
+        # 書き込み中の接続からはバックアップできないため、書き込み側のファイルを別の接続で開く
+        timeout = settings.SQLITE_BUSY_TIMEOUT_MS / 1000
+        primary = sqlite3.connect(source.settings_dict['NAME'], timeout=timeout)
+        target = sqlite3.connect(target_path, timeout=timeout)
+        try:
+            primary.backup(target, pages=pages)
+        finally:
+            target.close()
+            primary.close()
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:35
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0007_rentalrequest_is_returned'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='manufacturerwhitelist',
+            index=models.Index(fields=['added_at', 'id'], name='whitelist_added_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rentalrequest',
+            index=models.Index(fields=['usb_device', 'start_date', 'id'], name='rental_device_history_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:36
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def close_duplicate_active_rentals(apps, schema_editor):
+    # 制約追加前に、同じデバイスに残っている古い未返却レンタルを返却済みにする（最新の1件のみ残す）
+    RentalRequest = apps.get_model('main_app', 'RentalRequest')
+    latest_ids = (
+        RentalRequest.objects.filter(is_returned=False)
+        .values('usb_device')
+        .annotate(latest_id=Max('id'))
+        .values_list('latest_id', flat=True)
+    )
+    RentalRequest.objects.filter(is_returned=False).exclude(id__in=list(latest_ids)).update(is_returned=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0008_keyset_pagination_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(close_duplicate_active_rentals, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='rentalrequest',
+            index=models.Index(condition=models.Q(('is_returned', False)), fields=['usb_device', 'user'], name='rental_active_device_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rentalrequest',
+            index=models.Index(fields=['user', 'end_date'], name='rental_user_end_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='rentalrequest',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_returned', False)), fields=('usb_device',), name='unique_active_rental_per_device'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:58
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0009_active_rental_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255, verbose_name='件名')),
+                ('body', models.TextField(verbose_name='本文')),
+                ('from_email', models.CharField(blank=True, max_length=254, verbose_name='送信元')),
+                ('recipient', models.EmailField(max_length=254, verbose_name='宛先')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='登録日時')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='次回送信日時')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='送信試行回数')),
+                ('last_error', models.TextField(blank=True, verbose_name='直近のエラー')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='送信日時')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('sent_at__isnull', True)), fields=['next_attempt_at', 'id'], name='outbox_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:59
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0010_outboxemail'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rentalrequest',
+            name='last_reminded_on',
+            field=models.DateField(blank=True, null=True, verbose_name='最終督促日'),
+        ),
+        migrations.AddIndex(
+            model_name='rentalrequest',
+            index=models.Index(condition=models.Q(('is_returned', False)), fields=['end_date'], name='rental_active_end_idx'),
+        ),
+    ]
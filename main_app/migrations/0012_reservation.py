@@ -0,0 +1,31 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0011_overdue_reminders'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateField(verbose_name='利用開始日')),
+                ('end_date', models.DateField(verbose_name='返却予定日')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='予約日時')),
+                ('usb_device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main_app.usbdevice', verbose_name='USBデバイス')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='予約者')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['usb_device', 'start_date', 'end_date'], name='reservation_device_period_idx'), models.Index(fields=['user', 'start_date'], name='reservation_user_start_idx')],
+                'constraints': [models.CheckConstraint(condition=models.Q(('start_date__lte', models.F('end_date'))), name='reservation_period_valid')],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:04
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def remove_duplicate_entries(apps, schema_editor):
+    # 同じメーカーの重複登録は最初の1件だけ残す
+    ManufacturerWhitelist = apps.get_model('main_app', 'ManufacturerWhitelist')
+    first_ids = (
+        ManufacturerWhitelist.objects.values('manufacturer')
+        .annotate(first_id=Min('id'))
+        .values_list('first_id', flat=True)
+    )
+    ManufacturerWhitelist.objects.exclude(id__in=list(first_ids)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0012_reservation'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_entries, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='manufacturerwhitelist',
+            constraint=models.UniqueConstraint(fields=('manufacturer',), name='unique_whitelisted_manufacturer'),
+        ),
+    ]
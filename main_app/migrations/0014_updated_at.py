@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0013_unique_whitelisted_manufacturer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rentalrequest',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='更新日時'),
+        ),
+        migrations.AddField(
+            model_name='usbdevice',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='更新日時'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0014_updated_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedRentalRequest',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('requested_at', models.DateTimeField()),
+                ('approved', models.BooleanField(default=False)),
+                ('start_date', models.DateField(null=True, verbose_name='レンタル開始日')),
+                ('end_date', models.DateField(null=True, verbose_name='返却日')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, verbose_name='アーカイブ日時')),
+                ('approver', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='承認者')),
+                ('pc', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main_app.userpc', verbose_name='利用PC')),
+                ('usb_device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_rentals', to='main_app.usbdevice')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['usb_device', 'start_date', 'id'], name='archived_device_history_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0015_archivedrentalrequest'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceUsageDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='日付')),
+                ('capacity_band', models.CharField(max_length=10, verbose_name='容量帯')),
+                ('overdue', models.BooleanField(default=False, verbose_name='返却期限切れ')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UsageRollupState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('days_through', models.DateField(null=True, verbose_name='集計済みの最終日')),
+                ('changed_through', models.DateTimeField(null=True, verbose_name='反映済みのレンタル更新日時')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UsageSummaryDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='日付')),
+                ('capacity_band', models.CharField(max_length=10, verbose_name='容量帯')),
+                ('rented_days', models.PositiveIntegerField(default=0, verbose_name='貸出日数')),
+                ('overdue_days', models.PositiveIntegerField(default=0, verbose_name='期限切れ日数')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='archivedrentalrequest',
+            name='returned_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='返却日時'),
+        ),
+        migrations.AddField(
+            model_name='rentalrequest',
+            name='returned_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='返却日時'),
+        ),
+        migrations.AddIndex(
+            model_name='rentalrequest',
+            index=models.Index(fields=['updated_at'], name='rental_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rentalrequest',
+            index=models.Index(fields=['returned_at'], name='rental_returned_idx'),
+        ),
+        migrations.AddField(
+            model_name='deviceusageday',
+            name='manufacturer',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main_app.manufacturer'),
+        ),
+        migrations.AddField(
+            model_name='deviceusageday',
+            name='usb_device',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main_app.usbdevice'),
+        ),
+        migrations.AddField(
+            model_name='usagesummaryday',
+            name='manufacturer',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main_app.manufacturer'),
+        ),
+        migrations.AddConstraint(
+            model_name='deviceusageday',
+            constraint=models.UniqueConstraint(fields=('day', 'usb_device'), name='unique_device_usage_day'),
+        ),
+        migrations.AddIndex(
+            model_name='usagesummaryday',
+            index=models.Index(fields=['day'], name='usage_summary_day_idx'),
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:02
+
+from django.db import migrations
+
+# デバイス名・説明・メーカー名の全文検索索引（SQLiteのFTS5）。rowid はデバイスの id と同じにする。
+# trigram は単語の区切りが無い日本語でも3文字以上の部分一致で検索できる
+CREATE_STATEMENTS = [
+    """
+    CREATE VIRTUAL TABLE main_app_usbdevice_fts USING fts5(
+        name, description, manufacturer, tokenize = 'trigram'
+    )
+    """,
+    # 一括登録（bulk_create）や他のプロセスからの変更も漏れないよう、索引の更新はトリガーで行う
+    """
+    CREATE TRIGGER main_app_usbdevice_fts_insert AFTER INSERT ON main_app_usbdevice BEGIN
+        INSERT INTO main_app_usbdevice_fts (rowid, name, description, manufacturer)
+        VALUES (new.id, new.name, new.description,
+                (SELECT name FROM main_app_manufacturer WHERE id = new.manufacturer_id));
+    END
+    """,
+    # 更新日時だけの更新（レンタルのたびに起きる）では索引を書き換えない
+    """
+    CREATE TRIGGER main_app_usbdevice_fts_update
+    AFTER UPDATE OF name, description, manufacturer_id ON main_app_usbdevice BEGIN
+        DELETE FROM main_app_usbdevice_fts WHERE rowid = old.id;
+        INSERT INTO main_app_usbdevice_fts (rowid, name, description, manufacturer)
+        VALUES (new.id, new.name, new.description,
+                (SELECT name FROM main_app_manufacturer WHERE id = new.manufacturer_id));
+    END
+    """,
+    """
+    CREATE TRIGGER main_app_usbdevice_fts_delete AFTER DELETE ON main_app_usbdevice BEGIN
+        DELETE FROM main_app_usbdevice_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER main_app_manufacturer_fts_update AFTER UPDATE OF name ON main_app_manufacturer BEGIN
+        UPDATE main_app_usbdevice_fts SET manufacturer = new.name
+        WHERE rowid IN (SELECT id FROM main_app_usbdevice WHERE manufacturer_id = new.id);
+    END
+    """,
+    """
+    INSERT INTO main_app_usbdevice_fts (rowid, name, description, manufacturer)
+    SELECT d.id, d.name, d.description, m.name
+    FROM main_app_usbdevice d LEFT JOIN main_app_manufacturer m ON m.id = d.manufacturer_id
+    """,
+]
+
+DROP_STATEMENTS = [
+    "DROP TRIGGER IF EXISTS main_app_manufacturer_fts_update",
+    "DROP TRIGGER IF EXISTS main_app_usbdevice_fts_delete",
+    "DROP TRIGGER IF EXISTS main_app_usbdevice_fts_update",
+    "DROP TRIGGER IF EXISTS main_app_usbdevice_fts_insert",
+    "DROP TABLE IF EXISTS main_app_usbdevice_fts",
+]
+
+
+def create_search_index(apps, schema_editor):
+    # FTS5はSQLite専用。他のデータベースでは索引を作らず、検索は部分一致で行う（main_app.search）
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in CREATE_STATEMENTS:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_STATEMENTS:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0016_usage_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
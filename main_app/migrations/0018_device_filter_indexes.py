@@ -0,0 +1,25 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0017_device_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usbdevice',
+            index=models.Index(fields=['capacity'], name='device_capacity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usbdevice',
+            index=models.Index(fields=['purchase_date'], name='device_purchase_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usbdevice',
+            index=models.Index(fields=['is_available'], name='device_available_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0018_device_filter_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('rented', '貸出'), ('returned', '返却'), ('extended', '延長')], max_length=10, verbose_name='種類')),
+                ('is_available', models.BooleanField(verbose_name='変更後に貸出可能か')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='発生日時')),
+                ('usb_device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main_app.usbdevice')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='device_event_created_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='WaitlistEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('auto_reserve', models.BooleanField(default=False, verbose_name='空いたら自動でレンタルを申請する')),
+                ('rental_days', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='利用日数')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='登録日時')),
+                ('approver', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='承認者')),
+                ('pc', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main_app.userpc', verbose_name='利用PC')),
+                ('usb_device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main_app.usbdevice', verbose_name='USBデバイス')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='登録者')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['usb_device', 'id'], name='waitlist_device_order_idx')],
+                'constraints': [models.UniqueConstraint(fields=('usb_device', 'user'), name='unique_waitlist_entry')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0019_device_events_and_waitlist'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rentalrequest',
+            name='decided_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='承認・却下日時'),
+        ),
+        migrations.AlterField(
+            model_name='deviceevent',
+            name='kind',
+            field=models.CharField(choices=[('rented', '貸出'), ('returned', '返却'), ('extended', '延長'), ('rejected', '却下')], max_length=10, verbose_name='種類'),
+        ),
+        migrations.AddIndex(
+            model_name='rentalrequest',
+            index=models.Index(condition=models.Q(('approved', False), ('decided_at__isnull', True), ('is_returned', False)), fields=['approver', 'requested_at', 'id'], name='rental_pending_approval_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_existing_pcs_compliant(apps, schema_editor):
+    # 最低バージョンはまだ登録されていないため、既存のPCは全て基準を満たすものとして扱う
+    UserPC = apps.get_model('main_app', 'UserPC')
+    UserPC.objects.update(is_compliant=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0020_rental_approval'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AntivirusPolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product', models.CharField(blank=True, max_length=100, unique=True, verbose_name='製品名')),
+                ('min_version', models.CharField(max_length=50, verbose_name='最低バージョン')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='userpc',
+            name='is_compliant',
+            field=models.BooleanField(default=False, verbose_name='ウイルス対策の基準を満たす'),
+        ),
+        migrations.RunPython(mark_existing_pcs_compliant, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='userpc',
+            index=models.Index(fields=['user', 'is_compliant'], name='userpc_user_compliant_idx'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:13
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def create_baseline_snapshot(apps, schema_editor):
+    # 記録を始める前の貸出状況を起点のスナップショット（last_event_id=0）にし、以降の記録の再生をここから始める
+    RentalRequest = apps.get_model('main_app', 'RentalRequest')
+    ArchivedRentalRequest = apps.get_model('main_app', 'ArchivedRentalRequest')
+    RentalSnapshot = apps.get_model('main_app', 'RentalSnapshot')
+
+    devices = {}
+
+    def device(device_id):
+        return devices.setdefault(str(device_id), {
+            'available': True, 'rental': None, 'user': None, 'end_date': None, 'approved': False,
+            'rentals': 0, 'last_returned_at': None,
+        })
+
+    for model in (RentalRequest, ArchivedRentalRequest):
+        totals = model.objects.values('usb_device_id').annotate(rentals=Count('id'), last_returned_at=Max('returned_at'))
+        for row in totals.order_by():
+            state = device(row['usb_device_id'])
+            state['rentals'] += row['rentals']
+            if row['last_returned_at']:
+                returned = row['last_returned_at'].isoformat()
+                state['last_returned_at'] = max(state['last_returned_at'] or returned, returned)
+    for rental in RentalRequest.objects.filter(is_returned=False).values(
+        'id', 'usb_device_id', 'user_id', 'end_date', 'approved',
+    ):
+        device(rental['usb_device_id']).update(
+            available=False, rental=rental['id'], user=rental['user_id'], approved=rental['approved'],
+            end_date=rental['end_date'] and rental['end_date'].isoformat(),
+        )
+    RentalSnapshot.objects.create(last_event_id=0, devices=devices)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0021_antivirus_compliance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RentalSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_event_id', models.BigIntegerField(unique=True, verbose_name='反映済みの最後の記録のID')),
+                ('devices', models.JSONField(verbose_name='デバイスごとの状態')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RentalEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, '貸出'), (2, '返却'), (3, '延長'), (4, '承認'), (5, '却下')], verbose_name='種類')),
+                ('rental_id', models.BigIntegerField(verbose_name='レンタルID')),
+                ('device_id', models.BigIntegerField(verbose_name='USBデバイスID')),
+                ('user_id', models.BigIntegerField(verbose_name='借りた人のユーザーID')),
+                ('actor_id', models.BigIntegerField(null=True, verbose_name='操作したユーザーID')),
+                ('end_date', models.DateField(null=True, verbose_name='返却期日')),
+                ('comment', models.TextField(blank=True, verbose_name='コメント')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='発生日時')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['device_id', 'id'], name='rental_event_device_idx'), models.Index(fields=['rental_id'], name='rental_event_rental_idx')],
+            },
+        ),
+        migrations.RunPython(create_baseline_snapshot, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Q
+from django.db.models.functions import TruncMonth
+
+
+def fill_months(apps, schema_editor):
+    # 集計済みの日次集計から月次集計を作る（以降は rollup_usage コマンドが日次集計と一緒に作り直す）
+    DeviceUsageDay = apps.get_model('main_app', 'DeviceUsageDay')
+    DeviceUsageMonth = apps.get_model('main_app', 'DeviceUsageMonth')
+    rows = (
+        DeviceUsageDay.objects.annotate(month=TruncMonth('day'))
+        .values('month', 'usb_device_id')
+        .annotate(rented_days=Count('id'), overdue_days=Count('id', filter=Q(overdue=True)))
+        .order_by()
+    )
+    DeviceUsageMonth.objects.bulk_create([DeviceUsageMonth(**row) for row in rows.iterator(chunk_size=2000)], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0022_rental_event_log'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceUsageMonth',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(verbose_name='月')),
+                ('rented_days', models.PositiveIntegerField(default=0, verbose_name='貸出日数')),
+                ('overdue_days', models.PositiveIntegerField(default=0, verbose_name='期限切れ日数')),
+                ('usb_device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main_app.usbdevice')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('month', 'usb_device'), name='unique_device_usage_month')],
+            },
+        ),
+        migrations.RunPython(fill_months, migrations.RunPython.noop),
+    ]
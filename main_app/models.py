@@ -3,6 +3,7 @@ from django.db import models
 # Create your models here.
 # rentals/models.py
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import User
 from django.utils import timezone
 
@@ -16,6 +17,15 @@ class ManufacturerWhitelist(models.Model):
     manufacturer = models.ForeignKey(Manufacturer, on_delete=models.CASCADE, verbose_name="メーカー")
     added_at = models.DateTimeField(auto_now_add=True, verbose_name="登録日時")
 
+    class Meta:
+        indexes = [
+            # 一覧のキーセットページネーション用（新しい順）
+            models.Index(fields=['added_at', 'id'], name='whitelist_added_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['manufacturer'], name='unique_whitelisted_manufacturer'),
+        ]
+
     def __str__(self):
         return f"ホワイトリスト: {self.manufacturer.name}"
     
@@ -27,6 +37,16 @@ class USBDevice(models.Model):
     manufacturer = models.ForeignKey(Manufacturer, on_delete=models.CASCADE, null=True, verbose_name="メーカー")
     purchase_date = models.DateField(verbose_name="購入日", null=True, blank=True)
     capacity = models.BigIntegerField(verbose_name="容量（バイト数）", null=True, blank=True)
+    # デバイスまたはそのレンタルが最後に変更された日時（ETag / Last-Modified とキャッシュキーに使う）
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新日時")
+
+    class Meta:
+        indexes = [
+            # 一覧の絞り込み（容量・購入日の範囲、貸出状況）に使う
+            models.Index(fields=['capacity'], name='device_capacity_idx'),
+            models.Index(fields=['purchase_date'], name='device_purchase_date_idx'),
+            models.Index(fields=['is_available'], name='device_available_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -38,10 +58,38 @@ class UserPC(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     serial_number = models.CharField(max_length=100, unique=True, verbose_name="PCの製品番号")
     antivirus_version = models.CharField(max_length=50, verbose_name="ウイルス対策のバージョン")
+    # ウイルス対策のバージョンが AntivirusPolicy の基準を満たすか。保存時と evaluate_antivirus コマンドで更新する
+    is_compliant = models.BooleanField(default=False, verbose_name="ウイルス対策の基準を満たす")
+
+    class Meta:
+        indexes = [
+            # レンタル申請で選べるPC（ログインユーザーの基準を満たすPC）の検索用
+            models.Index(fields=['user', 'is_compliant'], name='userpc_user_compliant_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.serial_number}"
 
+
+class AntivirusPolicy(models.Model):
+    """
+    ウイルス対策ソフトの最低バージョン。製品名は大文字・小文字を区別しない。
+    製品名が空の行は、製品名の一致する行が無いPCに適用する（空の行も無ければ、その製品は確認しない）
+    """
+    product = models.CharField(max_length=100, blank=True, unique=True, verbose_name="製品名")
+    min_version = models.CharField(max_length=50, verbose_name="最低バージョン")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新日時")
+
+    def __str__(self):
+        return f"{self.product or '（全製品）'} {self.min_version} 以上"
+
+
+class RentalRequestQuerySet(models.QuerySet):
+    def pending_for(self, approver):
+        """承認者に割り当てられた、まだ承認も却下もしていない未返却の申請"""
+        return self.filter(approver=approver, approved=False, decided_at__isnull=True, is_returned=False)
+
+
 class RentalRequest(models.Model):
     usb_device = models.ForeignKey(USBDevice, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -56,6 +104,41 @@ class RentalRequest(models.Model):
     pc = models.ForeignKey(UserPC, on_delete=models.SET_NULL, null=True, verbose_name="利用PC")
 
     is_returned = models.BooleanField(default=False, verbose_name="返却済み")
+    # 実際に返却された日時（利用状況の集計で、期限切れだった日数を求めるのに使う）
+    returned_at = models.DateTimeField(null=True, blank=True, verbose_name="返却日時")
+    # 返却期限切れの督促メールを最後に送った日（send_overdue_reminders コマンドが更新する）
+    last_reminded_on = models.DateField(null=True, blank=True, verbose_name="最終督促日")
+    # 承認者が承認または却下した日時（却下した申請は approved が偽のまま返却済みになる）
+    decided_at = models.DateTimeField(null=True, blank=True, verbose_name="承認・却下日時")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新日時")
+
+    objects = RentalRequestQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # 承認者ごとの未判断の申請を申請順に辿るためのインデックス（判断済みの行は含めない）
+            models.Index(
+                fields=['approver', 'requested_at', 'id'],
+                condition=Q(approved=False, decided_at__isnull=True, is_returned=False),
+                name='rental_pending_approval_idx',
+            ),
+            # デバイス詳細のレンタル履歴をキーセット方式で辿るためのインデックス
+            models.Index(fields=['usb_device', 'start_date', 'id'], name='rental_device_history_idx'),
+            # 返却申請時の「このユーザーが借りている未返却レンタル」検索用
+            models.Index(fields=['usb_device', 'user'], condition=Q(is_returned=False), name='rental_active_device_user_idx'),
+            # ユーザーごとの返却期限切れ検索用
+            models.Index(fields=['user', 'end_date'], name='rental_user_end_idx'),
+            # 全ユーザーの返却期限切れを一括で洗い出すためのインデックス
+            models.Index(fields=['end_date'], condition=Q(is_returned=False), name='rental_active_end_idx'),
+            # 利用状況の集計で、前回以降に変更されたレンタルと期間内に返却されたレンタルを探すためのインデックス
+            models.Index(fields=['updated_at'], name='rental_updated_idx'),
+            models.Index(fields=['returned_at'], name='rental_returned_idx'),
+        ]
+        constraints = [
+            # 1台のデバイスに未返却のレンタルは高々1件（デバイスごとの未返却検索のインデックスも兼ねる）
+            models.UniqueConstraint(fields=['usb_device'], condition=Q(is_returned=False), name='unique_active_rental_per_device'),
+        ]
+
     @property
     def is_overdue(self):
         """返却期日が過ぎているかどうかを確認する"""
@@ -63,4 +146,241 @@ class RentalRequest(models.Model):
     
     def __str__(self):
         return f"{self.user.username} - {self.usb_device.name} - {'返却済み' if self.is_returned else '未返却'}"
-    
+
+
+class ArchivedRentalRequest(models.Model):
+    """
+    返却から一定期間が過ぎたレンタルの保管先（archive_rentals コマンドが移動する）。
+    元のIDをそのまま主キーにし、履歴の表示に要らない列は持たない。
+    """
+    id = models.BigIntegerField(primary_key=True)
+    usb_device = models.ForeignKey(USBDevice, on_delete=models.CASCADE, related_name='archived_rentals')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    requested_at = models.DateTimeField()
+    approved = models.BooleanField(default=False)
+    start_date = models.DateField(verbose_name="レンタル開始日", null=True)
+    end_date = models.DateField(verbose_name="返却日", null=True)
+    approver = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='+', verbose_name="承認者")
+    pc = models.ForeignKey(UserPC, on_delete=models.SET_NULL, null=True, related_name='+', verbose_name="利用PC")
+    returned_at = models.DateTimeField(null=True, blank=True, verbose_name="返却日時")
+    archived_at = models.DateTimeField(auto_now_add=True, verbose_name="アーカイブ日時")
+
+    # アーカイブされるのは返却済みのレンタルだけ
+    is_returned = True
+
+    class Meta:
+        indexes = [
+            # 現行テーブルと同じ並びでレンタル履歴を辿るためのインデックス
+            models.Index(fields=['usb_device', 'start_date', 'id'], name='archived_device_history_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.usb_device.name} - 返却済み"
+
+
+class ReservationQuerySet(models.QuerySet):
+    def overlapping(self, start_date, end_date):
+        """期間 [start_date, end_date] と1日でも重なる予約"""
+        return self.filter(start_date__lte=end_date, end_date__gte=start_date)
+
+
+class Reservation(models.Model):
+    """将来の期間を指定したUSBデバイスの予約。期間が重なる予約は同じデバイスに登録できない"""
+    usb_device = models.ForeignKey(USBDevice, on_delete=models.CASCADE, verbose_name="USBデバイス")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="予約者")
+    start_date = models.DateField(verbose_name="利用開始日")
+    end_date = models.DateField(verbose_name="返却予定日")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="予約日時")
+
+    objects = ReservationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # デバイスごとの期間重複検索用（開始日で範囲を絞り、終了日はインデックス上で判定する）
+            models.Index(fields=['usb_device', 'start_date', 'end_date'], name='reservation_device_period_idx'),
+            models.Index(fields=['user', 'start_date'], name='reservation_user_start_idx'),
+        ]
+        constraints = [
+            models.CheckConstraint(condition=Q(start_date__lte=models.F('end_date')), name='reservation_period_valid'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.usb_device.name} - {self.start_date}〜{self.end_date}"
+
+
+class DeviceEvent(models.Model):
+    """
+    デバイスの貸出状況の変化（貸出・返却・延長・申請の却下）。変更と同じトランザクションで追記し、
+    イベントストリーム（main_app.device_events）が id の順に配信する。古い行は prune_device_events コマンドで消す
+    """
+    RENTED = 'rented'
+    RETURNED = 'returned'
+    EXTENDED = 'extended'
+    REJECTED = 'rejected'
+    KIND_CHOICES = [(RENTED, "貸出"), (RETURNED, "返却"), (EXTENDED, "延長"), (REJECTED, "却下")]
+
+    usb_device = models.ForeignKey(USBDevice, on_delete=models.CASCADE, related_name='+')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, verbose_name="種類")
+    is_available = models.BooleanField(verbose_name="変更後に貸出可能か")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="発生日時")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='device_event_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.usb_device_id} - {self.get_kind_display()} - {self.created_at}"
+
+
+class RentalEvent(models.Model):
+    """
+    レンタルの操作（貸出・返却・延長・承認・却下）の追記専用の記録。操作と同じトランザクションで追記し、更新も削除もしない。
+    レンタルのアーカイブやデバイス・ユーザーの削除後も残るよう、IDは外部キーにせず整数で持つ。
+    最新の RentalSnapshot 以降の行を id の順に再生すると、デバイスの貸出状況を組み立て直せる（main_app.rental_log）
+    """
+    RENTED = 1
+    RETURNED = 2
+    EXTENDED = 3
+    APPROVED = 4
+    REJECTED = 5
+    KIND_CHOICES = [(RENTED, "貸出"), (RETURNED, "返却"), (EXTENDED, "延長"), (APPROVED, "承認"), (REJECTED, "却下")]
+
+    kind = models.PositiveSmallIntegerField(choices=KIND_CHOICES, verbose_name="種類")
+    rental_id = models.BigIntegerField(verbose_name="レンタルID")
+    device_id = models.BigIntegerField(verbose_name="USBデバイスID")
+    user_id = models.BigIntegerField(verbose_name="借りた人のユーザーID")
+    # 操作した人（承認・却下は承認者、それ以外は借りた人）
+    actor_id = models.BigIntegerField(null=True, verbose_name="操作したユーザーID")
+    # 貸出・延長の後の返却期日
+    end_date = models.DateField(null=True, verbose_name="返却期日")
+    # 返却時のコメント、承認・却下時の承認者のコメント
+    comment = models.TextField(blank=True, verbose_name="コメント")
+    created_at = models.DateTimeField(default=timezone.now, verbose_name="発生日時")
+
+    class Meta:
+        indexes = [
+            # デバイスごとの操作の履歴を順に辿るためのインデックス
+            models.Index(fields=['device_id', 'id'], name='rental_event_device_idx'),
+            models.Index(fields=['rental_id'], name='rental_event_rental_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.rental_id} - {self.get_kind_display()} - {self.created_at}"
+
+
+class RentalSnapshot(models.Model):
+    """
+    last_event_id までの RentalEvent を再生した結果（デバイスごとの貸出状況と貸出回数）。
+    snapshot_rentals コマンドが定期的に作り、組み立て直しはここから続きの記録だけを再生する
+    """
+    last_event_id = models.BigIntegerField(unique=True, verbose_name="反映済みの最後の記録のID")
+    # {"デバイスID": {"available": ..., "rental": ..., "user": ..., "end_date": ..., "approved": ..., "rentals": ..., "last_returned_at": ...}}
+    devices = models.JSONField(verbose_name="デバイスごとの状態")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="作成日時")
+
+    def __str__(self):
+        return f"記録 {self.last_event_id} までのスナップショット - {self.created_at}"
+
+
+class WaitlistEntry(models.Model):
+    """
+    貸出中のデバイスの空き待ち。返却されると登録の古い順に1人だけ、通知するか（auto_reserve が偽）
+    登録済みの承認者・PC・日数で代わりにレンタルを申請する
+    """
+    usb_device = models.ForeignKey(USBDevice, on_delete=models.CASCADE, verbose_name="USBデバイス")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="登録者")
+    auto_reserve = models.BooleanField(default=False, verbose_name="空いたら自動でレンタルを申請する")
+    rental_days = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name="利用日数")
+    approver = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', verbose_name="承認者",
+    )
+    pc = models.ForeignKey(UserPC, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', verbose_name="利用PC")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="登録日時")
+
+    class Meta:
+        indexes = [
+            # 返却時にデバイスごとの先頭（id の最も小さい登録）を取り出し、待ち順を数えるためのインデックス
+            models.Index(fields=['usb_device', 'id'], name='waitlist_device_order_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['usb_device', 'user'], name='unique_waitlist_entry'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.usb_device.name} - 空き待ち"
+
+
+class OutboxEmail(models.Model):
+    """送信待ちの通知メール。業務データと同じトランザクションで書き込み、send_outbox コマンドで配送する"""
+    subject = models.CharField(max_length=255, verbose_name="件名")
+    body = models.TextField(verbose_name="本文")
+    from_email = models.CharField(max_length=254, blank=True, verbose_name="送信元")
+    recipient = models.EmailField(verbose_name="宛先")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="登録日時")
+    next_attempt_at = models.DateTimeField(default=timezone.now, verbose_name="次回送信日時")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="送信試行回数")
+    last_error = models.TextField(blank=True, verbose_name="直近のエラー")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="送信日時")
+
+    class Meta:
+        indexes = [
+            # 未送信メールを送信予定順に取り出すためのインデックス
+            models.Index(fields=['next_attempt_at', 'id'], condition=Q(sent_at__isnull=True), name='outbox_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.recipient} - {self.subject} - {'送信済み' if self.sent_at else '未送信'}"
+
+
+class DeviceUsageDay(models.Model):
+    """
+    デバイスが貸し出されていた日ごとの1行（rollup_usage コマンドが変更のあった日だけ作り直す）。
+    メーカーと容量帯は集計時点の値を持ち、レポートでデバイス表を結合せずに集計できるようにする。
+    """
+    day = models.DateField(verbose_name="日付")
+    usb_device = models.ForeignKey(USBDevice, on_delete=models.CASCADE, related_name='+')
+    manufacturer = models.ForeignKey(Manufacturer, on_delete=models.SET_NULL, null=True, related_name='+')
+    capacity_band = models.CharField(max_length=10, verbose_name="容量帯")
+    overdue = models.BooleanField(default=False, verbose_name="返却期限切れ")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'usb_device'], name='unique_device_usage_day'),
+        ]
+
+
+class DeviceUsageMonth(models.Model):
+    """
+    デバイスごとの月次集計（その月の DeviceUsageDay の合計）。日次集計を作り直すときに、掛かる月も作り直す。
+    長い期間のデバイス別レポートは、丸ごと含まれる月をここから読み、月の途中の端だけ日次集計を読む
+    """
+    month = models.DateField(verbose_name="月")  # 月の1日
+    usb_device = models.ForeignKey(USBDevice, on_delete=models.CASCADE, related_name='+')
+    rented_days = models.PositiveIntegerField(default=0, verbose_name="貸出日数")
+    overdue_days = models.PositiveIntegerField(default=0, verbose_name="期限切れ日数")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['month', 'usb_device'], name='unique_device_usage_month'),
+        ]
+
+
+class UsageSummaryDay(models.Model):
+    """メーカー・容量帯ごとの日次集計。年単位のレポートでも数千行の合計で済む"""
+    day = models.DateField(verbose_name="日付")
+    manufacturer = models.ForeignKey(Manufacturer, on_delete=models.SET_NULL, null=True, related_name='+')
+    capacity_band = models.CharField(max_length=10, verbose_name="容量帯")
+    rented_days = models.PositiveIntegerField(default=0, verbose_name="貸出日数")
+    overdue_days = models.PositiveIntegerField(default=0, verbose_name="期限切れ日数")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['day'], name='usage_summary_day_idx'),
+        ]
+
+
+class UsageRollupState(models.Model):
+    """rollup_usage コマンドの進み具合（1行のみ）"""
+    days_through = models.DateField(null=True, verbose_name="集計済みの最終日")
+    changed_through = models.DateTimeField(null=True, verbose_name="反映済みのレンタル更新日時")
@@ -0,0 +1,125 @@
+# rentals/outbox.py
+import logging
+import smtplib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+
+def queue_mail(subject, message, recipient_list, from_email=None):
+    """
+    send_mail と同じ引数で通知メールを送信待ちに登録する。
+    呼び出し元のトランザクションに含まれるため、業務データがロールバックされればメールも送られない。
+    """
+    return OutboxEmail.objects.bulk_create([
+        OutboxEmail(subject=subject, body=message, from_email=from_email or '', recipient=recipient)
+        for recipient in recipient_list if recipient
+    ])
+
+
+def queue_mass_mail(datatuple, batch_size=500):
+    """
+    send_mass_mail と同じ (subject, message, from_email, recipient_list) のタプル列を
+    まとめて送信待ちに登録する。件数に関わらず数回のINSERTで済む。
+    """
+    return OutboxEmail.objects.bulk_create([
+        OutboxEmail(subject=subject, body=message, from_email=from_email or '', recipient=recipient)
+        for subject, message, from_email, recipient_list in datatuple
+        for recipient in recipient_list if recipient
+    ], batch_size=batch_size)
+
+
+def retry_delay(attempts):
+    """失敗回数に応じた再送までの待ち時間（指数バックオフ、上限あり）"""
+    delay = settings.OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.OUTBOX_RETRY_MAX_SECONDS))
+
+
+def claim_batch(batch_size, max_attempts):
+    """
+    送信するメールを取り出す。次回送信日時を OUTBOX_LEASE_SECONDS 後に進める条件付きUPDATEで確保し、
+    この呼び出しで更新した行だけを読み戻す。同時に動く他の send_outbox は確保済みの行を取り出さないため、
+    同じメールが二重に送られない。送信前に止まった場合も、期限が過ぎれば再び取り出される
+    """
+    now = timezone.now()
+    pending = OutboxEmail.objects.filter(sent_at__isnull=True, attempts__lt=max_attempts)
+    ids = list(
+        pending.filter(next_attempt_at__lte=now).order_by('next_attempt_at', 'id').values_list('id', flat=True)[:batch_size]
+    )
+    if not ids:
+        return []
+    lease_until = now + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS)
+    # 読んでから更新するまでに他で確保された行は、条件に合わず更新されない
+    pending.filter(id__in=ids, next_attempt_at__lte=now).update(next_attempt_at=lease_until)
+    return list(pending.filter(id__in=ids, next_attempt_at=lease_until).order_by('id'))
+
+
+def deliver_pending(batch_size=100, max_attempts=5, connection=None):
+    """
+    送信予定時刻を過ぎた未送信メールを1つのSMTP接続でまとめて送信する。
+    戻り値は (送信成功数, 送信失敗数)。
+    """
+    batch = claim_batch(batch_size, max_attempts)
+    if not batch:
+        return 0, 0
+
+    connection = connection or get_connection()
+    try:
+        connection.open()
+    except (smtplib.SMTPException, OSError) as e:
+        # SMTPサーバーに接続できない場合は、取り出した全件を失敗として再送を待たせる
+        logger.warning("SMTPサーバーに接続できませんでした: %s", e)
+        for email in batch:
+            email.last_error = str(e)
+        sent, failed = [], batch
+    else:
+        # 接続を開いたまま全件を送信し、メールごとのハンドシェイクを避ける
+        try:
+            sent, failed = _send_batch(connection, batch)
+        finally:
+            connection.close()
+
+    sent_at = timezone.now()
+    with transaction.atomic():
+        for email in sent:
+            email.sent_at = sent_at
+            email.attempts += 1
+        for email in failed:
+            email.attempts += 1
+            email.next_attempt_at = sent_at + retry_delay(email.attempts)
+        OutboxEmail.objects.bulk_update(sent, ['sent_at', 'attempts'])
+        OutboxEmail.objects.bulk_update(failed, ['attempts', 'next_attempt_at', 'last_error'])
+    return len(sent), len(failed)
+
+
+def _send_batch(connection, batch):
+    """開いた接続でメールを1件ずつ送り、(送信できたメール, 失敗したメール) を返す"""
+    sent, failed = [], []
+    for email in batch:
+        message = EmailMessage(
+            email.subject, email.body, email.from_email or settings.DEFAULT_FROM_EMAIL,
+            [email.recipient], connection=connection,
+        )
+        try:
+            message.send()
+        except (smtplib.SMTPException, OSError) as e:
+            logger.warning("メール送信に失敗しました (id=%s): %s", email.id, e)
+            email.last_error = str(e)
+            failed.append(email)
+            if isinstance(e, smtplib.SMTPServerDisconnected):
+                # 切断された場合は次のメールのために接続し直す。再接続できなければ残りは次回に回す
+                connection.close()
+                try:
+                    connection.open()
+                except (smtplib.SMTPException, OSError):
+                    break
+        else:
+            sent.append(email)
+    return sent, failed
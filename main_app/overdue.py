@@ -0,0 +1,67 @@
+# rentals/overdue.py
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import RentalRequest
+
+
+def _cache_key(user_id, today):
+    # 日付をキーに含めることで、日付が変わると自動的に新しい集計になる
+    return f'main_app:overdue:{user_id}:{today.isoformat()}'
+
+
+def overdue_queryset(user, today):
+    """返却期限切れの (デバイス名, 返却期日) を期日順に返すクエリ（check_query_plans コマンドもこのクエリの実行計画を確認する）"""
+    return RentalRequest.objects.filter(
+        user=user, end_date__lt=today, is_returned=False
+    ).order_by('end_date', 'id').values_list('usb_device__name', 'end_date')
+
+
+def overdue_rentals_for(user):
+    """
+    ログインユーザーの返却期限切れレンタル（デバイス名と返却期日）の一覧。
+    結果はレンタル・返却・延長で無効化されるまで、その日のあいだキャッシュする。
+    """
+    today = timezone.now().date()
+    key = _cache_key(user.id, today)
+    timeout = settings.OVERDUE_CACHE_SECONDS
+    if timeout:
+        rentals = cache.get(key)
+        if rentals is not None:
+            return rentals
+
+    rentals = [
+        {'usb_device_name': name, 'end_date': end_date}
+        for name, end_date in overdue_queryset(user, today)
+    ]
+    if timeout:
+        cache.set(key, rentals, timeout)
+    return rentals
+
+
+async def aoverdue_rentals_for(user):
+    """overdue_rentals_for の非同期版（キャッシュも非同期APIで読み書きする）"""
+    today = timezone.now().date()
+    key = _cache_key(user.id, today)
+    timeout = settings.OVERDUE_CACHE_SECONDS
+    if timeout:
+        rentals = await cache.aget(key)
+        if rentals is not None:
+            return rentals
+
+    rentals = [
+        {'usb_device_name': name, 'end_date': end_date}
+        async for name, end_date in overdue_queryset(user, today)
+    ]
+    if timeout:
+        await cache.aset(key, rentals, timeout)
+    return rentals
+
+
+def invalidate_overdue(user_id):
+    """ユーザーのレンタル状況が変わったときに呼ぶ。コミット前に読み直された古い値もコミット後に消す"""
+    key = _cache_key(user_id, timezone.now().date())
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
@@ -0,0 +1,173 @@
+# rentals/pagination.py
+import base64
+import json
+
+from django.core.paginator import InvalidPage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from django.http import Http404
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+class KeysetPage:
+    """キーセット方式の1ページ分。総件数は数えず、次ページの有無だけを持つ"""
+
+    def __init__(self, object_list, next_cursor, is_first):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.is_first = is_first
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return not self.is_first
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    OFFSETやCOUNT(*)を使わず、直前のページ末尾の並び替えキーを起点に次ページを取得する。
+    ordering は ('name', 'id') や ('-start_date', '-id') のように指定し、
+    最後のキーは一意（通常は id）である必要がある。NULL は常に末尾に並べる。
+    """
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+        self.per_page = per_page
+        self.fields = [queryset.model._meta.get_field(name) for name, _ in self.ordering]
+
+    def get_page(self, cursor=None):
+        # 1件多く取得して次ページの有無を判定する
+        rows = list(self._window(self.queryset, cursor))
+        return self._make_page(rows, cursor)
+
+    async def aget_page(self, cursor=None):
+        """get_page の非同期版（非同期ビューから非同期ORMで取得する）"""
+        rows = [row async for row in self._window(self.queryset, cursor)]
+        return self._make_page(rows, cursor)
+
+    def _window(self, queryset, cursor):
+        """カーソルより後ろの行を並び順に1ページ分＋1件取り出すクエリセット"""
+        queryset = queryset.order_by(*[
+            self._order_expression(name, desc, field.null)
+            for (name, desc), field in zip(self.ordering, self.fields)
+        ])
+        if cursor:
+            queryset = queryset.filter(self._after(self.decode_cursor(cursor)))
+        return queryset[:self.per_page + 1]
+
+    def _make_page(self, rows, cursor):
+        next_cursor = None
+        if len(rows) > self.per_page:
+            rows = rows[:self.per_page]
+            next_cursor = self.encode_cursor(rows[-1])
+        return KeysetPage(rows, next_cursor, is_first=not cursor)
+
+    @staticmethod
+    def _order_expression(name, desc, nullable):
+        # NULL を許可しない列はインデックス順そのままで並べられるよう素の指定にする
+        if not nullable:
+            return f'-{name}' if desc else name
+        return F(name).desc(nulls_last=True) if desc else F(name).asc(nulls_last=True)
+
+    def _after(self, values):
+        """並び替えキーが values より後ろにある行を表す条件を組み立てる"""
+        condition = Q(pk__in=[])
+        prefix = Q()
+        for (name, desc), field, value in zip(self.ordering, self.fields, values):
+            if not field.null:
+                lookup = 'lt' if desc else 'gt'
+                condition |= prefix & Q(**{f'{name}__{lookup}': value})
+                equal = Q(**{name: value})
+            elif value is None:
+                # NULL は末尾なので、同じ NULL の中で後続キーを比較するしかない
+                equal = Q(**{f'{name}__isnull': True})
+            else:
+                lookup = 'lt' if desc else 'gt'
+                condition |= prefix & (Q(**{f'{name}__{lookup}': value}) | Q(**{f'{name}__isnull': True}))
+                equal = Q(**{name: value})
+            prefix &= equal
+        return condition
+
+    def encode_cursor(self, obj):
+        # values() の辞書でもモデルのインスタンスでも、ページ末尾の並び替えキーを取り出せる
+        if isinstance(obj, dict):
+            values = [obj[field.attname] for field in self.fields]
+        else:
+            values = [getattr(obj, field.attname) for field in self.fields]
+        raw = json.dumps(values, cls=DjangoJSONEncoder).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            values = json.loads(raw)
+            if not isinstance(values, list) or len(values) != len(self.fields):
+                raise ValueError
+            return [None if v is None else field.to_python(v) for field, v in zip(self.fields, values)]
+        except Exception:
+            raise InvalidCursor("カーソルの値が不正です。")
+
+
+class MergedKeysetPaginator(KeysetPaginator):
+    """
+    同じ並び替えキーを持つ複数のクエリセット（現行テーブルとアーカイブなど）を1つの一覧としてページ分割する。
+    それぞれから1ページ分ずつ取り出してPython側で併合するため、クエリはクエリセットの数だけで済む。
+    最後のキー（id）はクエリセットをまたいで一意である必要がある。
+    """
+
+    def __init__(self, querysets, ordering, per_page):
+        super().__init__(querysets[0], ordering, per_page)
+        self.querysets = querysets
+
+    def get_page(self, cursor=None):
+        rows = []
+        for queryset in self.querysets:
+            rows.extend(self._window(queryset, cursor))
+        return self._merge(rows, cursor)
+
+    async def aget_page(self, cursor=None):
+        rows = []
+        for queryset in self.querysets:
+            rows.extend([row async for row in self._window(queryset, cursor)])
+        return self._merge(rows, cursor)
+
+    def _merge(self, rows, cursor):
+        # 後ろのキーから順に安定ソートを重ね、DBと同じ並び（NULLは末尾）にする
+        for (name, desc), field in reversed(list(zip(self.ordering, self.fields))):
+            rows.sort(key=self._sort_key(field.attname, desc), reverse=desc)
+        return self._make_page(rows[:self.per_page + 1], cursor)
+
+    @staticmethod
+    def _sort_key(attname, desc):
+        def key(obj):
+            value = getattr(obj, attname)
+            # 降順は reverse=True で並べるため、どちらの向きでも NULL が末尾に来るよう先頭の真偽値を切り替える
+            rank = (value is not None) if desc else (value is None)
+            return (rank, value if value is not None else 0)
+        return key
+
+
+class KeysetPaginationMixin:
+    """ListView の OFFSET ページネーションをキーセット方式に置き換えるミックスイン"""
+    keyset_ordering = ('id',)
+    cursor_kwarg = 'cursor'
+    paginate_by = 50
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, self.keyset_ordering, page_size)
+        try:
+            page = paginator.get_page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor as e:
+            raise Http404(str(e))
+        return (paginator, page, page.object_list, page.has_next() or page.has_previous())
@@ -0,0 +1,131 @@
+# rentals/rental_log.py
+# レンタルの操作の追記専用の記録（RentalEvent）と、そこから貸出状況を組み立て直す処理。
+# 記録は main_app.lending が状態の変更と同じトランザクションで追記する
+from django.db import transaction
+
+from .models import RentalEvent, RentalSnapshot, USBDevice
+
+# 再生のときに一度に読む記録の件数
+REPLAY_CHUNK_SIZE = 2000
+EVENT_FIELDS = ('id', 'kind', 'rental_id', 'device_id', 'user_id', 'end_date', 'created_at')
+# 記録を始める前の貸出状況（マイグレーションで作る）。記録の最初から組み立て直すのに使うため消さない
+BASELINE_EVENT_ID = 0
+
+
+class SnapshotMissing(LookupError):
+    """組み立て直す起点のスナップショットが消されている"""
+
+
+def _event(kind, rental, actor_id, comment):
+    return RentalEvent(
+        kind=kind, rental_id=rental.id, device_id=rental.usb_device_id, user_id=rental.user_id,
+        actor_id=actor_id, end_date=rental.end_date, comment=comment or '',
+    )
+
+
+def record(kind, rental, actor_id=None, comment=''):
+    """呼び出し元のトランザクションで1件追記する。操作した人を省略すると借りた人とする"""
+    event = _event(kind, rental, rental.user_id if actor_id is None else actor_id, comment)
+    event.save()
+    return event
+
+
+def record_many(kind, rentals, actor_id, comment=''):
+    """承認者がまとめて判断した申請の記録を1回のINSERTで追記する"""
+    return RentalEvent.objects.bulk_create([_event(kind, rental, actor_id, comment) for rental in rentals])
+
+
+def new_device():
+    return {
+        'available': True, 'rental': None, 'user': None, 'end_date': None, 'approved': False,
+        'rentals': 0, 'last_returned_at': None,
+    }
+
+
+def apply(devices, event):
+    """
+    記録を1件反映する。devices はデバイスIDをキーにした状態の辞書で、その場で更新する。
+    日付・日時は JSON にそのまま保存できるよう ISO 形式の文字列で持つ
+    """
+    device = devices.setdefault(event['device_id'], new_device())
+    kind = event['kind']
+    if kind == RentalEvent.RENTED:
+        device.update(
+            available=False, rental=event['rental_id'], user=event['user_id'], approved=False,
+            end_date=event['end_date'] and event['end_date'].isoformat(), rentals=device['rentals'] + 1,
+        )
+    elif device['rental'] != event['rental_id']:
+        # 貸出中のレンタル以外への操作（記録より前に返却済みのものなど）は状態を変えない
+        return
+    elif kind == RentalEvent.EXTENDED:
+        device['end_date'] = event['end_date'] and event['end_date'].isoformat()
+    elif kind == RentalEvent.APPROVED:
+        device['approved'] = True
+    elif kind in (RentalEvent.RETURNED, RentalEvent.REJECTED):
+        device.update(
+            available=True, rental=None, user=None, end_date=None, approved=False,
+            last_returned_at=event['created_at'].isoformat(),
+        )
+
+
+def latest_snapshot(until_id=None):
+    snapshots = RentalSnapshot.objects.order_by('-last_event_id')
+    if until_id is not None:
+        snapshots = snapshots.filter(last_event_id__lte=until_id)
+    return snapshots.first()
+
+
+def rebuild(until_id=None):
+    """
+    until_id（省略時は最新）までの記録を反映したデバイスごとの状態と、反映した最後の記録のIDを返す。
+    最新のスナップショットから始め、それ以降の記録だけを id の順に再生する。
+    until_id 以前のスナップショットが消されている場合は、空の状態から再生すると誤った状態になるため SnapshotMissing
+    """
+    snapshot = latest_snapshot(until_id)
+    if snapshot is None and RentalSnapshot.objects.exists():
+        raise SnapshotMissing(f"記録 {until_id} 以前のスナップショットがありません。")
+    if snapshot is None:
+        devices, last_id = {}, 0
+    else:
+        devices = {int(device_id): state for device_id, state in snapshot.devices.items()}
+        last_id = snapshot.last_event_id
+
+    events = RentalEvent.objects.filter(id__gt=last_id).order_by('id')
+    if until_id is not None:
+        events = events.filter(id__lte=until_id)
+    for event in events.values(*EVENT_FIELDS).iterator(chunk_size=REPLAY_CHUNK_SIZE):
+        apply(devices, event)
+        last_id = event['id']
+    return devices, last_id
+
+
+def take_snapshot():
+    """最新の記録までを反映したスナップショットを保存する。前回から記録が増えていなければ作らない"""
+    with transaction.atomic():
+        devices, last_id = rebuild()
+        if RentalSnapshot.objects.filter(last_event_id=last_id).exists():
+            return None
+        return RentalSnapshot.objects.create(
+            last_event_id=last_id, devices={str(device_id): state for device_id, state in devices.items()},
+        )
+
+
+def prune_snapshots(keep):
+    """新しい方から keep 件と記録を始める前のスナップショットを残し、古いスナップショットを消す（記録そのものは消さない）"""
+    stale = (
+        RentalSnapshot.objects.exclude(last_event_id=BASELINE_EVENT_ID)
+        .order_by('-last_event_id').values_list('id', flat=True)[keep:]
+    )
+    return RentalSnapshot.objects.filter(id__in=list(stale)).delete()[0]
+
+
+def mismatches(devices):
+    """
+    組み立て直した貸出可否と、USBデバイスの現在の貸出可否が食い違うデバイスの (ID, 記録上の可否, 現在の可否)。
+    記録に現れないデバイスは貸出可能のはずとして比べる
+    """
+    return [
+        (device_id, devices.get(device_id, {}).get('available', True), is_available)
+        for device_id, is_available in USBDevice.objects.order_by('id').values_list('id', 'is_available').iterator()
+        if devices.get(device_id, {}).get('available', True) != is_available
+    ]
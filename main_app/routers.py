@@ -0,0 +1,129 @@
+# rentals/routers.py
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA = 'replica'
+# 書き込んだ直後の数秒間、同じブラウザからの読み取りを書き込み側に向けるためのクッキー
+PIN_COOKIE = 'db_primary_pin'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RoutingState:
+    """処理中のリクエストの振り分け状態。ルーターから書き換えるため可変のオブジェクトにする"""
+
+    def __init__(self, use_replica):
+        self.use_replica = use_replica
+        self.wrote = False
+
+
+_state = ContextVar('db_routing', default=None)
+
+
+def replica_configured():
+    return REPLICA in settings.DATABASES
+
+
+class PrimaryReplicaRouter:
+    """
+    書き込みは常に default（書き込み側）に、読み取りは ReplicaRoutingMiddleware が許可したリクエストに限り
+    replica（読み取り専用の複製）に振り分ける。
+    管理コマンドやシェルなどリクエストの外、トランザクションの中、書き込みの後の読み取りは default から行う。
+    """
+    # 作成直後から全てのリクエストで読まれるため、複製の遅れを許容できないアプリ（ログインのセッション）
+    primary_only_apps = {'sessions'}
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.use_replica or not replica_configured():
+            return DEFAULT_DB_ALIAS
+        if model._meta.app_label in self.primary_only_apps:
+            return DEFAULT_DB_ALIAS
+        # select_for_update などトランザクション内の読み取りは書き込みと同じ接続で行う
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return REPLICA
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            # 書き込んだ内容を同じリクエストの残りの処理で読めるよう、以降の読み取りも書き込み側にする
+            state.use_replica = False
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 複製は同じ内容なので、どちらから読んだインスタンス同士でも関連付けてよい
+        return {obj1._state.db, obj2._state.db} <= {DEFAULT_DB_ALIAS, REPLICA} or None
+
+    def allow_migrate(self, db, app_label, **hints):
+        # 複製のスキーマは sync_replica コマンドで書き込み側から丸ごと写す
+        return False if db == REPLICA else None
+
+
+@contextmanager
+def use_primary():
+    """ブロック内の読み取りを書き込み側から行う（直前に書き込んだ内容を確実に読みたい場合など）"""
+    state = _state.get()
+    if state is None:
+        yield
+        return
+    previous, state.use_replica = state.use_replica, False
+    try:
+        yield
+    finally:
+        state.use_replica = previous and not state.wrote
+
+
+class ReplicaRoutingMiddleware:
+    """
+    GET などの安全なメソッドのリクエストだけ、読み取りを replica に振り分けてよいことにする。
+    書き込みのあったリクエストの応答には短時間のクッキーを付け、リダイレクト先や直後の再読み込みでは
+    複製の遅れに関係なく書き込み側から読む（read-after-write）。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = self.start(request)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(request, response, state)
+
+    async def __acall__(self, request):
+        # 非同期ORMは sync_to_async のスレッドで動くが、コンテキスト変数と状態オブジェクトは共有される
+        state = self.start(request)
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(request, response, state)
+
+    @staticmethod
+    def start(request):
+        use_replica = (
+            replica_configured() and request.method in SAFE_METHODS and PIN_COOKIE not in request.COOKIES
+        )
+        return RoutingState(use_replica)
+
+    @staticmethod
+    def finish(request, response, state):
+        if replica_configured() and (state.wrote or request.method not in SAFE_METHODS):
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=settings.DATABASE_REPLICA_PIN_SECONDS, httponly=True, samesite='Lax',
+            )
+        return response
@@ -0,0 +1,91 @@
+# rentals/search.py
+from django.db import connections, router
+from django.db.models import Q
+
+from .models import USBDevice
+
+FTS_TABLE = 'main_app_usbdevice_fts'
+# trigram の索引で引ける最短の語の長さ。これより短い語は索引の候補の中から部分一致で絞り込む
+MIN_INDEXED_LENGTH = 3
+# bm25 の列ごとの重み（デバイス名 > メーカー名 > 説明の順に一致を重く見る）
+COLUMN_WEIGHTS = (10.0, 1.0, 5.0)
+MAX_TERMS = 8
+
+
+def split_terms(query):
+    """空白区切りの検索語（重複を除き最大 MAX_TERMS 個）。全角の空白でも区切る"""
+    terms = [term for term in query.replace('　', ' ').split() if term]
+    return list(dict.fromkeys(terms))[:MAX_TERMS]
+
+
+def ranked_ids(terms, limit, using=None, within=None):
+    """
+    検索語を全て含むデバイスの (id, スコア) を関連度の高い順に返す。スコアは小さいほど関連度が高い。
+    3文字以上の語は FTS5 の索引で引くため、デバイス数に関わらずほぼ一定の時間で済む。
+    短い語だけの検索は索引の全行を走査する。
+    within（デバイスの id を返す QuerySet）を指定すると、その中から上位 limit 件を選ぶ。
+    """
+    indexed = [term for term in terms if len(term) >= MIN_INDEXED_LENGTH]
+    short = [term for term in terms if len(term) < MIN_INDEXED_LENGTH]
+    conditions, params = [], []
+    if indexed:
+        # 語は引用符で囲み、FTS5 の演算子（AND / NEAR / * など）として解釈させない
+        conditions.append(f'{FTS_TABLE} MATCH %s')
+        params.append(' AND '.join('"{}"'.format(term.replace('"', '""')) for term in indexed))
+    for term in short:
+        conditions.append("instr(lower(name || ' ' || description || ' ' || coalesce(manufacturer, '')), lower(%s)) > 0")
+        params.append(term)
+    if within is not None:
+        # 絞り込みは LIMIT より前に適用する（上位の件数を取ってから絞ると、条件に合う行が上位に無い場合に漏れる）
+        subquery, subquery_params = within.query.sql_with_params()
+        conditions.append(f'rowid IN ({subquery})')
+        params.extend(subquery_params)
+    score = f'bm25({FTS_TABLE}, {", ".join(map(str, COLUMN_WEIGHTS))})' if indexed else '0'
+
+    sql = (
+        f'SELECT rowid, {score} AS score FROM {FTS_TABLE} WHERE {" AND ".join(conditions)} '
+        f'ORDER BY score, rowid LIMIT %s'
+    )
+    with connections[using or router.db_for_read(USBDevice)].cursor() as cursor:
+        cursor.execute(sql, [*params, limit])
+        return cursor.fetchall()
+
+
+def search(queryset, query, limit):
+    """
+    queryset のデバイスのうち検索語に一致するものを関連度順に (行, スコア) のリストで返す。
+    queryset はモデルのインスタンスでも values()（id を含むこと）でもよい。
+    索引から id を引く1回と、queryset から該当の行を読む1回（と queryset の先読み）で済む。
+    """
+    terms = split_terms(query)
+    if not terms:
+        return []
+    using = queryset.db
+    if connections[using].vendor != 'sqlite':
+        # FTS5 の索引が無いデータベースでは部分一致で探す（デバイス数に比例して遅くなる）
+        condition = Q()
+        for term in terms:
+            condition &= (
+                Q(name__icontains=term) | Q(description__icontains=term) | Q(manufacturer__name__icontains=term)
+            )
+        return [(row, 0.0) for row in queryset.filter(condition).order_by('name', 'id')[:limit]]
+
+    # 絞り込み条件のある queryset は、条件に合う id の副問い合わせとして索引の検索に含める
+    within = queryset.order_by().values('pk') if queryset.query.has_filters() else None
+    scores = dict(ranked_ids(terms, limit, using, within))
+    if not scores:
+        return []
+    rows = {
+        row['id'] if isinstance(row, dict) else row.pk: row
+        for row in queryset.filter(pk__in=list(scores))
+    }
+    return [(rows[device_id], score) for device_id, score in scores.items() if device_id in rows]
+
+
+def rank_devices(queryset, query, limit):
+    """search の結果をデバイスのリストで返す（各デバイスに search_score を付ける）"""
+    devices = []
+    for device, score in search(queryset, query, limit):
+        device.search_score = score
+        devices.append(device)
+    return devices
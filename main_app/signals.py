@@ -0,0 +1,46 @@
+# rentals/signals.py
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+
+from . import versions, whitelist
+from .compliance import Policies
+from .dashboard import invalidate_dashboard
+from .models import Manufacturer, ManufacturerWhitelist, RentalRequest, USBDevice, UserPC
+
+
+@receiver([post_save, post_delete], sender=ManufacturerWhitelist)
+def invalidate_whitelist_cache(sender, **kwargs):
+    # メーカー削除による連鎖削除でも post_delete が送られる
+    whitelist.invalidate()
+
+
+@receiver([post_save, post_delete], sender=USBDevice)
+def bump_inventory_version(sender, **kwargs):
+    # 更新日時は auto_now で進むので、一覧のバージョンだけを進める
+    versions.bump_inventory()
+
+
+@receiver([post_save, post_delete], sender=RentalRequest)
+def touch_rented_device(sender, instance, **kwargs):
+    # 貸出状況や履歴はデバイスのページに表示されるため、デバイス側の更新日時を進める
+    versions.touch_devices([instance.usb_device_id])
+    # 借りた人と承認者のホームページの表示（レンタルの一覧・承認待ちの件数）も変わる
+    invalidate_dashboard(instance.user_id, instance.approver_id)
+
+
+@receiver(pre_save, sender=UserPC)
+def evaluate_pc_compliance(sender, instance, **kwargs):
+    # 登録・変更されたPCは保存時に判定する。基準の変更は evaluate_antivirus コマンドで全てのPCに反映する
+    instance.is_compliant = Policies.load().is_compliant(instance.antivirus_version)
+
+
+@receiver([post_save, post_delete], sender=UserPC)
+def invalidate_pc_owner_dashboard(sender, instance, **kwargs):
+    invalidate_dashboard(instance.user_id)
+
+
+@receiver(post_save, sender=Manufacturer)
+def touch_manufacturer_devices(sender, instance, created, **kwargs):
+    # メーカー名はデバイスの詳細ページに表示される
+    if not created:
+        versions.touch_devices(USBDevice.objects.filter(manufacturer=instance).values('id'))
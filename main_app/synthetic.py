@@ -0,0 +1,178 @@
+# rentals/synthetic.py
+# 負荷試験・ベンチマーク用の合成データ。seed_data コマンドと、データを作ってロールバックする各ベンチマーク
+# （check_query_plans・benchmark_overdue_cache・benchmark_routes）が同じ生成処理を使う
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .compliance import Policies
+from .models import Manufacturer, ManufacturerWhitelist, USBDevice, UserPC, RentalRequest, RentalEvent, Reservation
+
+GB = 1000 ** 3
+CAPACITIES = [4 * GB, 8 * GB, 16 * GB, 32 * GB, 64 * GB, 128 * GB, 256 * GB, 1000 * GB, None]
+ANTIVIRUS_VERSIONS = ['1.0.0', '2.3.1', '3.0.5', '3.2.0', '4.1.2', '']
+
+
+class SyntheticData:
+    """
+    メーカー・ユーザーとPC・デバイス・レンタル（操作の記録を含む）・予約を bulk_create でまとめて登録する。
+    名前には prefix を付け、同じ seed なら同じデータになる。呼び出し元のトランザクションで作る
+    """
+
+    def __init__(self, prefix='seed', seed=0, batch_size=5000):
+        self.prefix = prefix
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.today = timezone.now().date()
+        self.whitelisted_ids = set()
+        self.rentable_ids = []
+
+    def populate(self, manufacturers, users, devices, rentals, reservations, password=None):
+        """全ての種類をまとめて登録し、登録した件数を返す"""
+        manufacturer_ids = self.manufacturers(manufacturers)
+        user_ids, pc_ids = self.users(users, password)
+        device_ids = self.devices(devices, manufacturer_ids)
+        return {
+            'manufacturers': len(manufacturer_ids),
+            'users': len(user_ids),
+            'devices': len(device_ids),
+            'rentals': self.rentals(rentals, device_ids, user_ids, pc_ids),
+            'reservations': self.reservations(reservations, user_ids),
+        }
+
+    def bulk_create(self, model, objs):
+        return model.objects.bulk_create(objs, batch_size=self.batch_size)
+
+    def manufacturers(self, count):
+        manufacturers = self.bulk_create(Manufacturer, [Manufacturer(name=f'{self.prefix}-maker-{i:03d}') for i in range(count)])
+        whitelisted = [m for m in manufacturers if self.rng.random() < 0.9] or manufacturers[:1]
+        self.bulk_create(ManufacturerWhitelist, [ManufacturerWhitelist(manufacturer=m) for m in whitelisted])
+        # レンタルはホワイトリストのメーカーのデバイスに限る
+        self.whitelisted_ids = {m.id for m in whitelisted}
+        return [m.id for m in manufacturers]
+
+    def users(self, count, password=None):
+        """ユーザーと1人1台のPCを登録し、(ユーザーIDの一覧, ユーザーID → PCのID) を返す。password を省略するとログインできないユーザーにする"""
+        # パスワードのハッシュ化は重いので1回だけ計算して全員に使う
+        hashed = make_password(password)
+        users = self.bulk_create(User, [
+            User(username=f'{self.prefix}-user-{i:06d}', email=f'{self.prefix}-user-{i:06d}@example.com', password=hashed)
+            for i in range(count)
+        ])
+        # bulk_create では保存時の判定（シグナル）が動かないため、ここで判定する
+        policies = Policies.load()
+        versions = [self.rng.choice(ANTIVIRUS_VERSIONS) for _ in users]
+        pcs = self.bulk_create(UserPC, [
+            UserPC(
+                user=user, serial_number=f'{self.prefix}-pc-{i:06d}', antivirus_version=version,
+                is_compliant=policies.is_compliant(version),
+            )
+            for i, (user, version) in enumerate(zip(users, versions))
+        ])
+        return [u.id for u in users], {pc.user_id: pc.id for pc in pcs}
+
+    def devices(self, count, manufacturer_ids):
+        devices = []
+        ids = []
+        for i in range(count):
+            devices.append(USBDevice(
+                name=f'{self.prefix}-usb-{i:07d}',
+                description=f'合成データ {i}',
+                manufacturer_id=self.rng.choice(manufacturer_ids) if manufacturer_ids else None,
+                purchase_date=self.today - timedelta(days=self.rng.randint(0, 5 * 365)),
+                capacity=self.rng.choice(CAPACITIES),
+            ))
+            if len(devices) >= self.batch_size:
+                ids.extend((d.id, d.manufacturer_id) for d in self.bulk_create(USBDevice, devices))
+                devices = []
+        ids.extend((d.id, d.manufacturer_id) for d in self.bulk_create(USBDevice, devices))
+        self.rentable_ids = [d for d, m in ids if m in self.whitelisted_ids] or [d for d, _ in ids]
+        return [d for d, _ in ids]
+
+    def rentals(self, count, device_ids, user_ids, pc_ids):
+        if not device_ids or not user_ids:
+            return 0
+        # 未返却レンタルはデバイスの約1割（1台に1件まで）、残りは過去2年間の返却済みレンタル
+        active_devices = self.rng.sample(self.rentable_ids, min(len(self.rentable_ids), count // 10, len(device_ids) // 10))
+        created = 0
+        batch = []
+        active = []
+
+        def flush():
+            nonlocal batch, created
+            self.bulk_create(RentalRequest, batch)
+            # 返却済みのレンタルは貸出から返却までの操作の記録も作る（未返却のものは最後に作る）
+            self.bulk_create(RentalEvent, [
+                event for rental in batch if rental.is_returned for event in self.rental_events(rental)
+            ])
+            active.extend(rental for rental in batch if not rental.is_returned)
+            created += len(batch)
+            batch = []
+
+        for i in range(count):
+            user_id = self.rng.choice(user_ids)
+            start = self.today - timedelta(days=self.rng.randint(0, 2 * 365))
+            end = start + timedelta(days=self.rng.randint(1, 14))
+            rental = RentalRequest(
+                usb_device_id=active_devices[i] if i < len(active_devices) else self.rng.choice(self.rentable_ids),
+                user_id=user_id, pc_id=pc_ids.get(user_id), approver_id=self.rng.choice(user_ids),
+                approved=True, start_date=start, end_date=end,
+            )
+            if i < len(active_devices):
+                # 未返却のうち約3割は返却期限切れにする
+                if self.rng.random() < 0.3:
+                    rental.start_date = self.today - timedelta(days=self.rng.randint(15, 60))
+                    rental.end_date = self.today - timedelta(days=self.rng.randint(1, 14))
+                else:
+                    rental.start_date = self.today - timedelta(days=self.rng.randint(0, 7))
+                    rental.end_date = self.today + timedelta(days=self.rng.randint(1, 14))
+            else:
+                # 返却期日の前日〜2日後に返却されたことにする（今日より後にはしない）
+                returned_on = min(end + timedelta(days=self.rng.randint(-1, 2)), self.today)
+                rental.is_returned = True
+                rental.returned_at = timezone.now() - (self.today - returned_on)
+            batch.append(rental)
+            if len(batch) >= self.batch_size:
+                flush()
+        flush()
+        # 未返却のレンタルの記録は返却済みのものより後に置き、記録を再生した貸出状況がデバイスと一致するようにする
+        self.bulk_create(RentalEvent, [event for rental in active for event in self.rental_events(rental)])
+
+        for start in range(0, len(active_devices), self.batch_size):
+            USBDevice.objects.filter(id__in=active_devices[start:start + self.batch_size]).update(is_available=False)
+        return created
+
+    def rental_events(self, rental):
+        events = [
+            RentalEvent(
+                kind=kind, rental_id=rental.id, device_id=rental.usb_device_id, user_id=rental.user_id,
+                actor_id=rental.approver_id if kind == RentalEvent.APPROVED else rental.user_id, end_date=rental.end_date,
+            )
+            for kind in (RentalEvent.RENTED, RentalEvent.APPROVED)
+        ]
+        if rental.is_returned:
+            events.append(RentalEvent(
+                kind=RentalEvent.RETURNED, rental_id=rental.id, device_id=rental.usb_device_id, user_id=rental.user_id,
+                actor_id=rental.user_id, end_date=rental.end_date, created_at=rental.returned_at,
+            ))
+        return events
+
+    def reservations(self, count, user_ids):
+        if not self.rentable_ids or not user_ids:
+            return 0
+        # 同じデバイスの予約が重ならないよう、デバイスごとに週単位の枠を順に割り当てる
+        slots = {}
+        reservations = []
+        for _ in range(count):
+            device_id = self.rng.choice(self.rentable_ids)
+            slot = slots.get(device_id, 0)
+            slots[device_id] = slot + 1
+            start = self.today + timedelta(days=30 + slot * 7)
+            reservations.append(Reservation(
+                usb_device_id=device_id, user_id=self.rng.choice(user_ids),
+                start_date=start, end_date=start + timedelta(days=self.rng.randint(0, 5)),
+            ))
+        return len(self.bulk_create(Reservation, reservations))
@@ -1,3 +1,1794 @@
-from django.test import TestCase
+import asyncio
+import json
+import socketserver
+import sqlite3
+import tempfile
+import threading
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from types import ModuleType
+from unittest.mock import patch
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Q
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, reverse
+from django.utils import timezone
+
+from .models import (
+    USBDevice, RentalRequest, ArchivedRentalRequest, UserPC, OutboxEmail, Manufacturer, ManufacturerWhitelist,
+    Reservation, DeviceEvent, WaitlistEntry, AntivirusPolicy, RentalEvent, RentalSnapshot, DeviceUsageDay,
+    DeviceUsageMonth,
+)
+from .outbox import queue_mail, deliver_pending
+from .inventory import DEVICE_COLUMNS
+from .search import rank_devices
+from .usage import refresh_rollups, manufacturer_report, capacity_band_report, device_report
+from .forms import ManufacturerWhitelistForm, RentalRequestForm
+from . import compliance, instrumentation, lending, rental_log, routers, whitelist
+from .whitelist import whitelisted_manufacturer_ids
+from .views import RequestRentalView
+from .urls import build_urlpatterns
+
+
+def whitelisted_manufacturer(name='maker'):
+    manufacturer = Manufacturer.objects.create(name=name)
+    ManufacturerWhitelist.objects.create(manufacturer=manufacturer)
+    return manufacturer
+
+
+class LoggedInMixin:
+    """キャッシュを空にし、今日の日付と、ログイン済みのユーザー alice を用意する"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.today = timezone.now().date()
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.client.force_login(self.user)
+
+    def create_pc(self, serial_number='pc-1', antivirus_version='1.0'):
+        return UserPC.objects.create(user=self.user, serial_number=serial_number, antivirus_version=antivirus_version)
+
+
+class USBListViewQueryTests(LoggedInMixin, TestCase):
+    """USBデバイス一覧のクエリ数がデバイス数に比例して増えないことを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create(username='bob', email='bob@example.com')
+
+    def create_devices(self, count):
+        today = timezone.now().date()
+        for i in range(count):
+            device = USBDevice.objects.create(name=f'usb-{USBDevice.objects.count()}', is_available=(i % 3 == 0))
+            if not device.is_available:
+                owner = self.user if i % 2 else self.other
+                RentalRequest.objects.create(
+                    usb_device=device, user=owner,
+                    start_date=today - timedelta(days=10), end_date=today - timedelta(days=1),
+                )
+
+    def count_queries(self):
+        cache.clear()  # 返却期限切れのキャッシュが効いた回と比べないよう、毎回キャッシュの無い状態で数える
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('usb_list'))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_query_count_is_constant(self):
+        self.create_devices(5)
+        small = self.count_queries()
+        self.create_devices(50)
+        large = self.count_queries()
+        self.assertEqual(small, large)
+
+    def test_extension_link_only_for_own_rental(self):
+        today = timezone.now().date()
+        mine = USBDevice.objects.create(name='mine', is_available=False)
+        theirs = USBDevice.objects.create(name='theirs', is_available=False)
+        my_rental = RentalRequest.objects.create(usb_device=mine, user=self.user, start_date=today, end_date=today)
+        their_rental = RentalRequest.objects.create(usb_device=theirs, user=self.other, start_date=today, end_date=today)
+
+        response = self.client.get(reverse('usb_list'))
+        self.assertContains(response, reverse('extension_request', args=[my_rental.id]))
+        self.assertNotContains(response, reverse('extension_request', args=[their_rental.id]))
+
+
+class KeysetPaginationTests(LoggedInMixin, TestCase):
+    """キーセットページネーションが全件を重複なく辿り、OFFSET/COUNTを発行しないことを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.device = USBDevice.objects.create(name='history-target')
+        today = self.today
+        # 同じ開始日や開始日なしの行を混ぜて、並び替えキーの重複とNULLを扱えるか確認する
+        for i in range(45):
+            start = None if i % 7 == 0 else today - timedelta(days=i // 3)
+            RentalRequest.objects.create(
+                usb_device=self.device, user=self.user, start_date=start, end_date=today, is_returned=True,
+            )
+
+    def test_history_walks_every_row_once(self):
+        url = reverse('usb_device_detail', args=[self.device.id])
+        seen = []
+        cursor = None
+        while True:
+            params = {'history_cursor': cursor} if cursor else {}
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(url, params)
+            sql = ' '.join(q['sql'] for q in ctx.captured_queries).upper()
+            self.assertNotIn('OFFSET', sql)
+            self.assertNotIn('COUNT(', sql)
+            page = response.context['history_page']
+            seen.extend(rental.id for rental in page.object_list)
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        expected = list(
+            RentalRequest.objects.filter(usb_device=self.device)
+            .order_by(F('start_date').desc(nulls_last=True), '-id')
+            .values_list('id', flat=True)
+        )
+        self.assertEqual(seen, expected)
+
+    def test_device_list_pages_by_name(self):
+        for i in range(60):
+            USBDevice.objects.create(name=f'usb-{i:03d}')
+        first = self.client.get(reverse('usb_list'))
+        second = self.client.get(reverse('usb_list'), {'cursor': first.context['page_obj'].next_cursor})
+        names = [d.name for d in first.context['usb_devices']] + [d.name for d in second.context['usb_devices']]
+        self.assertEqual(names, sorted(USBDevice.objects.values_list('name', flat=True)))
+        self.assertFalse(second.context['page_obj'].has_next())
+
+    def test_invalid_cursor_returns_404(self):
+        response = self.client.get(reverse('usb_list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+
+class ActiveRentalIndexTests(TestCase):
+    """未返却レンタルの一意制約と、主要検索のインデックス利用を確認する"""
+
+    def test_one_active_rental_per_device(self):
+        user = User.objects.create_user(username='alice', password='pass12345')
+        device = USBDevice.objects.create(name='usb', is_available=False)
+        RentalRequest.objects.create(usb_device=device, user=user, is_returned=True)
+        RentalRequest.objects.create(usb_device=device, user=user)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            RentalRequest.objects.create(usb_device=device, user=user)
+
+    def test_query_plans_use_indexes(self):
+        out = StringIO()
+        call_command('check_query_plans', rentals=5000, devices=400, users=50, stdout=out)
+        self.assertIn('rental_user_end_idx', out.getvalue())
+        # 返却期限切れ警告は画面と同じクエリ（デバイス名の結合を含む）の実行計画を確認する
+        overdue_plan = out.getvalue().split('[usb_list overdue]')[1].split('[')[0]
+        self.assertIn('main_app_usbdevice', overdue_plan)
+        self.assertFalse(RentalRequest.objects.exists())
+
+
+class ConcurrentRentalTests(TransactionTestCase):
+    """同じデバイスへの同時レンタル申請で、成功するのが必ず1件だけであることを確認する"""
+    concurrency = 200
+
+    def test_only_one_request_wins(self):
+        today = timezone.now().date()
+        device = USBDevice.objects.create(name='popular', manufacturer=whitelisted_manufacturer())
+        approver = User.objects.create_user(username='approver', password='pass12345', email='approver@example.com')
+        requests = []
+        for i in range(self.concurrency):
+            user = User.objects.create(username=f'user-{i}')
+            pc = UserPC.objects.create(user=user, serial_number=f'pc-{i}', antivirus_version='1.0')
+            data = {'start_date': today, 'end_date': today + timedelta(days=7), 'approver': approver.id, 'pc': pc.id}
+            request = RequestFactory().post(reverse('request_rental', args=[device.id]), data)
+            request.user = user
+            requests.append(request)
+
+        barrier = threading.Barrier(self.concurrency)
+        statuses = []
+
+        # テストクライアントはテンプレート描画を記録するため、大量スレッドではビューを直接呼び出す
+        view = RequestRentalView.as_view()
+
+        def attempt(request):
+            try:
+                barrier.wait()
+                response = view(request, usb_id=device.id)
+                statuses.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=attempt, args=(request,)) for request in requests]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses.count(302), 1)
+        self.assertEqual(statuses.count(409), self.concurrency - 1)
+        self.assertEqual(RentalRequest.objects.filter(usb_device=device, is_returned=False).count(), 1)
+        device.refresh_from_db()
+        self.assertFalse(device.is_available)
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """テスト用の最小限のSMTPサーバー。受信したメールと接続数を server に記録する"""
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply('220 localhost fake smtp')
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            command = line.split(' ', 1)[0].upper()
+            if command == 'EHLO':
+                self.reply('250 localhost')
+            elif command in ('HELO', 'NOOP'):
+                self.reply('250 OK')
+            elif command in ('MAIL', 'RSET'):
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                address = line.split(':', 1)[1].strip('<> ')
+                if address in server.rejected:
+                    self.reply('550 mailbox unavailable')
+                else:
+                    recipients.append(address)
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 end with .')
+                while self.rfile.readline().rstrip(b'\r\n') != b'.':
+                    pass
+                server.messages.extend(recipients)
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+class FakeSMTPMixin:
+    """テスト用のSMTPサーバーを起動し、メールの送信先をそこに向ける"""
+
+    def setUp(self):
+        super().setUp()
+        self.smtp = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeSMTPHandler)
+        self.smtp.daemon_threads = True
+        self.smtp.connections = 0
+        self.smtp.messages = []
+        self.smtp.rejected = set()
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+        self.addCleanup(self.smtp.server_close)
+        self.addCleanup(self.smtp.shutdown)
+        self.smtp_settings = self.settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.smtp.server_address[1],
+            EMAIL_USE_TLS=False, EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='',
+            DEFAULT_FROM_EMAIL='rental@example.com',
+        )
+        self.smtp_settings.enable()
+        self.addCleanup(self.smtp_settings.disable)
+
+
+class OutboxTests(FakeSMTPMixin, TestCase):
+    """レンタル申請の通知メールが送信待ちに登録され、1つの接続でまとめて配送されることを確認する"""
+
+    def test_rental_request_queues_email_without_sending(self):
+        today = timezone.now().date()
+        user = User.objects.create_user(username='alice', password='pass12345')
+        approver = User.objects.create_user(username='approver', password='pass12345', email='approver@example.com')
+        pc = UserPC.objects.create(user=user, serial_number='pc-1', antivirus_version='1.0')
+        device = USBDevice.objects.create(name='usb', manufacturer=whitelisted_manufacturer())
+        self.client.force_login(user)
+
+        response = self.client.post(reverse('request_rental', args=[device.id]), {
+            'start_date': today, 'end_date': today + timedelta(days=3), 'approver': approver.id, 'pc': pc.id,
+        })
+        self.assertRedirects(response, reverse('usb_list'))
+        self.assertEqual(self.smtp.connections, 0)
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.recipient, 'approver@example.com')
+        self.assertIn(str(today), email.body)
+
+    def test_batch_is_sent_over_one_connection(self):
+        queue_mail('件名', '本文', [f'user{i}@example.com' for i in range(10)])
+        out = StringIO()
+        call_command('send_outbox', stdout=out)
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertEqual(len(self.smtp.messages), 10)
+        self.assertFalse(OutboxEmail.objects.filter(sent_at__isnull=True).exists())
+
+        # 送信済みのメールは再送しない
+        call_command('send_outbox', stdout=out)
+        self.assertEqual(len(self.smtp.messages), 10)
+
+    def test_failed_email_is_retried_with_backoff(self):
+        self.smtp.rejected = {'bad@example.com'}
+        queue_mail('件名', '本文', ['good@example.com', 'bad@example.com'])
+        with self.assertLogs('main_app.outbox', 'WARNING'):
+            self.assertEqual(deliver_pending(), (1, 1))
+
+        failed = OutboxEmail.objects.get(recipient='bad@example.com')
+        self.assertEqual(failed.attempts, 1)
+        self.assertGreater(failed.next_attempt_at, timezone.now())
+        # バックオフ中は再送しない
+        self.assertEqual(deliver_pending(), (0, 0))
+
+        self.smtp.rejected = set()
+        OutboxEmail.objects.filter(id=failed.id).update(next_attempt_at=timezone.now())
+        self.assertEqual(deliver_pending(), (1, 0))
+        self.assertEqual(self.smtp.messages, ['good@example.com', 'bad@example.com'])
+
+    def test_unreachable_server_backs_off_whole_batch(self):
+        queue_mail('件名', '本文', ['a@example.com', 'b@example.com'])
+        # 接続を拒否されるポート（一度使って閉じたポート）に向ける
+        with socketserver.TCPServer(('127.0.0.1', 0), socketserver.BaseRequestHandler) as closed:
+            port = closed.server_address[1]
+        out = StringIO()
+        with self.settings(EMAIL_PORT=port), self.assertLogs('main_app.outbox', 'WARNING'):
+            # 例外で止まらず、取り出した全件を失敗として扱う
+            call_command('send_outbox', stdout=out)
+        self.assertIn('送信: 0件, 失敗: 2件', out.getvalue())
+
+        emails = OutboxEmail.objects.all()
+        self.assertTrue(all(email.attempts == 1 and email.sent_at is None for email in emails))
+        self.assertTrue(all(email.next_attempt_at > timezone.now() and email.last_error for email in emails))
+
+        OutboxEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(deliver_pending(), (2, 0))
+
+
+class OutboxConcurrencyTests(FakeSMTPMixin, TransactionTestCase):
+    """send_outbox が同時に動いても、取り出したメールを確保するため1通ずつしか送られないことを確認する"""
+
+    def test_overlapping_workers_send_each_email_once(self):
+        queue_mail('件名', '本文', [f'user{i}@example.com' for i in range(5)])
+        claimed = threading.Event()
+        second_done = threading.Event()
+        results = {}
+
+        class SlowConnection(EmailBackend):
+            # 1つ目の送信処理は、取り出した後で2つ目の送信処理が終わるまで接続を待つ
+            def open(self):
+                claimed.set()
+                second_done.wait(5)
+                return super().open()
+
+        def first_worker():
+            try:
+                results['first'] = deliver_pending(connection=SlowConnection())
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=first_worker)
+        thread.start()
+        self.assertTrue(claimed.wait(5))
+        try:
+            results['second'] = deliver_pending()
+        finally:
+            second_done.set()
+            thread.join()
+
+        self.assertEqual(results, {'first': (5, 0), 'second': (0, 0)})
+        self.assertEqual(sorted(self.smtp.messages), sorted(f'user{i}@example.com' for i in range(5)))
+        self.assertEqual(OutboxEmail.objects.filter(sent_at__isnull=True).count(), 0)
+
+
+class OverdueReminderTests(TestCase):
+    """督促メールが受信者ごとに1通だけ登録され、再実行では重複しないことを確認する"""
+
+    def setUp(self):
+        today = timezone.now().date()
+        self.approver = User.objects.create_user(username='approver', password='pass12345', email='approver@example.com')
+        for name in ('alice', 'bob'):
+            user = User.objects.create_user(username=name, password='pass12345', email=f'{name}@example.com')
+            for i in range(3):
+                device = USBDevice.objects.create(name=f'{name}-usb-{i}', is_available=False)
+                RentalRequest.objects.create(
+                    usb_device=device, user=user, approver=self.approver,
+                    start_date=today - timedelta(days=10), end_date=today - timedelta(days=1 + i),
+                )
+        # 返却済みや期限内のレンタルは対象外
+        RentalRequest.objects.create(
+            usb_device=USBDevice.objects.create(name='returned'), user=user, approver=self.approver,
+            start_date=today - timedelta(days=10), end_date=today - timedelta(days=5), is_returned=True,
+        )
+        RentalRequest.objects.create(
+            usb_device=USBDevice.objects.create(name='not-due', is_available=False), user=user,
+            start_date=today, end_date=today + timedelta(days=5),
+        )
+
+    def test_one_reminder_per_recipient_and_incremental(self):
+        with self.assertNumQueries(5):
+            call_command('send_overdue_reminders', stdout=StringIO())
+        recipients = sorted(OutboxEmail.objects.values_list('recipient', flat=True))
+        self.assertEqual(recipients, ['alice@example.com', 'approver@example.com', 'bob@example.com'])
+        self.assertEqual(OutboxEmail.objects.get(recipient='approver@example.com').body.count('・'), 6)
+
+        call_command('send_overdue_reminders', stdout=StringIO())
+        self.assertEqual(OutboxEmail.objects.count(), 3)
+
+
+class ReservationTests(LoggedInMixin, TestCase):
+    """将来の予約の期間重複チェックと、期間指定の空きデバイス検索を確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create(username='bob', email='bob@example.com')
+        self.maker = whitelisted_manufacturer()
+        self.device = USBDevice.objects.create(name='usb-a', manufacturer=self.maker, capacity=32)
+
+    def reserve(self, device, start, end):
+        return self.client.post(reverse('reservation_create', args=[device.id]), {'start_date': start, 'end_date': end})
+
+    def test_overlapping_reservation_is_rejected(self):
+        start = self.today + timedelta(days=7)
+        response = self.reserve(self.device, start, start + timedelta(days=3))
+        self.assertRedirects(response, reverse('reservation_list'))
+
+        response = self.reserve(self.device, start + timedelta(days=3), start + timedelta(days=5))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "既に予約またはレンタルが入っています")
+
+        response = self.reserve(self.device, start + timedelta(days=4), start + timedelta(days=5))
+        self.assertRedirects(response, reverse('reservation_list'))
+        self.assertEqual(Reservation.objects.count(), 2)
+
+    def test_availability_search(self):
+        small = USBDevice.objects.create(name='usb-b', manufacturer=self.maker, capacity=8)
+        rented = USBDevice.objects.create(name='usb-c', manufacturer=self.maker, capacity=64, is_available=False)
+        RentalRequest.objects.create(
+            usb_device=rented, user=self.other, start_date=self.today, end_date=self.today + timedelta(days=3),
+        )
+        start = self.today + timedelta(days=1)
+        Reservation.objects.create(
+            usb_device=self.device, user=self.other, start_date=start, end_date=start + timedelta(days=1),
+        )
+
+        def search(start, end, **extra):
+            response = self.client.get(reverse('device_availability'), {'start_date': start, 'end_date': end, **extra})
+            return [device.name for device in response.context['devices']]
+
+        self.assertEqual(search(start, start), ['usb-b'])
+        self.assertEqual(search(start, start, min_capacity=16), [])
+        self.assertEqual(search(self.today + timedelta(days=4), self.today + timedelta(days=5)), ['usb-a', 'usb-b', 'usb-c'])
+        self.assertEqual(
+            search(self.today + timedelta(days=4), self.today + timedelta(days=5), min_capacity=16, manufacturer=self.maker.id),
+            ['usb-a', 'usb-c'],
+        )
+
+    def test_rental_blocked_by_other_users_reservation(self):
+        approver = User.objects.create_user(username='approver', password='pass12345', email='approver@example.com')
+        pc = self.create_pc()
+        Reservation.objects.create(
+            usb_device=self.device, user=self.other,
+            start_date=self.today + timedelta(days=2), end_date=self.today + timedelta(days=4),
+        )
+        response = self.client.post(reverse('request_rental', args=[self.device.id]), {
+            'start_date': self.today, 'end_date': self.today + timedelta(days=3), 'approver': approver.id, 'pc': pc.id,
+        })
+        self.assertEqual(response.status_code, 409)
+        self.device.refresh_from_db()
+        self.assertTrue(self.device.is_available)
+        self.assertFalse(RentalRequest.objects.exists())
+
+
+class InventoryImportExportTests(LoggedInMixin, TestCase):
+    """デバイスの一括登録と、レンタル履歴の逐次書き出しを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        ManufacturerWhitelist.objects.create(manufacturer=Manufacturer.objects.create(name='maker'))
+        Manufacturer.objects.create(name='blocked')
+        USBDevice.objects.create(name='existing')
+
+    def test_csv_upload_reports_row_errors_without_aborting(self):
+        csv_data = (
+            "name,description,manufacturer,purchase_date,capacity\n"
+            "usb-1,説明,maker,2024-01-02,1024\n"
+            "usb-2,,unknown,,\n"
+            "existing,,maker,,\n"
+            "usb-3,,maker,not-a-date,\n"
+            "usb-4,,maker,,-1\n"
+            "usb-1,,maker,,\n"
+            "usb-5,,maker,,\n"
+            "usb-6,,blocked,,\n"
+            "usb-7,,,,\n"
+        )
+        upload = SimpleUploadedFile('devices.csv', csv_data.encode('utf-8'), content_type='text/csv')
+        response = self.client.post(reverse('usb_device_import'), {'file': upload, 'format': 'csv'})
+
+        result = response.context['result']
+        self.assertEqual(result.created, 2)
+        self.assertEqual([line for line, _ in result.errors], [3, 4, 5, 6, 7, 9, 10])
+        device = USBDevice.objects.get(name='usb-1')
+        self.assertEqual(device.manufacturer.name, 'maker')
+        self.assertEqual(device.capacity, 1024)
+
+    def test_non_utf8_upload_is_reported(self):
+        csv_data = "name,description,manufacturer,purchase_date,capacity\nusb-1,予備のデバイス,maker,,\n".encode('cp932')
+        upload = SimpleUploadedFile('devices.csv', csv_data, content_type='text/csv')
+        response = self.client.post(reverse('usb_device_import'), {'file': upload, 'format': 'csv'})
+        self.assertEqual(response.status_code, 200)
+        result = response.context['result']
+        self.assertEqual(result.created, 0)
+        self.assertIn('文字コード', result.errors[0][1])
+
+        # 文字コードに Shift_JIS を選べば取り込める
+        upload = SimpleUploadedFile('devices.csv', csv_data, content_type='text/csv')
+        response = self.client.post(reverse('usb_device_import'), {'file': upload, 'format': 'csv', 'encoding': 'cp932'})
+        self.assertEqual(response.context['result'].created, 1)
+        self.assertEqual(USBDevice.objects.get(name='usb-1').description, '予備のデバイス')
+
+        path = Path(self.enterContext(tempfile.TemporaryDirectory())) / 'devices.csv'
+        path.write_bytes(csv_data.replace(b'usb-1', b'usb-2'))
+        err = StringIO()
+        call_command('import_devices', str(path), stdout=StringIO(), stderr=err)
+        self.assertIn('文字コード', err.getvalue())
+        call_command('import_devices', str(path), encoding='cp932', stdout=StringIO(), stderr=StringIO())
+        self.assertTrue(USBDevice.objects.filter(name='usb-2').exists())
+
+    def test_jsonl_command_uses_batched_inserts(self):
+        lines = [json.dumps({'name': f'usb-{i}', 'manufacturer': 'maker'}) for i in range(25)] + ['{broken']
+        stdin = StringIO("\n".join(lines) + "\n")
+        err = StringIO()
+        with patch('sys.stdin', stdin), CaptureQueriesContext(connection) as ctx:
+            call_command('import_devices', '-', format='jsonl', batch_size=10, stdout=StringIO(), stderr=err)
+        self.assertEqual(USBDevice.objects.filter(name__startswith='usb-').count(), 25)
+        self.assertIn('26行目', err.getvalue())
+        inserts = [q for q in ctx.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 3)
+
+    def test_rental_export_streams(self):
+        device = USBDevice.objects.get(name='existing')
+        for _ in range(3):
+            RentalRequest.objects.create(usb_device=device, user=self.user, is_returned=True)
+
+        response = self.client.get(reverse('inventory_export', args=['rentals']), {'format': 'jsonl'})
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['usb_device'] for row in rows], ['existing'] * 3)
+        self.assertEqual(rows[0]['user'], 'alice')
+
+        response = self.client.get(reverse('inventory_export', args=['devices']))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], ','.join(DEVICE_COLUMNS))
+        self.assertEqual(len(lines), 2)
+
+
+class ManufacturerWhitelistTests(LoggedInMixin, TestCase):
+    """ホワイトリストのキャッシュと、デバイス登録・レンタル時の強制を確認する"""
+
+    def setUp(self):
+        super().setUp()
+        whitelist.invalidate()
+        self.allowed = whitelisted_manufacturer('allowed')
+        self.blocked = Manufacturer.objects.create(name='blocked')
+
+    def test_ids_are_cached_and_invalidated_by_signals(self):
+        self.assertEqual(whitelisted_manufacturer_ids(), {self.allowed.id})
+        with self.assertNumQueries(0):
+            whitelisted_manufacturer_ids()
+
+        entry = ManufacturerWhitelist.objects.create(manufacturer=self.blocked)
+        self.assertEqual(whitelisted_manufacturer_ids(), {self.allowed.id, self.blocked.id})
+        entry.delete()
+        self.assertEqual(whitelisted_manufacturer_ids(), {self.allowed.id})
+        self.allowed.delete()
+        self.assertEqual(whitelisted_manufacturer_ids(), set())
+
+    def test_duplicate_entry_is_rejected(self):
+        form = ManufacturerWhitelistForm(data={'manufacturer': self.allowed.id})
+        self.assertFalse(form.is_valid())
+        self.assertIn("既にホワイトリストに登録されています", str(form.errors))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ManufacturerWhitelist.objects.create(manufacturer=self.allowed)
+
+    def test_device_registration_requires_whitelisted_manufacturer(self):
+        response = self.client.post(reverse('usb_device_create'), {'name': 'usb-1', 'manufacturer': self.blocked.id})
+        self.assertContains(response, "ホワイトリストに登録されたメーカーを選択してください")
+        response = self.client.post(reverse('usb_device_create'), {'name': 'usb-1', 'manufacturer': self.allowed.id})
+        self.assertRedirects(response, reverse('usb_list'))
+
+    def test_rental_of_non_whitelisted_device_is_refused(self):
+        today = timezone.now().date()
+        approver = User.objects.create_user(username='approver', password='pass12345', email='approver@example.com')
+        pc = self.create_pc()
+        device = USBDevice.objects.create(name='usb', manufacturer=self.blocked)
+        response = self.client.post(reverse('request_rental', args=[device.id]), {
+            'start_date': today, 'end_date': today, 'approver': approver.id, 'pc': pc.id,
+        })
+        self.assertContains(response, "ホワイトリストに登録されていないため", status_code=409)
+        device.refresh_from_db()
+        self.assertTrue(device.is_available)
+
+    def test_whitelist_page_query_count_is_constant(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.get(reverse('whitelist_list'))
+            return len(ctx.captured_queries)
+
+        small = count_queries()
+        for i in range(20):
+            whitelisted_manufacturer(f'maker-{i}')
+        self.assertEqual(count_queries(), small)
+
+
+class OverdueCacheTests(LoggedInMixin, TestCase):
+    """返却期限切れ警告のキャッシュが、返却・延長・日付の変わり目で正しく更新されることを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.device = USBDevice.objects.create(name='usb', is_available=False)
+        self.rental = RentalRequest.objects.create(
+            usb_device=self.device, user=self.user,
+            start_date=self.today - timedelta(days=10), end_date=self.today - timedelta(days=1),
+        )
+
+    def overdue_names(self):
+        response = self.client.get(reverse('usb_list'))
+        return [rental['usb_device_name'] for rental in response.context['overdue_rentals']]
+
+    def test_cached_until_return(self):
+        self.assertEqual(self.overdue_names(), ['usb'])
+        with CaptureQueriesContext(connection) as ctx:
+            self.overdue_names()
+        self.assertFalse(any('"end_date" <' in q['sql'] for q in ctx.captured_queries))
+
+        self.client.post(reverse('return_usb', args=[self.device.id]), {'comments': ''})
+        self.assertEqual(self.overdue_names(), [])
+
+    def test_extension_invalidates(self):
+        self.assertEqual(self.overdue_names(), ['usb'])
+        self.client.post(reverse('extension_request', args=[self.rental.id]), {
+            'new_end_date': self.today + timedelta(days=3),
+        })
+        self.assertEqual(self.overdue_names(), [])
+
+    def test_date_rollover_recomputes(self):
+        RentalRequest.objects.filter(id=self.rental.id).update(end_date=self.today)
+        self.assertEqual(self.overdue_names(), [])
+        tomorrow = timezone.now() + timedelta(days=1)
+        with patch('django.utils.timezone.now', return_value=tomorrow):
+            self.assertEqual(self.overdue_names(), ['usb'])
+
+
+class ConditionalGetTests(LoggedInMixin, TestCase):
+    """変更が無ければ304を返し、レンタルやデバイスの変更でETagと断片キャッシュが更新されることを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.device = USBDevice.objects.create(name='usb', manufacturer=whitelisted_manufacturer())
+        self.pc = self.create_pc()
+
+    def revalidate(self, url):
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('no-cache', first['Cache-Control'])
+        return first, self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+
+    def test_device_detail_returns_304_until_rented(self):
+        url = reverse('usb_device_detail', args=[self.device.id])
+        first, second = self.revalidate(url)
+        self.assertEqual(second.status_code, 304)
+        self.assertTrue(first.has_header('Last-Modified'))
+
+        self.client.post(reverse('request_rental', args=[self.device.id]), {
+            'approver': self.user.id, 'pc': self.pc.id, 'start_date': self.today, 'end_date': self.today,
+        })
+        third = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(third.status_code, 200)
+        self.assertContains(third, '現在のレンタル情報')
+
+    def test_device_list_returns_304_until_device_added(self):
+        first, second = self.revalidate(reverse('usb_list'))
+        self.assertEqual(second.status_code, 304)
+        USBDevice.objects.create(name='usb-2')
+        third = self.client.get(reverse('usb_list'), HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(third.status_code, 200)
+        self.assertContains(third, 'usb-2')
+
+    def test_history_fragment_is_cached_until_return(self):
+        RentalRequest.objects.create(usb_device=self.device, user=self.user, start_date=self.today, end_date=self.today)
+        USBDevice.objects.filter(id=self.device.id).update(is_available=False)
+        url = reverse('usb_device_detail', args=[self.device.id])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertContains(response, '現在のレンタル情報')
+        self.assertFalse(any('main_app_rentalrequest' in q['sql'] for q in ctx.captured_queries))
+
+        self.client.post(reverse('return_usb', args=[self.device.id]), {'comments': ''})
+        response = self.client.get(url)
+        self.assertNotContains(response, '現在のレンタル情報')
+        self.assertContains(response, '返却済み:</strong> はい')
+
+
+class JsonApiTests(LoggedInMixin, TestCase):
+    """JSON一覧APIの項目選択とカーソルによるページ送りを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create(username='bob', email='bob@example.com')
+        maker = whitelisted_manufacturer()
+        for i in range(25):
+            USBDevice.objects.create(name=f'usb-{i:02d}', manufacturer=maker, capacity=i)
+
+    def test_devices_walk_all_pages_with_selected_fields(self):
+        seen = []
+        params = {'fields': 'name,manufacturer', 'limit': 10}
+        while True:
+            with self.assertNumQueries(3):  # セッション・ユーザー・一覧の1回のみ
+                data = self.client.get(reverse('api_devices'), params).json()
+            seen.extend(data['results'])
+            if not data['next_cursor']:
+                break
+            params['cursor'] = data['next_cursor']
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(seen[0], {'name': 'usb-00', 'manufacturer': 'maker'})
+
+    def test_invalid_parameters_return_400(self):
+        self.assertEqual(self.client.get(reverse('api_devices'), {'fields': 'password'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api_devices'), {'limit': 0}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api_rentals'), {'cursor': 'broken'}).status_code, 400)
+        for name in ('api_rentals', 'api_archived_rentals'):
+            for value in ('abc', '0', str(2 ** 63)):
+                response = self.client.get(reverse(name), {'usb_device': value})
+                self.assertEqual(response.status_code, 400, (name, value))
+                self.assertIn('usb_device', response.json()['error'])
+            self.assertEqual(self.client.get(reverse(name), {'usb_device': '1'}).status_code, 200)
+
+    def test_pcs_are_limited_to_login_user_and_login_is_required(self):
+        self.create_pc('mine')
+        UserPC.objects.create(user=self.other, serial_number='theirs', antivirus_version='1.0')
+        data = self.client.get(reverse('api_user_pcs'), {'fields': 'serial_number'}).json()
+        self.assertEqual(data['results'], [{'serial_number': 'mine'}])
+
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('api_whitelist')).status_code, 403)
+
+
+class RentalArchiveTests(LoggedInMixin, TestCase):
+    """古い返却済みレンタルがアーカイブへ移され、履歴では両方のテーブルが1つに見えることを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.device = USBDevice.objects.create(name='usb', is_available=False)
+        # 古い返却済み・最近の返却済み・開始日なし・未返却を混ぜる
+        for i in range(30):
+            start = None if i % 9 == 0 else self.today - timedelta(days=800 - i * 20)
+            RentalRequest.objects.create(
+                usb_device=self.device, user=self.user, start_date=start,
+                end_date=(start or self.today - timedelta(days=600)) + timedelta(days=7), is_returned=True,
+            )
+        self.active = RentalRequest.objects.create(
+            usb_device=self.device, user=self.user, start_date=self.today - timedelta(days=900), end_date=self.today,
+        )
+
+    def history_ids(self):
+        ids, params = [], {}
+        while True:
+            page = self.client.get(reverse('usb_device_detail', args=[self.device.id]), params).context['history_page']
+            ids.extend(rental.id for rental in page.object_list)
+            if not page.has_next():
+                return ids
+            params = {'history_cursor': page.next_cursor}
+
+    def test_archive_moves_old_returned_rentals_in_batches(self):
+        before = self.history_ids()
+        out = StringIO()
+        with CaptureQueriesContext(connection) as ctx:
+            call_command('archive_rentals', '--older-than-days=365', '--batch-size=4', stdout=out)
+
+        archived = set(ArchivedRentalRequest.objects.values_list('id', flat=True))
+        self.assertTrue(archived)
+        # バッチごとに1回のDELETEで消す（行ごとのシグナルによるUPDATEは走らない）
+        deletes = [q for q in ctx.captured_queries if q['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), -(-len(archived) // 4))
+        self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE')])
+        self.assertFalse(RentalRequest.objects.filter(id__in=archived).exists())
+        self.assertTrue(RentalRequest.objects.filter(id=self.active.id).exists())
+        self.assertFalse(RentalRequest.objects.filter(
+            is_returned=True, end_date__lt=self.today - timedelta(days=365)
+        ).exists())
+        self.assertIn("4件をアーカイブしました", out.getvalue())
+
+        cache.clear()
+        self.assertEqual(self.history_ids(), before)
+        self.assertEqual(len(before), 31)
+
+    def test_export_includes_archived_rentals(self):
+        call_command('archive_rentals', '--older-than-days=365', stdout=StringIO())
+        response = self.client.get(reverse('inventory_export', args=['rentals']), {'format': 'jsonl'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(rows), 31)
+        self.assertTrue(all(row['is_returned'] for row in rows if row['id'] != self.active.id))
+
+
+class UsageRollupTests(LoggedInMixin, TestCase):
+    """日次集計が変更のあった日だけ作り直され、レポートが集計テーブルだけを読むことを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.now = timezone.now()
+        self.today = self.now.date()
+        maker_a = Manufacturer.objects.create(name='maker-a')
+        maker_b = Manufacturer.objects.create(name='maker-b')
+        self.d1 = USBDevice.objects.create(name='usb-1', manufacturer=maker_a, capacity=16 * 1000 ** 3)
+        self.d2 = USBDevice.objects.create(name='usb-2', manufacturer=maker_b, is_available=False)
+        day = lambda n: self.today - timedelta(days=n)
+        # 返却期日の2日後に返却: 貸出8日、期限切れ2日
+        RentalRequest.objects.create(
+            usb_device=self.d1, user=self.user, start_date=day(10), end_date=day(5),
+            is_returned=True, returned_at=self.now - timedelta(days=3),
+        )
+        # アーカイブ済み（返却日時の記録なし）: 貸出3日
+        ArchivedRentalRequest.objects.create(
+            id=10 ** 9, usb_device=self.d1, user=self.user, requested_at=self.now,
+            start_date=day(20), end_date=day(18),
+        )
+        # 貸出中で期限切れ: 昨日までで貸出4日、期限切れ1日
+        self.active = RentalRequest.objects.create(
+            usb_device=self.d2, user=self.user, start_date=day(4), end_date=day(2),
+        )
+
+    def report(self):
+        rows = manufacturer_report(self.today - timedelta(days=30), self.today - timedelta(days=1))
+        return {row['manufacturer__name']: (row['rented_days'], row['overdue_days']) for row in rows}
+
+    def test_rollups_are_incremental(self):
+        self.assertEqual(refresh_rollups(now=self.now), 20)
+        self.assertEqual(self.report(), {'maker-a': (11, 2), 'maker-b': (4, 1)})
+        bands = {row['capacity_band']: row['rented_days'] for row in capacity_band_report(
+            self.today - timedelta(days=30), self.today)}
+        self.assertEqual(bands, {'le32g': 11, 'unknown': 4})
+
+        # 変更が無ければ何も作り直さない
+        RentalRequest.objects.update(updated_at=self.now - timedelta(hours=1))
+        self.assertEqual(refresh_rollups(now=self.now), 0)
+
+        # 延長されたレンタルは開始日から昨日までを作り直す
+        self.active.end_date = self.today + timedelta(days=5)
+        self.active.save()
+        self.assertEqual(refresh_rollups(), 4)
+        self.assertEqual(self.report(), {'maker-a': (11, 2), 'maker-b': (4, 0)})
+
+        # 日付が進めば、その日の分だけを集計する
+        RentalRequest.objects.update(updated_at=self.now - timedelta(hours=1))
+        self.assertEqual(refresh_rollups(now=self.now + timedelta(days=1)), 1)
+
+    def settle(self):
+        # ここまでの変更は前回の集計に反映済みとする
+        RentalRequest.objects.update(updated_at=self.now - timedelta(hours=1))
+        RentalEvent.objects.update(created_at=self.now - timedelta(hours=1))
+
+    def test_changed_rentals_rebuild_from_the_changed_day(self):
+        approver = User.objects.create(username='approver')
+        rental = RentalRequest.objects.create(
+            usb_device=USBDevice.objects.create(name='usb-3', is_available=False), user=self.user, approver=approver,
+            start_date=self.today - timedelta(days=40), end_date=self.today - timedelta(days=10),
+        )
+        rental_log.record(RentalEvent.RENTED, rental)
+        refresh_rollups(now=self.now)
+        self.settle()
+
+        # 延長は変更前の返却期日の翌日からだけを作り直す（開始日からの40日ではない）
+        lending.extend_rental(rental, self.today + timedelta(days=5))
+        self.assertEqual(refresh_rollups(now=self.now), 9)
+        self.settle()
+        # 承認は集計に影響せず、今日の返却は昨日までの集計を変えない
+        self.assertEqual(len(lending.decide(approver, [rental.id], approve=True)), 1)
+        self.assertEqual(refresh_rollups(now=self.now), 0)
+        self.settle()
+        lending.return_rental(rental)
+        self.assertEqual(refresh_rollups(now=self.now), 0)
+
+        # 差分だけの作り直しでも、全てを作り直した結果と一致する
+        period = (self.today - timedelta(days=60), self.today - timedelta(days=1))
+        incremental = (manufacturer_report(*period), device_report(*period))
+        refresh_rollups(since=period[0], now=self.now)
+        self.assertEqual((manufacturer_report(*period), device_report(*period)), incremental)
+        self.assertEqual(device_report(*period)[0]['overdue_days'], 0)
+
+    def test_device_report_reads_months_and_edge_days(self):
+        RentalRequest.objects.create(
+            usb_device=self.d2, user=self.user, start_date=self.today - timedelta(days=120),
+            end_date=self.today - timedelta(days=90), is_returned=True, returned_at=self.now - timedelta(days=60),
+        )
+        refresh_rollups(now=self.now)
+        self.assertTrue(DeviceUsageMonth.objects.exists())
+
+        day = lambda n: self.today - timedelta(days=n)
+        for first, last in [(day(115), day(3)), (day(100), day(95)), (day(60).replace(day=1), day(1)), (day(200), day(1))]:
+            expected = {
+                row['usb_device_id']: (row['rented_days'], row['overdue_days'])
+                for row in DeviceUsageDay.objects.filter(day__range=(first, last)).values('usb_device_id')
+                .annotate(rented_days=Count('id'), overdue_days=Count('id', filter=Q(overdue=True)))
+            }
+            with CaptureQueriesContext(connection) as ctx:
+                rows = device_report(first, last)
+            self.assertEqual({row['usb_device_id']: (row['rented_days'], row['overdue_days']) for row in rows}, expected)
+            self.assertLessEqual(len(ctx.captured_queries), 2)
+
+    def test_report_reads_only_rollups(self):
+        refresh_rollups(now=self.now)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('usage_report'))
+        self.assertContains(response, 'maker-a')
+        self.assertFalse(any('rentalrequest' in q['sql'] for q in ctx.captured_queries))
+
+        response = self.client.get(reverse('usage_report_export', args=['devices']), {
+            'start_date': self.today - timedelta(days=30), 'end_date': self.today,
+        })
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'usb_device_id,usb_device,rented_days,overdue_days,overdue_rate')
+        self.assertEqual(lines[1], f'{self.d1.id},usb-1,11,2,0.1818')
+
+
+class SeedAndBenchmarkTests(TestCase):
+    """合成データの登録と、ベースラインとの比較で悪化を検出できることを確認する"""
+
+    def test_seed_data_respects_constraints(self):
+        call_command('seed_data', '--devices=200', '--rentals=1000', '--users=30', '--reservations=50', stdout=StringIO())
+        self.assertEqual(USBDevice.objects.count(), 200)
+        self.assertEqual(RentalRequest.objects.count(), 1000)
+        # 未返却レンタルのあるデバイスだけが貸出中になっている
+        self.assertEqual(
+            USBDevice.objects.filter(is_available=False).count(),
+            RentalRequest.objects.filter(is_returned=False).count(),
+        )
+        self.assertFalse(RentalRequest.objects.filter(is_returned=True, returned_at__isnull=True).exists())
+        # 操作の記録を再生した貸出状況もデバイスと一致する
+        self.assertEqual(rental_log.mismatches(rental_log.rebuild()[0]), [])
+        with self.assertRaisesMessage(CommandError, '既に登録されています'):
+            call_command('seed_data', '--devices=1', stdout=StringIO())
+
+    def test_benchmark_fails_on_query_regression(self):
+        call_command('seed_data', '--devices=50', '--rentals=200', '--users=10', stdout=StringIO())
+        baseline = Path(self.enterContext(tempfile.TemporaryDirectory())) / 'baseline.json'
+        # 数回の計測ではレイテンシが揺らぐため、この試験ではクエリ数の比較だけを有効にする
+        args = [
+            'benchmark_routes', '--routes=usb_list,return_usb', '--requests=3', '--warmup=1', f'--baseline={baseline}',
+            '--min-delta-ms=1000',
+        ]
+        call_command(*args, '--save-baseline', stdout=StringIO())
+        saved = json.loads(baseline.read_text())
+        self.assertEqual(set(saved), {'usb_list', 'return_usb'})
+
+        call_command(*args, stdout=StringIO())  # 同じ条件なら悪化なし
+        saved['usb_list']['queries'] -= 1
+        baseline.write_text(json.dumps(saved))
+        with self.assertRaisesMessage(CommandError, 'usb_list: クエリ数'):
+            call_command(*args, stdout=StringIO())
+
+
+class RequestMetricsTests(LoggedInMixin, TestCase):
+    """リクエストの計測値が Server-Timing ヘッダー・ログ・ルートごとの集計に出ることを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        instrumentation.reset()
+
+    def timings(self, response):
+        entries = {}
+        for entry in response['Server-Timing'].split(', '):
+            name, *params = entry.split(';')
+            entries[name] = dict(param.split('=', 1) for param in params)
+        return entries
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse('usb_list'))
+        timings = self.timings(response)
+        self.assertEqual(set(timings), {'db', 'dup', 'view', 'tpl', 'total'})
+        self.assertRegex(timings['db']['desc'], r'^"SQL [1-9]\d* queries"$')
+        self.assertGreater(float(timings['tpl']['dur']), 0)
+
+    def test_duplicate_fingerprints_ignore_in_list_length(self):
+        metrics = instrumentation.RequestMetrics()
+        for sql in ('SELECT 1 WHERE id IN (%s, %s)', 'SELECT 1 WHERE id IN (%s, %s, %s)', 'SELECT 2'):
+            metrics.queries.append((0.001, sql))
+        [(count, sql)] = metrics.duplicates().values()
+        self.assertEqual((count, sql), (2, 'SELECT 1 WHERE id IN (%s, ...)'))
+
+    @override_settings(SLOW_REQUEST_MS=0)
+    def test_slow_request_is_logged_with_worst_queries(self):
+        with self.assertLogs('main_app.instrumentation', 'WARNING') as logs:
+            self.client.get(reverse('usb_list'))
+        self.assertIn('usb_list', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    def test_metrics_endpoint_aggregates_per_route(self):
+        for _ in range(3):
+            self.client.get(reverse('usb_list'))
+        # スタッフ以外はループバックからでも参照できない（同じホストのリバースプロキシ経由を想定）
+        self.assertEqual(self.client.get(reverse('request_metrics'), REMOTE_ADDR='127.0.0.1').status_code, 403)
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        body = self.client.get(reverse('request_metrics')).content.decode()
+        self.assertIn('main_app_request_duration_ms_count{route="usb_list"} 3', body)
+        self.assertIn('main_app_request_duration_ms_bucket{route="usb_list",le="+Inf"} 3', body)
+
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('request_metrics')).status_code, 403)
+        with self.settings(METRICS_TOKEN='secret'):
+            response = self.client.get(reverse('request_metrics'), HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(reverse('request_metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, 403)
+
+
+def async_urlconf():
+    """読み取りの多いページを非同期ビューに差し替えたURL設定（ASGIでの構成と同じ）"""
+    urlconf = ModuleType('async_urls')
+    urlconf.urlpatterns = [
+        path('', include(build_urlpatterns(async_reads=True))),
+        path('accounts/', include('django.contrib.auth.urls')),
+    ]
+    return urlconf
+
+
+class AsyncReadViewTests(LoggedInMixin, TestCase):
+    """非同期ビューが同期ビューと同じ内容を返し、ログイン確認と304も同じように働くことを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.async_client.force_login(self.user)
+        maker = whitelisted_manufacturer()
+        self.devices = [USBDevice.objects.create(name=f'usb-{i:02d}', manufacturer=maker) for i in range(3)]
+        pc = self.create_pc()
+        RentalRequest.objects.create(
+            usb_device=self.devices[0], user=self.user, pc=pc,
+            start_date=self.today - timedelta(days=3), end_date=self.today - timedelta(days=1),
+        )
+        self.urls = [
+            reverse('usb_list'), reverse('usb_device_detail', args=[self.devices[0].id]),
+            reverse('user_pc_list'), reverse('whitelist_list'),
+            reverse('api_devices'), reverse('api_rentals') + '?active=1', reverse('api_user_pcs'),
+            reverse('usb_list') + '?q=usb-01', reverse('api_device_search') + '?q=usb',
+        ]
+        self.expected = {url: self.client.get(url).content for url in self.urls}
+        cache.clear()  # 非同期ビューでも断片キャッシュが無い状態から描画させる
+
+    async def test_same_content_as_sync_views(self):
+        with override_settings(ROOT_URLCONF=async_urlconf()):
+            for url in self.urls:
+                response = await self.async_client.get(url)
+                self.assertEqual(response.status_code, 200, url)
+                self.assertEqual(response.content, self.expected[url], url)
+                self.assertTrue(response.has_header('Server-Timing'), url)
+
+    async def test_conditional_get_returns_304(self):
+        with override_settings(ROOT_URLCONF=async_urlconf()):
+            for url in self.urls[:2]:
+                first = await self.async_client.get(url)
+                self.assertIn('no-cache', first['Cache-Control'])
+                second = await self.async_client.get(url, headers={'If-None-Match': first['ETag']})
+                self.assertEqual(second.status_code, 304, url)
+            missing = await self.async_client.get(reverse('usb_device_detail', args=[0]))
+            self.assertEqual(missing.status_code, 404)
+
+    async def test_login_is_required(self):
+        await self.async_client.alogout()
+        with override_settings(ROOT_URLCONF=async_urlconf()):
+            response = await self.async_client.get(reverse('usb_list'))
+            self.assertEqual(response.status_code, 302)
+            self.assertIn('/accounts/login/', response['Location'])
+            response = await self.async_client.get(reverse('api_devices'))
+            self.assertEqual(response.status_code, 403)
+
+
+@patch.object(routers, 'replica_configured', lambda: True)
+class ReplicaRoutingTests(SimpleTestCase):
+    """読み取りは安全なメソッドのリクエストだけ複製に向き、書き込みの後は書き込み側に戻ることを確認する"""
+
+    def setUp(self):
+        self.router = routers.PrimaryReplicaRouter()
+        self.factory = RequestFactory()
+
+    def call(self, request, write=False):
+        seen = []
+
+        def view(request):
+            seen.append(self.router.db_for_read(USBDevice))
+            if write:
+                self.router.db_for_write(USBDevice)
+                seen.append(self.router.db_for_read(USBDevice))
+            return HttpResponse()
+
+        response = routers.ReplicaRoutingMiddleware(view)(request)
+        return seen, response
+
+    def test_safe_request_reads_from_replica_until_it_writes(self):
+        seen, response = self.call(self.factory.get('/'))
+        self.assertEqual(seen, ['replica'])
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+        seen, response = self.call(self.factory.get('/'), write=True)
+        self.assertEqual(seen, ['replica', 'default'])
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+
+    def test_post_and_pinned_requests_read_from_primary(self):
+        seen, response = self.call(self.factory.post('/'))
+        self.assertEqual(seen, ['default'])
+        self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], settings.DATABASE_REPLICA_PIN_SECONDS)
+
+        request = self.factory.get('/')
+        request.COOKIES[routers.PIN_COOKIE] = '1'
+        self.assertEqual(self.call(request)[0], ['default'])
+
+    def test_reads_outside_requests_and_sessions_use_primary(self):
+        self.assertEqual(self.router.db_for_read(USBDevice), 'default')
+        response = routers.ReplicaRoutingMiddleware(
+            lambda request: HttpResponse(self.router.db_for_read(Session))
+        )(self.factory.get('/'))
+        self.assertEqual(response.content, b'default')
+        self.assertIs(self.router.allow_migrate('replica', 'main_app'), False)
+
+
+class DatabaseConnectionTests(TransactionTestCase):
+    """接続の作成時にWALとロック待ちの設定が適用され、複製を書き込み側から作れることを確認する"""
+
+    def test_pragmas_are_applied_on_connect(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_BUSY_TIMEOUT_MS)
+
+    def test_sync_replica_copies_primary(self):
+        USBDevice.objects.create(name='replicated')
+        with tempfile.TemporaryDirectory() as tmp:
+            replica = Path(tmp) / 'replica.sqlite3'
+            with patch.dict(settings.DATABASES, {'replica': {**settings.DATABASES['default'], 'NAME': replica}}):
+                call_command('sync_replica', stdout=StringIO())
+            target = sqlite3.connect(replica)
+            try:
+                names = [row[0] for row in target.execute('SELECT name FROM main_app_usbdevice')]
+            finally:
+                target.close()
+        self.assertEqual(names, ['replicated'])
+
+
+class DeviceSearchTests(LoggedInMixin, TestCase):
+    """全文検索の索引がデバイスとメーカーの変更に追従し、関連度順に検索できることを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.sandisk = whitelisted_manufacturer('SanDisk')
+        self.kioxia = whitelisted_manufacturer('KIOXIA')
+        self.by_name = USBDevice.objects.create(name='Extreme Pro 128', manufacturer=self.sandisk)
+        self.by_description = USBDevice.objects.create(
+            name='Generic 64', description='Extreme temperature rated', manufacturer=self.kioxia,
+        )
+        self.japanese = USBDevice.objects.create(
+            name='社内配布用', description='暗号化機能付きの高速USBメモリ', manufacturer=self.kioxia,
+        )
+
+    def names(self, query):
+        return [device.name for device in rank_devices(USBDevice.objects.all(), query, 10)]
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.names('extreme'), ['Extreme Pro 128', 'Generic 64'])
+        self.assertEqual(self.names('extreme sandisk'), ['Extreme Pro 128'])
+
+    def test_japanese_and_short_terms(self):
+        self.assertEqual(self.names('暗号化'), ['社内配布用'])
+        self.assertEqual(self.names('高速 64'), [])
+        self.assertEqual(self.names('64'), ['Generic 64'])
+        # FTS5 の演算子や引用符は検索語として扱う
+        self.assertEqual(self.names('"extreme" OR NEAR(*'), [])
+
+    def test_index_follows_updates_deletes_and_manufacturer_renames(self):
+        self.by_name.name = 'Ultra Fit 32'
+        self.by_name.save()
+        self.assertEqual(self.names('extreme'), ['Generic 64'])
+        self.assertEqual(self.names('ultra'), ['Ultra Fit 32'])
+
+        self.by_description.delete()
+        self.assertEqual(self.names('extreme'), [])
+
+        self.kioxia.name = 'Toshiba Memory'
+        self.kioxia.save()
+        self.assertEqual(self.names('toshiba'), ['社内配布用'])
+        self.assertEqual(self.names('kioxia'), [])
+
+    def test_bulk_import_is_indexed(self):
+        csv_file = SimpleUploadedFile('devices.csv', 'name,manufacturer,description\nImported 8,SanDisk,防水仕様のモデル\n'.encode())
+        self.client.post(reverse('usb_device_import'), {'file': csv_file, 'format': 'csv'})
+        self.assertEqual(self.names('防水仕様'), ['Imported 8'])
+
+    def test_list_page_search_box(self):
+        response = self.client.get(reverse('usb_list'), {'q': 'extreme'})
+        self.assertEqual([d.name for d in response.context['usb_devices']], ['Extreme Pro 128', 'Generic 64'])
+        self.assertContains(response, 'value="extreme"')
+        self.assertContains(self.client.get(reverse('usb_list'), {'q': 'missing'}), '検索語に一致するUSBデバイスはありません')
+
+    def test_search_api_is_ranked_and_constant_in_queries(self):
+        with self.assertNumQueries(4):  # セッション・ユーザー・索引・デバイスの読み込み
+            data = self.client.get(reverse('api_device_search'), {'q': 'extreme', 'fields': 'name,manufacturer'}).json()
+        self.assertEqual([r['name'] for r in data['results']], ['Extreme Pro 128', 'Generic 64'])
+        self.assertEqual(data['results'][0]['manufacturer'], 'SanDisk')
+        self.assertLess(data['results'][0]['score'], data['results'][1]['score'])
+        self.assertEqual(self.client.get(reverse('api_device_search')).status_code, 400)
+
+
+class DeviceFacetTests(LoggedInMixin, TestCase):
+    """一覧の絞り込みと、全てのファセットの件数が1回の集計クエリで求まることを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.maker_a = whitelisted_manufacturer('A')
+        self.maker_b = whitelisted_manufacturer('B')
+        gb = 1000 ** 3
+        for name, maker, capacity, purchased, available in [
+            ('a-8', self.maker_a, 8 * gb, '2023-03-01', True),
+            ('a-64', self.maker_a, 64 * gb, '2024-06-01', False),
+            ('a-none', self.maker_a, None, None, True),
+            ('b-16', self.maker_b, 16 * gb, '2024-01-15', True),
+            ('b-1t', self.maker_b, 1000 * gb, '2024-12-31', True),
+        ]:
+            USBDevice.objects.create(
+                name=name, manufacturer=maker, capacity=capacity, purchase_date=purchased, is_available=available,
+            )
+
+    def get(self, **params):
+        return self.client.get(reverse('usb_list'), params)
+
+    def names(self, response):
+        return sorted(device.name for device in response.context['usb_devices'])
+
+    def counts(self, items, key):
+        return {item[key]: item['count'] for item in items}
+
+    def test_filters_narrow_the_list(self):
+        self.assertEqual(self.names(self.get(manufacturer=self.maker_a.id)), ['a-64', 'a-8', 'a-none'])
+        self.assertEqual(self.names(self.get(capacity_from='le32g', capacity_to='le128g')), ['a-64', 'b-16'])
+        self.assertEqual(self.names(self.get(purchased_from='2024-01-01', purchased_to='2024-06-30')), ['a-64', 'b-16'])
+        self.assertEqual(self.names(self.get(availability='rented')), ['a-64'])
+        self.assertEqual(self.names(self.get(manufacturer=self.maker_b.id, availability='available', capacity_to='le32g')), ['b-16'])
+
+    def test_search_applies_filters_before_ranking(self):
+        # 絞り込みの外に関連度の上位（表示件数を超える数）があっても、条件に合うデバイスが漏れない
+        for i in range(60):
+            USBDevice.objects.create(name=f'alpha-b-{i:02d}', manufacturer=self.maker_b)
+        for i in range(5):
+            USBDevice.objects.create(name=f'alpha-a-spare-{i}', manufacturer=self.maker_a, description='予備のデバイス')
+        names = self.names(self.get(q='alpha', manufacturer=self.maker_a.id))
+        self.assertEqual(names, [f'alpha-a-spare-{i}' for i in range(5)])
+        self.assertEqual(len(self.get(q='alpha', manufacturer=self.maker_a.id, availability='rented').context['usb_devices']), 0)
+
+    def test_facet_counts_exclude_their_own_selection(self):
+        facets = self.get(manufacturer=self.maker_a.id, purchased_from='2024-01-01').context['facets']
+        self.assertEqual(facets['total'], 1)  # a-64 のみ
+        # メーカーの件数はメーカー以外の条件（2024年以降の購入）だけで数える
+        self.assertEqual(self.counts(facets['manufacturer'], 'name'), {'A': 1, 'B': 2})
+        # 購入年の件数は購入日以外の条件（メーカーA）だけで数える
+        self.assertEqual(self.counts(facets['purchased'], 'year'), {2024: 1, 2023: 1, None: 1})
+        self.assertEqual(self.counts(facets['capacity'], 'key')['le128g'], 1)
+        self.assertEqual(self.counts(facets['availability'], 'value'), {'available': 0, 'rented': 1})
+
+    def test_all_facets_come_from_one_aggregate_query(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.get(manufacturer=[self.maker_a.id, self.maker_b.id], capacity_from='le8g', availability='available')
+        grouped = [q['sql'] for q in ctx.captured_queries if 'GROUP BY' in q['sql']]
+        self.assertEqual(len(grouped), 1)
+        # 2回目はデバイスが変わるまでキャッシュを使う
+        with CaptureQueriesContext(connection) as ctx:
+            self.get(manufacturer=[self.maker_a.id, self.maker_b.id], capacity_from='le8g', availability='available')
+        self.assertFalse(any('GROUP BY' in q['sql'] for q in ctx.captured_queries))
+
+    def test_invalid_filters_are_reported_and_ignored(self):
+        response = self.get(purchased_from='2024-12-31', purchased_to='2024-01-01', manufacturer='x')
+        self.assertEqual(len(response.context['usb_devices']), 5)
+        self.assertContains(response, '購入日の終わりは始まりより後の日付を指定してください。')
+        # 64ビットの範囲外や0以下の id は、クエリを実行せずにフォームのエラーにする
+        for value in ('99999999999999999999999', '0', '-1'):
+            response = self.get(manufacturer=value)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.context['usb_devices']), 5)
+            self.assertContains(response, 'id が範囲外です。')
+
+    def test_next_page_link_keeps_filters(self):
+        for i in range(60):
+            USBDevice.objects.create(name=f'z-{i:02d}', manufacturer=self.maker_b, is_available=True)
+        response = self.get(manufacturer=self.maker_b.id)
+        next_url = f"{reverse('usb_list')}?manufacturer={self.maker_b.id}&cursor={response.context['page_obj'].next_cursor}"
+        self.assertContains(response, f'manufacturer={self.maker_b.id}&amp;cursor=')
+        self.assertTrue(all(d.manufacturer_id == self.maker_b.id for d in self.client.get(next_url).context['usb_devices']))
+
+
+class WaitlistTests(TestCase):
+    """返却されたデバイスが空き待ちの先頭の1人にだけ回り、通知か自動申請が同じトランザクションで行われることを確認する"""
+
+    def setUp(self):
+        self.today = timezone.now().date()
+        self.renter = User.objects.create(username='alice', email='alice@example.com')
+        self.waiter = User.objects.create(username='bob', email='bob@example.com')
+        self.third = User.objects.create(username='carol', email='carol@example.com')
+        self.approver = User.objects.create(username='approver', email='approver@example.com')
+        self.pc = UserPC.objects.create(user=self.waiter, serial_number='pc-bob', antivirus_version='1.0')
+        self.device = USBDevice.objects.create(name='popular', manufacturer=whitelisted_manufacturer(), is_available=False)
+        RentalRequest.objects.create(
+            usb_device=self.device, user=self.renter, start_date=self.today, end_date=self.today + timedelta(days=3),
+        )
+
+    def join(self, user, **data):
+        self.client.force_login(user)
+        return self.client.post(reverse('waitlist_join', args=[self.device.id]), data)
+
+    def give_back(self):
+        self.client.force_login(self.renter)
+        return self.client.post(reverse('return_usb', args=[self.device.id]), {'comments': ''})
+
+    def test_first_in_line_is_notified(self):
+        self.assertRedirects(self.join(self.waiter), reverse('reservation_list'))
+        self.join(self.third)
+        self.assertEqual(self.client.get(reverse('reservation_list')).context['waitlist_entries'][0].ahead, 1)
+
+        self.assertRedirects(self.give_back(), reverse('usb_list'))
+        self.device.refresh_from_db()
+        self.assertTrue(self.device.is_available)
+        self.assertEqual(list(OutboxEmail.objects.values_list('recipient', flat=True)), ['bob@example.com'])
+        self.assertEqual(list(WaitlistEntry.objects.values_list('user__username', flat=True)), ['carol'])
+        self.assertEqual(list(DeviceEvent.objects.values_list('kind', 'is_available')), [(DeviceEvent.RETURNED, True)])
+
+    def test_auto_reserve_rents_for_the_next_user(self):
+        self.join(self.waiter, auto_reserve='on', rental_days=5, approver=self.approver.id, pc=self.pc.id)
+        self.give_back()
+
+        rental = RentalRequest.objects.get(usb_device=self.device, is_returned=False)
+        self.assertEqual((rental.user, rental.pc, rental.end_date), (self.waiter, self.pc, self.today + timedelta(days=5)))
+        self.device.refresh_from_db()
+        self.assertFalse(self.device.is_available)
+        self.assertEqual(
+            sorted(OutboxEmail.objects.values_list('recipient', flat=True)), ['approver@example.com', 'bob@example.com'],
+        )
+        self.assertEqual(
+            list(DeviceEvent.objects.order_by('id').values_list('kind', flat=True)), [DeviceEvent.RETURNED, DeviceEvent.RENTED],
+        )
+        self.assertFalse(WaitlistEntry.objects.exists())
+
+    def test_auto_reserve_falls_back_to_notification(self):
+        self.join(self.waiter, auto_reserve='on', rental_days=5, approver=self.approver.id, pc=self.pc.id)
+        # 返却までの間に他の人の予約が入った場合は申請せず、通知だけにする
+        Reservation.objects.create(
+            usb_device=self.device, user=self.third, start_date=self.today + timedelta(days=1),
+            end_date=self.today + timedelta(days=2),
+        )
+        self.give_back()
+        self.assertFalse(RentalRequest.objects.filter(is_returned=False).exists())
+        self.device.refresh_from_db()
+        self.assertTrue(self.device.is_available)
+        self.assertEqual(list(OutboxEmail.objects.values_list('recipient', flat=True)), ['bob@example.com'])
+
+    def test_join_is_validated(self):
+        response = self.join(self.waiter, auto_reserve='on')
+        self.assertContains(response, "自動で申請する場合は入力してください。")
+        self.join(self.waiter)
+        self.assertContains(self.join(self.waiter), "既に登録しています")
+        self.assertContains(self.join(self.renter), "既にあなたがレンタルしています")
+        self.device.is_available = True
+        self.device.save()
+        self.assertContains(self.join(self.third), "貸出可能です")
+        self.assertEqual(WaitlistEntry.objects.count(), 1)
+
+    def test_extension_is_recorded_as_event(self):
+        self.client.force_login(self.renter)
+        rental = RentalRequest.objects.get(usb_device=self.device)
+        self.client.post(reverse('extension_request', args=[rental.id]), {'new_end_date': self.today + timedelta(days=9)})
+        self.assertEqual(list(DeviceEvent.objects.values_list('kind', flat=True)), [DeviceEvent.EXTENDED])
+
+    def test_returned_rental_cannot_be_extended(self):
+        self.client.force_login(self.renter)
+        rental = RentalRequest.objects.get(usb_device=self.device)
+        RentalRequest.objects.filter(id=rental.id).update(is_returned=True)
+        url = reverse('extension_request', args=[rental.id])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        response = self.client.post(url, {'new_end_date': self.today + timedelta(days=9)})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(DeviceEvent.objects.exists())
+        self.assertFalse(RentalEvent.objects.filter(kind=RentalEvent.EXTENDED).exists())
+
+
+@override_settings(DEVICE_EVENTS_POLL_SECONDS=0.01, DEVICE_EVENTS_HEARTBEAT_SECONDS=0.2)
+class DeviceEventStreamTests(LoggedInMixin, TestCase):
+    """貸出状況の変化がSSEで配信され、再接続時は Last-Event-ID の続きから送られることを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.async_client.force_login(self.user)
+        self.devices = [USBDevice.objects.create(name=f'usb-{i}') for i in range(2)]
+
+    async def read_until(self, content, marker):
+        """marker を含むチャンクが届くまで読み、それまでのチャンクを返す"""
+        chunks = []
+        while not chunks or marker not in chunks[-1]:
+            chunks.append((await asyncio.wait_for(anext(content), 5)).decode())
+        return chunks
+
+    async def test_events_are_pushed_to_the_stream(self):
+        with override_settings(ROOT_URLCONF=async_urlconf()):
+            response = await self.async_client.get(reverse('device_events'), {'device': self.devices[0].id})
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            content = aiter(response.streaming_content)
+            try:
+                self.assertIn('retry:', (await anext(content)).decode())
+                await DeviceEvent.objects.acreate(usb_device=self.devices[1], kind=DeviceEvent.RENTED, is_available=False)
+                event = await DeviceEvent.objects.acreate(
+                    usb_device=self.devices[0], kind=DeviceEvent.RETURNED, is_available=True,
+                )
+                chunks = await self.read_until(content, f'id: {event.id}')
+                # 絞り込んだデバイス以外のイベントは送られない
+                self.assertFalse(any(f'"device":{self.devices[1].id}' in chunk for chunk in chunks))
+                self.assertIn('"kind":"returned","available":true', chunks[-1])
+                self.assertIn(': keepalive', ''.join(await self.read_until(content, 'keepalive')))
+            finally:
+                await content.aclose()
+
+    async def test_reconnect_resumes_after_last_event_id(self):
+        events = [
+            await DeviceEvent.objects.acreate(usb_device=self.devices[0], kind=kind, is_available=available)
+            for kind, available in [(DeviceEvent.RENTED, False), (DeviceEvent.EXTENDED, False), (DeviceEvent.RETURNED, True)]
+        ]
+        with override_settings(ROOT_URLCONF=async_urlconf()):
+            response = await self.async_client.get(
+                reverse('device_events'), headers={'Last-Event-ID': str(events[0].id)},
+            )
+            content = aiter(response.streaming_content)
+            try:
+                chunks = await self.read_until(content, f'id: {events[2].id}')
+            finally:
+                await content.aclose()
+        sent = [chunk for chunk in chunks if chunk.startswith('id:')]
+        self.assertEqual([chunk.split('\n')[0] for chunk in sent], [f'id: {events[1].id}', f'id: {events[2].id}'])
+
+    def test_wsgi_tells_the_browser_to_stop(self):
+        self.assertEqual(self.client.get(reverse('device_events')).status_code, 204)
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('device_events')).status_code, 403)
+
+    def test_prune_old_events(self):
+        old = DeviceEvent.objects.create(usb_device=self.devices[0], kind=DeviceEvent.RENTED, is_available=False)
+        DeviceEvent.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=2))
+        DeviceEvent.objects.create(usb_device=self.devices[0], kind=DeviceEvent.RETURNED, is_available=True)
+        with CaptureQueriesContext(connection) as ctx:
+            call_command('prune_device_events', stdout=StringIO())
+        self.assertEqual(list(DeviceEvent.objects.values_list('kind', flat=True)), [DeviceEvent.RETURNED])
+        self.assertEqual([q['sql'].split()[0] for q in ctx.captured_queries], ['DELETE'])
+
+
+class ApprovalQueueTests(TestCase):
+    """承認待ちの一覧のクエリ数が件数に比例せず、まとめて承認・却下しても更新とメール登録が1回ずつで済むことを確認する"""
+
+    def setUp(self):
+        self.today = timezone.now().date()
+        self.approver = User.objects.create(username='approver', email='approver@example.com')
+        self.other_approver = User.objects.create(username='other', email='other@example.com')
+        self.users = [User.objects.create(username=f'user-{i}', email=f'user-{i}@example.com') for i in range(2)]
+        self.client.force_login(self.approver)
+        self.maker = whitelisted_manufacturer()
+
+    def create_rentals(self, count, approver=None):
+        rentals = []
+        for i in range(count):
+            user = self.users[i % 2]
+            device = USBDevice.objects.create(name=f'usb-{USBDevice.objects.count()}', manufacturer=self.maker, is_available=False)
+            pc = UserPC.objects.create(user=user, serial_number=f'pc-{device.id}', antivirus_version='1.0')
+            rentals.append(RentalRequest.objects.create(
+                usb_device=device, user=user, pc=pc, approver=approver or self.approver,
+                start_date=self.today, end_date=self.today + timedelta(days=3),
+            ))
+        return rentals
+
+    def decide(self, rentals, action, **extra):
+        return self.client.post(reverse('approval_queue'), {'ids': [r.id for r in rentals], 'action': action, **extra})
+
+    def test_queue_query_count_is_constant(self):
+        self.create_rentals(2)
+        self.create_rentals(1, approver=self.other_approver)
+        with CaptureQueriesContext(connection) as small:
+            response = self.client.get(reverse('approval_queue'))
+        self.assertEqual(len(response.context['rentals']), 2)
+        self.create_rentals(10)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(reverse('approval_queue'))
+        self.assertEqual(len(response.context['rentals']), 12)
+        self.assertEqual(len(small), len(large))
+
+    def test_bulk_approve_updates_once_and_mails_each_requester_once(self):
+        rentals = self.create_rentals(6)
+        foreign = self.create_rentals(1, approver=self.other_approver)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.decide(rentals + foreign, 'approve', comment='返却期日を守ってください')
+        rental_updates = [q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "main_app_rentalrequest"')]
+        outbox_inserts = [q for q in ctx.captured_queries if q['sql'].startswith('INSERT INTO "main_app_outboxemail"')]
+        self.assertEqual((len(rental_updates), len(outbox_inserts)), (1, 1))
+        self.assertRedirects(response, reverse('approval_queue'))
+
+        self.assertEqual(RentalRequest.objects.filter(approved=True, decided_at__isnull=False).count(), 6)
+        self.assertFalse(RentalRequest.objects.get(id=foreign[0].id).approved)
+        self.assertEqual(
+            sorted(OutboxEmail.objects.values_list('recipient', flat=True)), ['user-0@example.com', 'user-1@example.com'],
+        )
+        self.assertIn('返却期日を守ってください', OutboxEmail.objects.first().body)
+        # 判断済みの申請は一覧から消え、もう一度送っても処理されない
+        self.assertEqual(len(self.client.get(reverse('approval_queue')).context['rentals']), 0)
+        self.decide(rentals, 'reject')
+        self.assertEqual(RentalRequest.objects.filter(is_returned=True).count(), 0)
+
+    def test_bulk_reject_frees_devices_and_serves_waitlist(self):
+        rentals = self.create_rentals(3)
+        waiter = User.objects.create(username='waiter', email='waiter@example.com')
+        WaitlistEntry.objects.create(usb_device=rentals[0].usb_device, user=waiter)
+        self.decide(rentals, 'reject')
+
+        self.assertEqual(RentalRequest.objects.filter(is_returned=True, approved=False, decided_at__isnull=False).count(), 3)
+        self.assertFalse(USBDevice.objects.filter(is_available=False).exists())
+        self.assertEqual(DeviceEvent.objects.filter(kind=DeviceEvent.REJECTED).count(), 3)
+        self.assertIn('waiter@example.com', OutboxEmail.objects.values_list('recipient', flat=True))
+        self.assertFalse(WaitlistEntry.objects.exists())
+
+    def test_selection_is_required(self):
+        self.create_rentals(1)
+        response = self.client.post(reverse('approval_queue'), {'action': 'approve'})
+        self.assertContains(response, "申請を1件以上選択してください。")
+        self.assertFalse(RentalRequest.objects.filter(approved=True).exists())
+        response = self.client.post(reverse('approval_queue'), {'action': 'approve', 'ids': ['99999999999999999999999']})
+        self.assertContains(response, "id が範囲外です。")
+
+
+class DashboardTests(LoggedInMixin, TestCase):
+    """ホームページの状況表示がデータ量に関わらず同じクエリ数で組み立てられ、自分の変更ではすぐに更新されることを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create(username='bob', email='bob@example.com')
+        self.pc = self.create_pc('pc-alice')
+
+    def rent(self, end_offset, user=None, approver=None, approved=False):
+        device = USBDevice.objects.create(name=f'usb-{USBDevice.objects.count()}', is_available=False)
+        return RentalRequest.objects.create(
+            usb_device=device, user=user or self.user, pc=self.pc if user is None else None, approver=approver,
+            approved=approved, start_date=self.today - timedelta(days=5), end_date=self.today + timedelta(days=end_offset),
+        )
+
+    def dashboard(self):
+        return self.client.get(reverse('index')).context['dashboard']
+
+    def test_sections(self):
+        overdue = self.rent(-1, approved=True)
+        due_soon = self.rent(2)
+        self.rent(30, approved=True)
+        self.rent(5, user=self.other, approver=self.user)
+        dashboard = self.dashboard()
+
+        self.assertEqual([r['id'] for r in dashboard['overdue']], [overdue.id])
+        self.assertEqual([r['id'] for r in dashboard['due_soon']], [due_soon.id])
+        self.assertEqual([r['id'] for r in dashboard['awaiting_approval']], [due_soon.id])
+        self.assertEqual(len(dashboard['rentals']), 3)
+        self.assertEqual([(pc['serial_number'], pc['active_rentals']) for pc in dashboard['pcs']], [('pc-alice', 3)])
+        self.assertEqual(dashboard['approvals_waiting'], 1)
+
+    def test_query_count_is_fixed_and_cached(self):
+        self.rent(1)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(reverse('index'))
+        for offset in range(-3, 10):
+            self.rent(offset)
+            self.rent(offset, user=self.other, approver=self.user)
+            self.create_pc(f'pc-{offset}')
+        cache.clear()
+        with CaptureQueriesContext(connection) as large:
+            self.client.get(reverse('index'))
+        self.assertEqual(len(small), len(large))
+        with CaptureQueriesContext(connection) as cached:
+            self.client.get(reverse('index'))
+        self.assertEqual(len(cached), len(large) - 3)
+
+    def test_own_changes_clear_the_cache(self):
+        rental = self.rent(2)
+        self.assertEqual(len(self.dashboard()['rentals']), 1)
+        self.client.post(reverse('return_usb', args=[rental.usb_device_id]), {'comments': ''})
+        self.assertEqual(self.dashboard()['rentals'], [])
+        self.create_pc('pc-2')
+        self.assertEqual(len(self.dashboard()['pcs']), 2)
+
+
+class AntivirusComplianceTests(LoggedInMixin, TestCase):
+    """ウイルス対策の判定を保存時とコマンドでまとめて行い、申請や一覧では判定済みのフラグだけを使うことを確認する"""
+
+    def test_parse_and_compare(self):
+        self.assertEqual(compliance.parse('4.1.2'), ('', (4, 1, 2)))
+        self.assertEqual(compliance.parse(' Defender v4.18 '), ('defender', (4, 18)))
+        self.assertEqual(compliance.parse('Norton ver.22.1'), ('norton', (22, 1)))
+        self.assertEqual(compliance.parse('不明'), ('不明', None))
+        self.assertTrue(compliance.is_at_least((4, 1), (4, 1, 0)))
+        self.assertTrue(compliance.is_at_least((4, 10), (4, 9, 9)))
+        self.assertFalse(compliance.is_at_least((3, 99), (4,)))
+
+        AntivirusPolicy.objects.create(product='', min_version='3.0')
+        AntivirusPolicy.objects.create(product='Defender', min_version='4.18.1')
+        policies = compliance.Policies.load()
+        self.assertTrue(policies.is_compliant('3.0.5'))
+        self.assertFalse(policies.is_compliant('2.3.1'))
+        self.assertFalse(policies.is_compliant(''))
+        self.assertTrue(policies.is_compliant('defender 4.18.2'))
+        self.assertFalse(policies.is_compliant('DEFENDER 4.18'))
+        # 基準が無ければ全て満たすものとする
+        self.assertTrue(compliance.Policies({}).is_compliant(''))
+
+    def test_save_evaluates_pc(self):
+        AntivirusPolicy.objects.create(product='', min_version='3.0')
+        pc = self.create_pc(antivirus_version='2.0')
+        self.assertFalse(pc.is_compliant)
+        pc.antivirus_version = '3.2.0'
+        pc.save()
+        self.assertTrue(UserPC.objects.get(id=pc.id).is_compliant)
+
+    def test_command_updates_changed_flags_in_one_pass(self):
+        pcs = [
+            self.create_pc(f'pc-{i}', version)
+            for i, version in enumerate(['1.0.0', '2.3.1', '3.0.5', '4.1.2', '', 'Defender 4.18'])
+        ]
+        self.assertTrue(all(pc.is_compliant for pc in pcs))
+        AntivirusPolicy.objects.create(product='', min_version='3.0')
+        AntivirusPolicy.objects.create(product='defender', min_version='4.0')
+
+        out = StringIO()
+        call_command('evaluate_antivirus', '--dry-run', stdout=out)
+        self.assertIn('6件中 3件', out.getvalue())
+        self.assertEqual(UserPC.objects.filter(is_compliant=True).count(), 6)
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command('evaluate_antivirus', stdout=StringIO())
+        self.assertEqual(
+            set(UserPC.objects.filter(is_compliant=True).values_list('serial_number', flat=True)),
+            {'pc-2', 'pc-3', 'pc-5'},
+        )
+        # 基準の読み込み・PCの走査・判定が変わったPCのUPDATE（とトランザクション）だけで済む
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        selects = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 2)
+
+    def test_rental_form_and_list_use_flag(self):
+        ok = self.create_pc('pc-ok', '4.0')
+        ng = self.create_pc('pc-ng')
+        UserPC.objects.filter(id=ng.id).update(is_compliant=False)
+
+        form = RentalRequestForm(user=self.user)
+        self.assertEqual(list(form.fields['pc'].queryset), [ok])
+        approver = User.objects.create(username='approver', email='approver@example.com')
+        device = USBDevice.objects.create(name='usb', manufacturer=whitelisted_manufacturer())
+        today = timezone.now().date()
+        response = self.client.post(reverse('request_rental', args=[device.id]), {
+            'start_date': today, 'end_date': today + timedelta(days=1), 'approver': approver.id, 'pc': ng.id,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('pc', response.context['form'].errors)
+        self.assertFalse(RentalRequest.objects.exists())
+
+        response = self.client.get(reverse('user_pc_list'), {'compliance': 'ng'})
+        self.assertEqual(list(response.context['user_pcs']), [ng])
+        response = self.client.get(reverse('user_pc_list'), {'compliance': 'ok'})
+        self.assertEqual(list(response.context['user_pcs']), [ok])
+        self.assertEqual(len(self.client.get(reverse('user_pc_list')).context['user_pcs']), 2)
+
+
+class RentalEventLogTests(LoggedInMixin, TestCase):
+    """レンタルの操作が同じトランザクションで記録され、最新のスナップショット以降の記録だけで貸出状況を組み立て直せることを確認する"""
+
+    def setUp(self):
+        super().setUp()
+        self.approver = User.objects.create(username='approver', email='approver@example.com')
+        self.pc = self.create_pc('pc-alice')
+        self.maker = whitelisted_manufacturer()
+
+    def rent(self, device=None):
+        device = device or USBDevice.objects.create(name=f'usb-{USBDevice.objects.count()}', manufacturer=self.maker)
+        self.client.post(reverse('request_rental', args=[device.id]), {
+            'start_date': self.today, 'end_date': self.today + timedelta(days=3),
+            'approver': self.approver.id, 'pc': self.pc.id,
+        })
+        return RentalRequest.objects.get(usb_device=device, is_returned=False)
+
+    def kinds(self, rental):
+        return list(RentalEvent.objects.filter(rental_id=rental.id).order_by('id').values_list('kind', flat=True))
+
+    def test_actions_are_recorded_with_comments(self):
+        rental = self.rent()
+        new_end = self.today + timedelta(days=10)
+        self.client.post(reverse('extension_request', args=[rental.id]), {'new_end_date': new_end})
+        lending.decide(self.approver, [rental.id], approve=True, comment='どうぞ')
+        self.client.post(reverse('return_usb', args=[rental.usb_device_id]), {'comments': 'ケースが割れていました'})
+
+        self.assertEqual(self.kinds(rental), [
+            RentalEvent.RENTED, RentalEvent.EXTENDED, RentalEvent.APPROVED, RentalEvent.RETURNED,
+        ])
+        events = {event.kind: event for event in RentalEvent.objects.filter(rental_id=rental.id)}
+        self.assertEqual(events[RentalEvent.EXTENDED].end_date, new_end)
+        self.assertEqual((events[RentalEvent.APPROVED].actor_id, events[RentalEvent.APPROVED].comment), (self.approver.id, 'どうぞ'))
+        self.assertEqual((events[RentalEvent.RETURNED].actor_id, events[RentalEvent.RETURNED].comment), (self.user.id, 'ケースが割れていました'))
+
+        rejected = self.rent()
+        lending.decide(self.approver, [rejected.id], approve=False)
+        self.assertEqual(self.kinds(rejected), [RentalEvent.RENTED, RentalEvent.REJECTED])
+
+    def test_rolled_back_rental_is_not_recorded(self):
+        device = USBDevice.objects.create(name='usb', manufacturer=self.maker)
+        other = User.objects.create(username='bob', email='bob@example.com')
+        Reservation.objects.create(usb_device=device, user=other, start_date=self.today, end_date=self.today)
+        rental_request = RentalRequest(
+            usb_device=device, user=self.user, approver=self.approver, pc=self.pc,
+            start_date=self.today, end_date=self.today + timedelta(days=1),
+        )
+        self.assertFalse(lending.rent(rental_request))
+        self.assertFalse(RentalEvent.objects.exists())
+
+    def test_rebuild_replays_only_events_after_snapshot(self):
+        returned = self.rent()
+        lending.return_rental(returned)
+        kept = self.rent()
+        snapshot = rental_log.take_snapshot()
+        self.assertIsNone(rental_log.take_snapshot())
+
+        extended = self.rent()
+        lending.extend_rental(extended, self.today + timedelta(days=20))
+        lending.return_rental(kept)
+        after = RentalEvent.objects.filter(id__gt=snapshot.last_event_id).count()
+        with patch.object(rental_log, 'apply', wraps=rental_log.apply) as apply:
+            devices, last_id = rental_log.rebuild()
+        self.assertEqual(apply.call_count, after)
+        self.assertEqual(last_id, RentalEvent.objects.latest('id').id)
+
+        self.assertEqual(devices[extended.usb_device_id]['end_date'], (self.today + timedelta(days=20)).isoformat())
+        self.assertEqual(devices[extended.usb_device_id]['rental'], extended.id)
+        self.assertTrue(devices[kept.usb_device_id]['available'])
+        self.assertEqual(devices[returned.usb_device_id]['rentals'], 1)
+        self.assertEqual(rental_log.mismatches(devices), [])
+        # スナップショットを使わずに全ての記録を再生しても同じ結果になる
+        RentalSnapshot.objects.all().delete()
+        self.assertEqual(rental_log.rebuild(), (devices, last_id))
+        # 途中の記録までの状態も組み立て直せる
+        self.assertFalse(rental_log.rebuild(snapshot.last_event_id)[0][kept.usb_device_id]['available'])
+
+        # 起点のスナップショットが消された記録までは、空の状態から再生せずにエラーにする
+        rental_log.take_snapshot()
+        with self.assertRaises(rental_log.SnapshotMissing):
+            rental_log.rebuild(snapshot.last_event_id)
+
+    def test_snapshot_command(self):
+        rental = self.rent()
+        out = StringIO()
+        call_command('snapshot_rentals', '--keep=1', stdout=out)
+        self.assertIn('スナップショットを保存しました', out.getvalue())
+        self.rent()
+        call_command('snapshot_rentals', '--keep=1', stdout=StringIO())
+        # 古いスナップショットは消えるが、記録を始める前の状態は残す
+        self.assertEqual(
+            list(RentalSnapshot.objects.order_by('last_event_id').values_list('last_event_id', flat=True)),
+            [rental_log.BASELINE_EVENT_ID, RentalEvent.objects.latest('id').id],
+        )
+        self.assertFalse(rental_log.rebuild(RentalEvent.objects.earliest('id').id)[0][rental.usb_device_id]['available'])
+
+        USBDevice.objects.filter(id=rental.usb_device_id).update(is_available=True)
+        out = StringIO()
+        call_command('snapshot_rentals', '--verify', stdout=out)
+        self.assertIn(f'デバイス {rental.usb_device_id}: 記録では貸出中、現在は貸出可能', out.getvalue())
+        self.assertIn('食い違い 1件', out.getvalue())
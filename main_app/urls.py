@@ -1,21 +1,52 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import api, async_views, views
 
-urlpatterns = [
-    path('', views.IndexView.as_view(), name='index'),  # ホームページ
-    path('signup/', views.SignupView.as_view(), name='signup'),  # サインアップ
-    path('device/add/', views.USBDeviceCreateView.as_view(), name='usb_device_create'),  # USBデバイス登録
-    path('device/<int:pk>/', views.USBDeviceDetailView.as_view(), name='usb_device_detail'),  # USBデバイス詳細
-    path('device/<int:pk>/edit/', views.USBDeviceUpdateView.as_view(), name='usb_device_edit'),  # USBデバイス編集
-    path('device/<int:pk>/delete/', views.USBDeviceDeleteView.as_view(), name='usb_device_delete'),  # USBデバイス削除
-    path('rentals/', views.USBListView.as_view(), name='usb_list'),  # USBリスト閲覧
-    path('rentals/request/<int:usb_id>/', views.RequestRentalView.as_view(), name='request_rental'),  # レンタル申請
-    path('rentals/return/<int:usb_id>/', views.ReturnUSBView.as_view(), name='return_usb'),  # 返却申請フォーム
-    path('rentals/extension/<int:rental_id>/', views.ExtensionRequestView.as_view(), name='extension_request'),  # 延長申請
-    path('pc/add/', views.AddUserPCView.as_view(), name='add_user_pc'),  # 利用PC追加
-    path('pc/list/', views.UserPCListView.as_view(), name='user_pc_list'),  # 利用PC一覧
-    path('pc/edit/<int:pk>/', views.UserPCUpdateView.as_view(), name='user_pc_edit'),  # 利用PC編集
-    path('pc/delete/<int:pk>/', views.UserPCDeleteView.as_view(), name='user_pc_delete'),  # 利用PC削除
-    path('whitelist/add/', views.ManufacturerWhitelistCreateView.as_view(), name='whitelist_add'),  # ホワイトリスト登録
-    path('whitelist/', views.ManufacturerWhitelistListView.as_view(), name='whitelist_list'),  # ホワイトリスト一覧
-]
+
+def build_urlpatterns(async_reads=False):
+    """
+    URLの一覧を組み立てる。async_reads が真なら、読み取りの多いページとJSON APIを
+    非同期ビュー（async_views）に差し替える。URLとルート名はどちらでも同じ。
+    """
+    reads = async_views if async_reads else views
+    api_reads = async_views if async_reads else api
+    return [
+        path('', views.IndexView.as_view(), name='index'),  # ホームページ
+        path('signup/', views.SignupView.as_view(), name='signup'),  # サインアップ
+        path('device/add/', views.USBDeviceCreateView.as_view(), name='usb_device_create'),  # USBデバイス登録
+        path('device/import/', views.DeviceImportView.as_view(), name='usb_device_import'),  # USBデバイス一括登録
+        path('export/<str:target>/', views.InventoryExportView.as_view(), name='inventory_export'),  # デバイス・レンタル履歴の書き出し
+        path('device/<int:pk>/', reads.USBDeviceDetailView.as_view(), name='usb_device_detail'),  # USBデバイス詳細
+        path('device/<int:pk>/edit/', views.USBDeviceUpdateView.as_view(), name='usb_device_edit'),  # USBデバイス編集
+        path('device/<int:pk>/delete/', views.USBDeviceDeleteView.as_view(), name='usb_device_delete'),  # USBデバイス削除
+        path('rentals/', reads.USBListView.as_view(), name='usb_list'),  # USBリスト閲覧
+        path('rentals/request/<int:usb_id>/', views.RequestRentalView.as_view(), name='request_rental'),  # レンタル申請
+        path('rentals/return/<int:usb_id>/', views.ReturnUSBView.as_view(), name='return_usb'),  # 返却申請フォーム
+        path('rentals/extension/<int:rental_id>/', views.ExtensionRequestView.as_view(), name='extension_request'),  # 延長申請
+        path('rentals/availability/', views.DeviceAvailabilityView.as_view(), name='device_availability'),  # 期間指定の空きデバイス検索
+        path('rentals/reserve/<int:usb_id>/', views.ReservationCreateView.as_view(), name='reservation_create'),  # 予約
+        path('reservations/', views.ReservationListView.as_view(), name='reservation_list'),  # 予約一覧
+        path('reservations/<int:pk>/cancel/', views.ReservationCancelView.as_view(), name='reservation_cancel'),  # 予約取り消し
+        path('rentals/waitlist/<int:usb_id>/', views.WaitlistJoinView.as_view(), name='waitlist_join'),  # 空き待ちの登録
+        path('waitlist/<int:pk>/cancel/', views.WaitlistCancelView.as_view(), name='waitlist_cancel'),  # 空き待ちの取り消し
+        path('events/devices/', reads.DeviceEventStreamView.as_view(), name='device_events'),  # 貸出状況の変化の配信（SSE、ASGIのみ）
+        path('approvals/', views.ApprovalQueueView.as_view(), name='approval_queue'),  # 承認待ちの申請（まとめて承認・却下）
+        path('pc/add/', views.AddUserPCView.as_view(), name='add_user_pc'),  # 利用PC追加
+        path('pc/list/', reads.UserPCListView.as_view(), name='user_pc_list'),  # 利用PC一覧
+        path('pc/edit/<int:pk>/', views.UserPCUpdateView.as_view(), name='user_pc_edit'),  # 利用PC編集
+        path('pc/delete/<int:pk>/', views.UserPCDeleteView.as_view(), name='user_pc_delete'),  # 利用PC削除
+        path('whitelist/add/', views.ManufacturerWhitelistCreateView.as_view(), name='whitelist_add'),  # ホワイトリスト登録
+        path('whitelist/', reads.ManufacturerWhitelistListView.as_view(), name='whitelist_list'),  # ホワイトリスト一覧
+        path('reports/usage/', views.UsageReportView.as_view(), name='usage_report'),  # 利用状況レポート
+        path('reports/usage/<str:group>.csv', views.UsageReportExportView.as_view(), name='usage_report_export'),  # 利用状況レポートのCSV
+        path('metrics/', views.RequestMetricsView.as_view(), name='request_metrics'),  # ルートごとの処理時間の集計
+        path('api/devices/', api_reads.DeviceApiView.as_view(), name='api_devices'),  # デバイス一覧（JSON）
+        path('api/devices/search/', api_reads.DeviceSearchApiView.as_view(), name='api_device_search'),  # デバイスの全文検索（JSON、関連度順）
+        path('api/rentals/', api_reads.RentalApiView.as_view(), name='api_rentals'),  # レンタル一覧（JSON）
+        path('api/rentals/archived/', api_reads.ArchivedRentalApiView.as_view(), name='api_archived_rentals'),  # アーカイブ済みレンタル一覧（JSON）
+        path('api/pcs/', api_reads.UserPCApiView.as_view(), name='api_user_pcs'),  # 利用PC一覧（JSON）
+        path('api/whitelist/', api_reads.WhitelistApiView.as_view(), name='api_whitelist'),  # ホワイトリスト一覧（JSON）
+    ]
+
+
+urlpatterns = build_urlpatterns(settings.ASYNC_READ_VIEWS)
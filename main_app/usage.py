@@ -0,0 +1,317 @@
+# rentals/usage.py
+from collections import defaultdict
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.db.models import Count, Min, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .models import (
+    RentalRequest, ArchivedRentalRequest, RentalEvent, DeviceUsageDay, DeviceUsageMonth, UsageSummaryDay,
+    UsageRollupState,
+)
+
+ONE_DAY = timedelta(days=1)
+# 同時に更新されたレンタルの取りこぼしを防ぐため、前回の反映時刻より少し前から見直す
+CHANGE_OVERLAP = timedelta(minutes=5)
+# 1回のトランザクションで作り直す最大の日数
+CHUNK_DAYS = 31
+# 変更されたレンタルの操作の記録を一度に読む件数
+CHANGED_CHUNK_SIZE = 500
+
+GB = 1000 ** 3  # 製品の表記に合わせて10進で区切る
+CAPACITY_BANDS = [
+    ('le8g', '8GB以下', 8 * GB),
+    ('le32g', '32GB以下', 32 * GB),
+    ('le128g', '128GB以下', 128 * GB),
+    ('le512g', '512GB以下', 512 * GB),
+    ('gt512g', '512GB超', None),
+]
+UNKNOWN_BAND = 'unknown'
+BAND_LABELS = {key: label for key, label, _ in CAPACITY_BANDS} | {UNKNOWN_BAND: '不明'}
+
+RENTAL_FIELDS = (
+    'usb_device_id', 'usb_device__manufacturer_id', 'usb_device__capacity',
+    'start_date', 'end_date', 'returned_at',
+)
+
+
+def capacity_band(capacity):
+    if capacity is None:
+        return UNKNOWN_BAND
+    for key, _label, upper in CAPACITY_BANDS:
+        if upper is None or capacity <= upper:
+            return key
+
+
+def last_rented_day(rental, today):
+    """レンタルが最後に貸し出されていた日。未返却なら今日まで続いているとみなす"""
+    if not rental.get('is_returned', True):
+        return today
+    if rental['returned_at']:
+        return rental['returned_at'].date()
+    # 返却日時を記録する前に返却されたレンタルは、返却期日に返却されたものとみなす
+    return rental['end_date'] or rental['start_date']
+
+
+def _start_of(day):
+    return datetime.combine(day, time.min, tzinfo=dt_timezone.utc)
+
+
+def rentals_overlapping(first, last):
+    """[first, last] に1日でも貸し出されていたレンタル（現行テーブルとアーカイブの両方）"""
+    returned_in_range = (
+        Q(returned_at__gte=_start_of(first))
+        | Q(returned_at__isnull=True, end_date__gte=first)
+        | Q(returned_at__isnull=True, end_date__isnull=True, start_date__gte=first)
+    )
+    current = RentalRequest.objects.filter(start_date__lte=last).filter(
+        Q(is_returned=False) | returned_in_range
+    ).values(*RENTAL_FIELDS, 'is_returned')
+    archived = ArchivedRentalRequest.objects.filter(start_date__lte=last).filter(
+        returned_in_range
+    ).values(*RENTAL_FIELDS)
+    yield from current.iterator(chunk_size=2000)
+    yield from archived.iterator(chunk_size=2000)
+
+
+def rebuild_days(first, last, today):
+    """[first, last] の日次集計を、その期間に掛かるレンタルだけを読んで作り直す"""
+    usage = {}
+    for rental in rentals_overlapping(first, last):
+        day = max(rental['start_date'], first)
+        stop = min(last_rented_day(rental, today), last)
+        band = capacity_band(rental['usb_device__capacity'])
+        while day <= stop:
+            overdue = rental['end_date'] is not None and day > rental['end_date']
+            key = (day, rental['usb_device_id'])
+            if key in usage:
+                # 同じ日に同じデバイスのレンタルが重なる場合は1日として数える
+                usage[key][2] = usage[key][2] or overdue
+            else:
+                usage[key] = [rental['usb_device__manufacturer_id'], band, overdue]
+            day += ONE_DAY
+
+    summary = defaultdict(lambda: [0, 0])
+    for (day, _device_id), (manufacturer_id, band, overdue) in usage.items():
+        totals = summary[(day, manufacturer_id, band)]
+        totals[0] += 1
+        totals[1] += overdue
+
+    with transaction.atomic():
+        DeviceUsageDay.objects.filter(day__range=(first, last)).delete()
+        UsageSummaryDay.objects.filter(day__range=(first, last)).delete()
+        DeviceUsageDay.objects.bulk_create([
+            DeviceUsageDay(day=day, usb_device_id=device_id, manufacturer_id=manufacturer_id,
+                           capacity_band=band, overdue=overdue)
+            for (day, device_id), (manufacturer_id, band, overdue) in usage.items()
+        ], batch_size=1000)
+        UsageSummaryDay.objects.bulk_create([
+            UsageSummaryDay(day=day, manufacturer_id=manufacturer_id, capacity_band=band,
+                            rented_days=rented, overdue_days=overdue)
+            for (day, manufacturer_id, band), (rented, overdue) in summary.items()
+        ], batch_size=1000)
+        rebuild_months(_month_of(first), _month_of(last))
+    return len(usage)
+
+
+def rebuild_months(first_month, last_month):
+    """[first_month, last_month] の月のデバイスごとの月次集計を、その月の日次集計から作り直す"""
+    rows = (
+        DeviceUsageDay.objects.filter(day__gte=first_month, day__lt=_next_month(last_month))
+        .annotate(month=TruncMonth('day'))
+        .values('month', 'usb_device_id')
+        .annotate(rented_days=Count('id'), overdue_days=Count('id', filter=Q(overdue=True)))
+        .order_by()
+    )
+    DeviceUsageMonth.objects.filter(month__range=(first_month, last_month)).delete()
+    DeviceUsageMonth.objects.bulk_create([DeviceUsageMonth(**row) for row in rows], batch_size=1000)
+
+
+def dirty_days(state, today, since=None):
+    """前回の実行以降に集計が変わりうる日の集合（今日は集計途中なので含めない）"""
+    yesterday = today - ONE_DAY
+    days = set()
+
+    # まだ集計していない日（前回から日付が進んだ分、初回は最初のレンタルから）
+    first = since
+    if first is None and state.days_through is not None:
+        first = state.days_through + ONE_DAY
+    if first is None:
+        first = min(filter(None, [
+            RentalRequest.objects.aggregate(first=Min('start_date'))['first'],
+            ArchivedRentalRequest.objects.aggregate(first=Min('start_date'))['first'],
+        ]), default=None)
+    if first is not None:
+        days.update(_date_range(first, yesterday))
+
+    # 前回以降に申請・返却・延長されたレンタルは、変更の掛かる最初の日から昨日までの集計を変えうる
+    if since is None and state.changed_through is not None:
+        for first in changed_rental_days(state.changed_through - CHANGE_OVERLAP):
+            days.update(_date_range(first, yesterday))
+    return days
+
+
+def changed_rental_days(changed_since):
+    """changed_since より後に更新されたレンタルごとに、集計が変わりうる最初の日を返す"""
+    changed = RentalRequest.objects.filter(updated_at__gt=changed_since, start_date__isnull=False).values(
+        'id', 'start_date', 'end_date',
+    )
+    rentals = {rental['id']: rental for rental in changed.iterator(chunk_size=2000)}
+    ids = list(rentals)
+    firsts = set()
+    for start in range(0, len(ids), CHANGED_CHUNK_SIZE):
+        chunk = ids[start:start + CHANGED_CHUNK_SIZE]
+        events = defaultdict(list)
+        for event in (
+            RentalEvent.objects.filter(rental_id__in=chunk).order_by('id')
+            .values('rental_id', 'kind', 'end_date', 'created_at')
+        ):
+            events[event['rental_id']].append(event)
+        for rental_id in chunk:
+            first = first_changed_day(rentals[rental_id], events[rental_id], changed_since)
+            if first is not None:
+                firsts.add(first)
+    return firsts
+
+
+def first_changed_day(rental, events, changed_since):
+    """
+    レンタルの changed_since 以降の操作の記録から、集計が変わりうる最初の日を求める（変わらなければ None）。
+    延長は変更前と変更後の返却期日の早い方の翌日から（期限切れかどうかが変わる）、返却・却下は返却日から、
+    貸出は開始日から。承認は集計に影響しない。記録の無い変更（管理画面での編集など）は開始日からとする
+    """
+    recent = [event for event in events if event['created_at'] > changed_since]
+    if not recent:
+        return rental['start_date']
+    # 変更前の返却期日は、changed_since までの最後の貸出・延長の記録のもの
+    end_date = next(
+        (event['end_date'] for event in reversed(events) if event['created_at'] <= changed_since and event['end_date']),
+        None,
+    )
+    days = []
+    for event in recent:
+        if event['kind'] == RentalEvent.RENTED:
+            days.append(rental['start_date'])
+        elif event['kind'] in (RentalEvent.RETURNED, RentalEvent.REJECTED):
+            days.append(event['created_at'].date())
+        elif event['kind'] == RentalEvent.EXTENDED:
+            if end_date is None or event['end_date'] is None:
+                days.append(rental['start_date'])
+            else:
+                days.append(min(end_date, event['end_date']) + ONE_DAY)
+            end_date = event['end_date']
+    return min(days, default=None)
+
+
+def refresh_rollups(since=None, now=None):
+    """
+    変更のあった日だけ日次集計を作り直し、作り直した日数を返す。
+    since を指定するとその日以降を全て作り直す（デバイスの削除やメーカー変更を反映したい場合）。
+    """
+    now = now or timezone.now()
+    today = now.date()
+    state, _ = UsageRollupState.objects.get_or_create(pk=1)
+    days = sorted(dirty_days(state, today, since))
+
+    for first, last in _chunks(days):
+        rebuild_days(first, last, today)
+
+    state.days_through = today - ONE_DAY
+    state.changed_through = now
+    state.save()
+    return len(days)
+
+
+def _date_range(first, last):
+    day = first
+    while day <= last:
+        yield day
+        day += ONE_DAY
+
+
+def _month_of(day):
+    return day.replace(day=1)
+
+
+def _next_month(month):
+    return (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def _chunks(days):
+    """連続する日をまとめ、CHUNK_DAYS 日以内の (最初の日, 最後の日) に分ける"""
+    first = previous = None
+    for day in days:
+        if first is not None and (day != previous + ONE_DAY or (day - first).days >= CHUNK_DAYS):
+            yield first, previous
+            first = None
+        if first is None:
+            first = day
+        previous = day
+    if first is not None:
+        yield first, previous
+
+
+def _with_rate(rows):
+    for row in rows:
+        row['overdue_rate'] = row['overdue_days'] / row['rented_days'] if row['rented_days'] else 0.0
+        yield row
+
+
+def manufacturer_report(first, last):
+    return list(_with_rate(
+        UsageSummaryDay.objects.filter(day__range=(first, last))
+        .values('manufacturer_id', 'manufacturer__name')
+        .annotate(rented_days=Sum('rented_days'), overdue_days=Sum('overdue_days'))
+        .order_by('-rented_days', 'manufacturer__name')
+    ))
+
+
+def capacity_band_report(first, last):
+    rows = list(_with_rate(
+        UsageSummaryDay.objects.filter(day__range=(first, last))
+        .values('capacity_band')
+        .annotate(rented_days=Sum('rented_days'), overdue_days=Sum('overdue_days'))
+    ))
+    order = [key for key, _label, _upper in CAPACITY_BANDS] + [UNKNOWN_BAND]
+    for row in rows:
+        row['label'] = BAND_LABELS.get(row['capacity_band'], row['capacity_band'])
+    return sorted(rows, key=lambda row: order.index(row['capacity_band']) if row['capacity_band'] in order else len(order))
+
+
+def device_report(first, last, limit=None):
+    """
+    期間中に丸ごと含まれる月は月次集計から、月の途中の端（最初と最後の月の一部）だけ日次集計から読み、
+    デバイスごとに足し合わせる。1年間のレポートでも日次集計を読むのは最大で2か月分になる
+    """
+    first_month = first if first.day == 1 else _next_month(first)
+    end_month = _month_of(last + ONE_DAY)  # この月の1日より前までが丸ごと含まれる
+    if first_month < end_month:
+        monthly = (
+            DeviceUsageMonth.objects.filter(month__gte=first_month, month__lt=end_month)
+            .values('usb_device_id', 'usb_device__name')
+            .annotate(rented_days=Sum('rented_days'), overdue_days=Sum('overdue_days'))
+            .order_by()
+        )
+        edges = Q(day__gte=first, day__lt=first_month) | Q(day__gte=end_month, day__lte=last)
+    else:
+        monthly = DeviceUsageMonth.objects.none()
+        edges = Q(day__range=(first, last))
+    daily = (
+        DeviceUsageDay.objects.filter(edges)
+        .values('usb_device_id', 'usb_device__name')
+        .annotate(rented_days=Count('id'), overdue_days=Count('id', filter=Q(overdue=True)))
+        .order_by()
+    )
+
+    totals = {}
+    for rows in (monthly, daily):
+        for row in rows.iterator(chunk_size=2000):
+            total = totals.setdefault(row['usb_device_id'], dict(row, rented_days=0, overdue_days=0))
+            total['rented_days'] += row['rented_days']
+            total['overdue_days'] += row['overdue_days']
+    rows = sorted(totals.values(), key=lambda row: (-row['rented_days'], row['usb_device_id']))
+    if limit:
+        rows = rows[:limit]
+    return list(_with_rate(rows))
@@ -0,0 +1,43 @@
+# rentals/versions.py
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import USBDevice
+
+INVENTORY_KEY = 'main_app:inventory:version'
+
+
+def inventory_version():
+    """
+    USBデバイス一覧の表示に影響する変更（デバイスやレンタルの追加・更新・削除）のたびに変わる値。
+    一覧ページのETagに使う。
+    """
+    version = cache.get(INVENTORY_KEY)
+    if version is None:
+        # キャッシュから消えた場合も過去の値と重ならないよう、現在時刻から作り直す
+        version = time.time_ns()
+        if not cache.add(INVENTORY_KEY, version, timeout=None):
+            version = cache.get(INVENTORY_KEY, version)
+    return version
+
+
+def bump_inventory():
+    """変更時に呼ぶ。コミット前に読まれた値で古い内容が304にならないよう、コミット後にも進める"""
+    _bump()
+    transaction.on_commit(_bump)
+
+
+def _bump():
+    cache.set(INVENTORY_KEY, time.time_ns(), timeout=None)
+
+
+def touch_devices(device_ids):
+    """
+    レンタルやメーカーの変更をデバイスの更新日時に反映する。
+    詳細ページのETag / Last-Modified と、一覧・履歴の断片キャッシュのキーが変わる。
+    """
+    USBDevice.objects.filter(id__in=device_ids).update(updated_at=timezone.now())
+    bump_inventory()
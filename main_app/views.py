@@ -1,20 +1,50 @@
-from django.core.mail import send_mail
-from smtplib import SMTPException
+import hashlib
+import hmac
+import io
+from datetime import timedelta
 from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.urls import reverse_lazy
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.core.exceptions import PermissionDenied
 from django.views.generic import TemplateView, ListView, CreateView, FormView, View, DetailView, UpdateView, DeleteView
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import login
+from django.contrib import messages
 from django.utils import timezone
-from .models import USBDevice, RentalRequest, UserPC, Manufacturer, ManufacturerWhitelist
-from .forms import UserPCForm, USBDeviceForm, RentalRequestForm, ReturnRequestForm, CustomUserCreationForm, ManufacturerForm, ManufacturerWhitelistForm, ExtensionRequestForm
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+from django.db import transaction, IntegrityError
+from django.db.models import Prefetch, Exists, OuterRef, Subquery, Count
+from .models import USBDevice, RentalRequest, ArchivedRentalRequest, UserPC, Manufacturer, ManufacturerWhitelist, Reservation, WaitlistEntry
+from . import lending
+from .whitelist import is_whitelisted
+from .overdue import overdue_rentals_for
+from .dashboard import dashboard_for
+from .versions import inventory_version
+from .instrumentation import render_metrics
+from .inventory import FORMATS, import_devices, read_rows, export_devices, export_rentals, stream_rows
+from .facets import DeviceFilter
+from .search import rank_devices
+from .usage import manufacturer_report, capacity_band_report, device_report
+from .pagination import KeysetPaginator, MergedKeysetPaginator, KeysetPaginationMixin, InvalidCursor
+from .forms import UserPCForm, USBDeviceForm, RentalRequestForm, ReturnRequestForm, CustomUserCreationForm, ManufacturerForm, ManufacturerWhitelistForm, ExtensionRequestForm, ReservationForm, AvailabilitySearchForm, DeviceImportForm, UsageReportForm, WaitlistForm, ApprovalDecisionForm
 
 # ホームページや一般的な表示用ビュー
 class IndexView(TemplateView):
     template_name = "index.html"
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        if self.request.user.is_authenticated:
+            # ログインユーザーのレンタル・利用PC・承認待ちの状況（少数の固定のクエリで組み立て、短時間キャッシュする）
+            context['dashboard'] = dashboard_for(self.request.user)
+        return context
+
 # サインアップビュー
 class SignupView(FormView):
     template_name = 'registration/signup.html'
@@ -37,24 +67,105 @@ class USBDeviceCreateView(LoginRequiredMixin, CreateView):
         # 必要であれば、保存処理前の処理をここに追加
         return super().form_valid(form)
 
-class USBDeviceDetailView(LoginRequiredMixin, DetailView):
+class ConditionalGetMixin:
+    """
+    GET を condition() で包み、クライアントの If-None-Match / If-Modified-Since が一致すれば
+    本文を組み立てずに 304 を返す。ログイン確認の後に評価されるよう dispatch ではなく get を包む。
+    """
+
+    def get_etag(self, request, *args, **kwargs):
+        return None
+
+    def get_last_modified(self, request, *args, **kwargs):
+        return None
+
+    def get(self, request, *args, **kwargs):
+        view = condition(etag_func=self.get_etag, last_modified_func=self.get_last_modified)(super().get)
+        response = view(request, *args, **kwargs)
+        # ユーザーごとの内容なので共有キャッシュには置かせず、ブラウザには毎回再検証させる
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    @staticmethod
+    def make_etag(*parts):
+        return hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+class USBDeviceDetailView(LoginRequiredMixin, ConditionalGetMixin, DetailView):
     model = USBDevice
     template_name = 'rentals/usb_device_detail.html'
+    rentals_template_name = 'rentals/usb_device_rentals.html'
     context_object_name = 'usb_device'
+    history_ordering = ('-start_date', '-id')
+    history_paginate_by = 20
+
+    def device_updated_at(self):
+        # ETag と Last-Modified の両方で使うため、主キーでの1回の問い合わせで済ませる
+        if not hasattr(self, '_updated_at'):
+            self._updated_at = USBDevice.objects.filter(pk=self.kwargs['pk']).values_list('updated_at', flat=True).first()
+        return self._updated_at
+
+    def get_etag(self, request, *args, **kwargs):
+        updated_at = self.device_updated_at()
+        if updated_at is None:
+            return None  # 存在しないデバイスはビュー本体で404にする
+        return self.make_etag(request.user.id, self.kwargs['pk'], updated_at.isoformat(), request.get_full_path())
+
+    def get_last_modified(self, request, *args, **kwargs):
+        return self.device_updated_at()
+
+    def get_queryset(self):
+        # メーカー名を同じクエリで取得する
+        return USBDevice.objects.select_related('manufacturer')
+
+    def history_paginator(self):
+        # 古い返却済みレンタルはアーカイブに移されているため、両方のテーブルを1つの履歴として辿る
+        return MergedKeysetPaginator([
+            RentalRequest.objects.filter(usb_device=self.object).select_related('user'),
+            ArchivedRentalRequest.objects.filter(usb_device=self.object).select_related('user'),
+        ], self.history_ordering, self.history_paginate_by)
+
+    def history_cursor(self, paginator):
+        # 不正なカーソルは問い合わせの前に404にする
+        cursor = self.request.GET.get('history_cursor')
+        if cursor:
+            try:
+                paginator.decode_cursor(cursor)
+            except InvalidCursor as e:
+                raise Http404(str(e))
+        return cursor or ''
+
+    def rentals_cache_key(self, cursor):
+        # デバイスの更新日時はレンタルの変更でも進むため、キーが変われば古い断片は使われない
+        return make_template_fragment_key('usb_device_rentals', [self.object.id, self.object.updated_at, cursor])
+
+    def render_rentals(self, current_rental, history_page):
+        return render_to_string(self.rentals_template_name, {
+            'usb_device': self.object,
+            'current_rental': current_rental,
+            'rental_history': history_page.object_list,
+            'history_page': history_page,
+        }, self.request)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        
-        # 現在レンタル中の情報を取得（所有者とレンタル期間）
-        current_rental = RentalRequest.objects.filter(
-            usb_device=self.object, is_returned=False
-        ).first()
-        
-        # レンタル履歴を取得（新しい順に並べ替え）
-        rental_history = RentalRequest.objects.filter(usb_device=self.object).order_by('-start_date')
-
-        context['current_rental'] = current_rental  # 現在のレンタル情報を追加
-        context['rental_history'] = rental_history  # レンタル履歴を追加
+        paginator = self.history_paginator()
+        cursor = self.history_cursor(paginator)
+
+        # 現在のレンタル情報とレンタル履歴（新しい順、キーセット方式）は描画済みの断片をキャッシュし、
+        # キャッシュが無いときだけ問い合わせる
+        key = self.rentals_cache_key(cursor)
+        rentals_html = cache.get(key)
+        if rentals_html is None:
+            current_rental = RentalRequest.objects.filter(
+                usb_device=self.object, is_returned=False
+            ).select_related('user').first()
+            history_page = paginator.get_page(cursor)
+            rentals_html = self.render_rentals(current_rental, history_page)
+            cache.set(key, rentals_html, settings.FRAGMENT_CACHE_SECONDS)
+            context['history_page'] = history_page
+
+        context['rentals_html'] = rentals_html
         return context
     
     
@@ -70,19 +181,54 @@ class USBDeviceDeleteView(LoginRequiredMixin, DeleteView):
     success_url = reverse_lazy('usb_list')  # 削除完了後にリダイレクトするページ
 
 # USBデバイス一覧ビュー
-class USBListView(LoginRequiredMixin, ListView):
+class USBListView(LoginRequiredMixin, ConditionalGetMixin, KeysetPaginationMixin, ListView):
     model = USBDevice
     template_name = 'rentals/usb_list.html'
     context_object_name = 'usb_devices'
-    
+    keyset_ordering = ('name', 'id')
+    search_limit = 50
+
+    def get_etag(self, request, *args, **kwargs):
+        # デバイス・レンタルが変わるか、日付が変わって返却期限切れの判定が変わると別のETagになる
+        return self.make_etag(
+            request.user.id, timezone.now().date().isoformat(), inventory_version(), request.get_full_path(),
+        )
+
+    def search_query(self):
+        return self.request.GET.get('q', '').strip()
+
+    def device_filter(self):
+        if not hasattr(self, '_device_filter'):
+            self._device_filter = DeviceFilter(self.request.GET)
+        return self._device_filter
+
+    def get_queryset(self):
+        # ログインユーザーの未返却レンタルだけをまとめて先読みし、デバイスごとのクエリ発行（N+1）を防ぐ
+        my_active_rentals = RentalRequest.objects.filter(user=self.request.user, is_returned=False)
+        queryset = self.device_filter().apply(USBDevice.objects.prefetch_related(
+            Prefetch('rentalrequest_set', queryset=my_active_rentals, to_attr='my_active_rentals')
+        ))
+        if self.search_query():
+            # 検索時は全文検索の索引で関連度の高い順に上位だけを表示する
+            return rank_devices(queryset, self.search_query(), self.search_limit)
+        return queryset
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.search_query():
+            return (None, None, queryset, False)
+        return super().paginate_queryset(queryset, page_size)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
-        # ログインユーザーの返却期限が過ぎたレンタルリクエストを取得
-        overdue_rentals = RentalRequest.objects.filter(user=self.request.user, end_date__lt=timezone.now().date(), usb_device__is_available=False)
-        
-        # 期限切れのレンタルリストをコンテキストに追加
-        context['overdue_rentals'] = overdue_rentals
+        # ログインユーザーの返却期限が過ぎたレンタルを取得（レンタル・返却・延長まではキャッシュを使う）
+        context['overdue_rentals'] = overdue_rentals_for(self.request.user)
+        context['fragment_cache_seconds'] = settings.FRAGMENT_CACHE_SECONDS
+        context['search_query'] = self.search_query()
+        context['device_filter'] = self.device_filter()
+        if not self.search_query():
+            # 全てのファセットの件数を1回の集計クエリで求める（検索中は関連度順の上位だけなので出さない）
+            context['facets'] = self.device_filter().facet_counts(USBDevice.objects.all())
         return context
     
 class ReturnUSBView(LoginRequiredMixin, FormView):
@@ -104,18 +250,12 @@ class ReturnUSBView(LoginRequiredMixin, FormView):
         usb_device = get_object_or_404(USBDevice, id=usb_id, is_available=False)
 
         # レンタル申請を取得して返却済みに設定
-        rental_request = RentalRequest.objects.filter(usb_device=usb_device, user=self.request.user, is_returned=False).first()
-        if rental_request:
-            rental_request.is_returned = True
-            rental_request.save()
-
-        # USBデバイスを利用可能状態に更新
-        usb_device.is_available = True
-        usb_device.save()
-
-        # フォームの入力内容を処理
-        comments = form.cleaned_data.get('comments')
-        # 追加の処理が必要であればここに追加します
+        # 未返却レンタルはデバイスごとに1件のみなので、本人のレンタルが無ければ返却できない
+        rental_request = get_object_or_404(RentalRequest, usb_device=usb_device, user=self.request.user, is_returned=False)
+        rental_request.usb_device = usb_device
+        # USBデバイスを利用可能状態に戻し、空き待ちの先頭の人に通知（または自動で申請）する。
+        # 返却時のコメントは操作の記録（RentalEvent）に残す
+        lending.return_rental(rental_request, comment=form.cleaned_data.get('comments'))
 
         # USBデバイス一覧ページにリダイレクト
         return redirect('usb_list')
@@ -131,64 +271,35 @@ class RequestRentalView(LoginRequiredMixin, FormView):
         return kwargs
 
     def form_valid(self, form):
-        usb_id = self.kwargs['usb_id']
-        usb_device = get_object_or_404(USBDevice, id=usb_id, is_available=True)
-
         rental_request = form.save(commit=False)
-        rental_request.usb_device = usb_device
         rental_request.user = self.request.user
-        rental_request.save()
+        rental_request.usb_device_id = self.kwargs['usb_id']
 
-        usb_device.is_available = False
-        usb_device.save()
+        if not self.reserve(rental_request):
+            return self.reservation_conflict(form)
 
         return redirect('usb_list')
 
+    def reserve(self, rental_request):
+        """デバイスを貸出中にしてレンタル申請を保存する。他の申請に先を越された場合は False を返す"""
+        return lending.rent(rental_request)
+
+    def reservation_conflict(self, form):
+        """他のユーザーに先に貸し出された（または存在しない、ホワイトリスト外の）デバイスへの申請を拒否する"""
+        usb_device = get_object_or_404(USBDevice, id=self.kwargs['usb_id'])
+        if not is_whitelisted(usb_device.manufacturer_id):
+            error_message = "このUSBデバイスのメーカーはホワイトリストに登録されていないため、レンタルできません。"
+        else:
+            error_message = "このUSBデバイスは既に他のユーザーにレンタルまたは予約されています。"
+        return render(self.request, self.template_name, {
+            'form': form, 'usb_device': usb_device, 'error_message': error_message,
+        }, status=409)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['usb_device'] = USBDevice.objects.get(id=self.kwargs['usb_id'])
+        context['usb_device'] = get_object_or_404(USBDevice, id=self.kwargs['usb_id'])
         return context
     
-    def post(self, request, usb_id):
-        usb_device = get_object_or_404(USBDevice, id=usb_id, is_available=True)
-        form = RentalRequestForm(request.POST)
-        
-        if form.is_valid():
-            rental_request = form.save(commit=False)
-            rental_request.usb_device = usb_device
-            rental_request.user = request.user
-            rental_request.save()
-
-            # デバイスをレンタル不可に変更
-            usb_device.is_available = False
-            usb_device.save()
-            
-            # メール送信とエラーハンドリング
-            try:
-                self.send_approval_email(rental_request)
-            except SMTPException:
-                # メール送信に失敗した場合のエラーメッセージ
-                error_message = "レンタル申請が完了しましたが、承認者へのメール送信に失敗しました。"
-                return render(request, 'rentals/request_rental_form.html', {'form': form, 'error_message': error_message})
-
-            return redirect('usb_list')
-
-        return render(request, 'rentals/request_rental_form.html', {'form': form, 'usb_device': usb_device})
-
-    def send_approval_email(self, rental_request):
-        """承認者にレンタル申請の通知メールを送信する"""
-        subject = "USBレンタル申請の承認が必要です"
-        message = (
-            f"{rental_request.user.username}さんがUSBデバイス『{rental_request.usb_device.name}』の"
-            "レンタルを申請しました。\n"
-            f"承認者であるあなたの承認が必要です。\n"
-            "レンタル開始日: {rental_request.start_date}\n"
-            "返却期日: {rental_request.end_date}\n\n"
-            "承認・却下を行ってください。"
-        )
-        recipient_list = [rental_request.approver.email]  # 承認者のメールアドレス
-        send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, recipient_list)
-    
 class AddUserPCView(LoginRequiredMixin, CreateView):
     model = UserPC
     form_class = UserPCForm
@@ -205,9 +316,17 @@ class UserPCListView(LoginRequiredMixin, ListView):
     template_name = 'rentals/user_pc_list.html'
     context_object_name = 'user_pcs'
 
+    # ?compliance=ok / ng でウイルス対策の基準を満たす・満たさないPCに絞り込む
+    COMPLIANCE_FILTERS = {'ok': True, 'ng': False}
+
     def get_queryset(self):
         # ログインユーザーのPC情報のみを取得
-        return UserPC.objects.filter(user=self.request.user)
+        queryset = UserPC.objects.filter(user=self.request.user)
+        compliant = self.COMPLIANCE_FILTERS.get(self.request.GET.get('compliance'))
+        if compliant is not None:
+            # 判定済みのフラグで絞り込む（バージョンの文字列はリクエストごとに解釈しない）
+            queryset = queryset.filter(is_compliant=compliant)
+        return queryset
     
 class UserPCUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     model = UserPC
@@ -261,25 +380,347 @@ class ManufacturerWhitelistCreateView(LoginRequiredMixin, View):
             'whitelist_form': whitelist_form,
         })
 
-class ManufacturerWhitelistListView(LoginRequiredMixin, ListView):
+class ManufacturerWhitelistListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = ManufacturerWhitelist
     template_name = 'rentals/manufacturer_whitelist_list.html'
     context_object_name = 'whitelisted_manufacturers'
+    keyset_ordering = ('-added_at', '-id')
+
+    def get_queryset(self):
+        # メーカー名を1回のJOINでまとめて取得する
+        return ManufacturerWhitelist.objects.select_related('manufacturer')
 
 class ExtensionRequestView(LoginRequiredMixin, View):
+    def get_rental(self, request, rental_id):
+        # 延長できるのは本人の未返却のレンタルだけ（返却済みを延長すると貸出中のイベントが配信されてしまう）
+        return get_object_or_404(RentalRequest, id=rental_id, user=request.user, is_returned=False)
+
     def get(self, request, rental_id):
-        rental_request = get_object_or_404(RentalRequest, id=rental_id, user=request.user)
+        rental_request = self.get_rental(request, rental_id)
         form = ExtensionRequestForm(initial={'new_end_date': rental_request.end_date})
         return render(request, 'rentals/extension_request_form.html', {'form': form, 'rental_request': rental_request})
 
     def post(self, request, rental_id):
-        rental_request = get_object_or_404(RentalRequest, id=rental_id, user=request.user)
+        rental_request = self.get_rental(request, rental_id)
         form = ExtensionRequestForm(request.POST)
         
         if form.is_valid():
             new_end_date = form.cleaned_data['new_end_date']
-            rental_request.end_date = new_end_date  # 返却期日を更新
-            rental_request.save()
+            lending.extend_rental(rental_request, new_end_date)  # 返却期日を更新
             return redirect('usb_list')  # 一覧ページにリダイレクト
             
         return render(request, 'rentals/extension_request_form.html', {'form': form, 'rental_request': rental_request})
+
+
+def available_devices(start_date, end_date):
+    """期間 [start_date, end_date] に予約も未返却のレンタルも入っていないデバイス"""
+    reserved = Reservation.objects.overlapping(start_date, end_date).filter(usb_device=OuterRef('pk'))
+    rented = RentalRequest.objects.filter(usb_device=OuterRef('pk'), is_returned=False)
+    if start_date > timezone.now().date():
+        # 将来の期間なら、その期間まで返却期日が続くレンタルだけが重なる
+        rented = rented.filter(end_date__gte=start_date)
+    return USBDevice.objects.filter(~Exists(reserved), ~Exists(rented))
+
+
+# 期間を指定した空きデバイス検索ビュー
+class DeviceAvailabilityView(LoginRequiredMixin, View):
+    template_name = 'rentals/device_availability.html'
+    paginate_by = 50
+
+    def get(self, request):
+        form = AvailabilitySearchForm(request.GET or None)
+        context = {'form': form}
+
+        if form.is_valid():
+            devices = available_devices(form.cleaned_data['start_date'], form.cleaned_data['end_date'])
+            if form.cleaned_data['manufacturer']:
+                devices = devices.filter(manufacturer=form.cleaned_data['manufacturer'])
+            if form.cleaned_data['min_capacity'] is not None:
+                devices = devices.filter(capacity__gte=form.cleaned_data['min_capacity'])
+
+            paginator = KeysetPaginator(devices.select_related('manufacturer'), ('name', 'id'), self.paginate_by)
+            try:
+                page = paginator.get_page(request.GET.get('cursor'))
+            except InvalidCursor as e:
+                raise Http404(str(e))
+
+            # ページ送りのリンクで検索条件を引き継ぐ
+            params = request.GET.copy()
+            params.pop('cursor', None)
+            context.update({'devices': page.object_list, 'page_obj': page, 'search_query': params.urlencode()})
+
+        return render(request, self.template_name, context)
+
+
+class ReservationCreateView(LoginRequiredMixin, FormView):
+    template_name = 'rentals/reservation_form.html'
+    form_class = ReservationForm
+    success_url = reverse_lazy('reservation_list')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['usb_device'] = get_object_or_404(USBDevice, id=self.kwargs['usb_id'])
+        return context
+
+    def form_valid(self, form):
+        reservation = form.save(commit=False)
+        reservation.user = self.request.user
+
+        with transaction.atomic():
+            # 同じデバイスへの予約・レンタルと直列化してから期間の重複を確認する
+            usb_device = get_object_or_404(USBDevice.objects.select_for_update(), id=self.kwargs['usb_id'])
+            allowed = is_whitelisted(usb_device.manufacturer_id)
+            is_free = allowed and available_devices(reservation.start_date, reservation.end_date).filter(id=usb_device.id).exists()
+            if is_free:
+                reservation.usb_device = usb_device
+                reservation.save()
+
+        if not allowed:
+            form.add_error(None, "このUSBデバイスのメーカーはホワイトリストに登録されていないため、予約できません。")
+            return self.form_invalid(form)
+        if not is_free:
+            form.add_error(None, "指定した期間には既に予約またはレンタルが入っています。")
+            return self.form_invalid(form)
+        return super().form_valid(form)
+
+
+class ReservationListView(LoginRequiredMixin, ListView):
+    model = Reservation
+    template_name = 'rentals/reservation_list.html'
+    context_object_name = 'reservations'
+
+    def get_queryset(self):
+        # ログインユーザーの、まだ終わっていない予約のみを取得
+        return Reservation.objects.filter(
+            user=self.request.user, end_date__gte=timezone.now().date()
+        ).select_related('usb_device').order_by('start_date', 'id')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # 空き待ちの登録と、それぞれの前に待っている人数（デバイスごとのインデックスで数える）
+        ahead = (
+            WaitlistEntry.objects.filter(usb_device=OuterRef('usb_device'), id__lt=OuterRef('id'))
+            .order_by().values('usb_device').annotate(count=Count('id')).values('count')
+        )
+        context['waitlist_entries'] = (
+            WaitlistEntry.objects.filter(user=self.request.user).select_related('usb_device')
+            .annotate(ahead=Subquery(ahead)).order_by('id')
+        )
+        return context
+
+
+class ReservationCancelView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
+    model = Reservation
+    template_name = 'rentals/reservation_confirm_delete.html'
+    success_url = reverse_lazy('reservation_list')
+
+    def test_func(self):
+        # ログインユーザーの予約のみ取り消し可能
+        reservation = self.get_object()
+        return reservation.user == self.request.user
+
+
+class WaitlistJoinView(LoginRequiredMixin, FormView):
+    """貸出中のデバイスの空き待ちに登録する。返却されると登録順に1人ずつ通知（または自動で申請）される"""
+    template_name = 'rentals/waitlist_form.html'
+    form_class = WaitlistForm
+    success_url = reverse_lazy('reservation_list')
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['user'] = self.request.user
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['usb_device'] = get_object_or_404(USBDevice, id=self.kwargs['usb_id'])
+        return context
+
+    def form_valid(self, form):
+        usb_device = get_object_or_404(USBDevice, id=self.kwargs['usb_id'])
+        if usb_device.is_available:
+            form.add_error(None, "このUSBデバイスは貸出可能です。空き待ちではなくレンタルを申請してください。")
+            return self.form_invalid(form)
+        if RentalRequest.objects.filter(usb_device=usb_device, user=self.request.user, is_returned=False).exists():
+            form.add_error(None, "このUSBデバイスは既にあなたがレンタルしています。")
+            return self.form_invalid(form)
+
+        entry = form.save(commit=False)
+        entry.usb_device = usb_device
+        entry.user = self.request.user
+        try:
+            with transaction.atomic():
+                entry.save()
+        except IntegrityError:
+            form.add_error(None, "このUSBデバイスの空き待ちには既に登録しています。")
+            return self.form_invalid(form)
+        return super().form_valid(form)
+
+
+class WaitlistCancelView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
+    model = WaitlistEntry
+    template_name = 'rentals/waitlist_confirm_delete.html'
+    success_url = reverse_lazy('reservation_list')
+
+    def test_func(self):
+        # ログインユーザーの登録のみ取り消し可能
+        return self.get_object().user == self.request.user
+
+
+class ApprovalQueueView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
+    """
+    ログインユーザーが承認者になっている未判断の申請の一覧。選んだ申請をまとめて承認・却下できる。
+    申請者・デバイス・PCは1回のJOINで読み、判断は件数に関わらず1回の条件付きUPDATEで行う（lending.decide）
+    """
+    template_name = 'rentals/approval_queue.html'
+    context_object_name = 'rentals'
+    keyset_ordering = ('requested_at', 'id')
+
+    def get_queryset(self):
+        return RentalRequest.objects.pending_for(self.request.user).select_related('user', 'usb_device', 'pc')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.setdefault('form', ApprovalDecisionForm())
+        return context
+
+    def post(self, request):
+        form = ApprovalDecisionForm(request.POST)
+        if not form.is_valid():
+            self.object_list = self.get_queryset()
+            return self.render_to_response(self.get_context_data(form=form))
+
+        approve = form.cleaned_data['action'] == 'approve'
+        decided = lending.decide(request.user, form.cleaned_data['ids'], approve, form.cleaned_data['comment'])
+        messages.success(request, f"{len(decided)}件の申請を{'承認' if approve else '却下'}しました。")
+        return redirect('approval_queue')
+
+
+class DeviceEventStreamView(LoginRequiredMixin, View):
+    """
+    デバイスの貸出状況の変化を Server-Sent Events で配信する（ASGIでは async_views の同じ名前のビューを使う）。
+    WSGIではワーカーを接続ごとに占有してしまうため配信せず、204 を返してブラウザに再接続をやめさせる
+    """
+    raise_exception = True
+
+    def get(self, request):
+        return HttpResponse(status=204)
+
+
+# USBデバイスの一括登録ビュー
+class DeviceImportView(LoginRequiredMixin, View):
+    template_name = 'rentals/device_import.html'
+    max_reported_errors = 100
+
+    def get(self, request):
+        return render(request, self.template_name, {'form': DeviceImportForm()})
+
+    def post(self, request):
+        form = DeviceImportForm(request.POST, request.FILES)
+        context = {'form': form}
+        if form.is_valid():
+            # アップロードされたファイルを全体を読み込まずに1行ずつ処理する
+            text = io.TextIOWrapper(form.cleaned_data['file'].file, encoding=form.cleaned_data['encoding'], newline='')
+            result = import_devices(read_rows(text, form.cleaned_data['format']))
+            context.update({
+                'result': result,
+                'errors': result.errors[:self.max_reported_errors],
+            })
+        return render(request, self.template_name, context)
+
+
+class InventoryExportView(LoginRequiredMixin, View):
+    """デバイスまたはレンタル履歴をジェネレーターで逐次返す（全件をメモリに載せない）"""
+    exporters = {'devices': export_devices, 'rentals': export_rentals}
+    content_types = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/jsonl; charset=utf-8'}
+
+    def get(self, request, target):
+        fmt = request.GET.get('format', 'csv')
+        if target not in self.exporters or fmt not in FORMATS:
+            raise Http404("不明な書き出し対象または形式です。")
+        response = StreamingHttpResponse(self.exporters[target](fmt), content_type=self.content_types[fmt])
+        response['Content-Disposition'] = f'attachment; filename="{target}.{fmt}"'
+        return response
+
+
+# 利用状況レポート（rollup_usage コマンドが作る日次集計だけを読む）
+class UsageReportView(LoginRequiredMixin, View):
+    template_name = 'rentals/usage_report.html'
+    default_days = 30
+    device_limit = 50
+
+    def get_period(self, request):
+        # 指定が無ければ、集計済みの昨日までの直近30日間
+        yesterday = timezone.now().date() - timedelta(days=1)
+        form = UsageReportForm(request.GET or {
+            'start_date': yesterday - timedelta(days=self.default_days - 1), 'end_date': yesterday,
+        })
+        if not form.is_valid():
+            return form, None, None
+        return form, form.cleaned_data['start_date'], form.cleaned_data['end_date']
+
+    def get(self, request):
+        form, start_date, end_date = self.get_period(request)
+        context = {'form': form}
+        if start_date:
+            context.update({
+                'start_date': start_date,
+                'end_date': end_date,
+                'period_query': f'start_date={start_date}&end_date={end_date}',
+                'manufacturers': manufacturer_report(start_date, end_date),
+                'capacity_bands': capacity_band_report(start_date, end_date),
+                'devices': device_report(start_date, end_date, limit=self.device_limit),
+            })
+        return render(request, self.template_name, context)
+
+
+class UsageReportExportView(UsageReportView):
+    """利用状況レポートをCSVで書き出す（デバイス別は全デバイス分を逐次出力する）"""
+    reports = {
+        'manufacturers': (
+            ['manufacturer_id', 'manufacturer', 'rented_days', 'overdue_days', 'overdue_rate'],
+            manufacturer_report,
+            ('manufacturer_id', 'manufacturer__name'),
+        ),
+        'capacity_bands': (
+            ['capacity_band', 'label', 'rented_days', 'overdue_days', 'overdue_rate'],
+            capacity_band_report,
+            ('capacity_band', 'label'),
+        ),
+        'devices': (
+            ['usb_device_id', 'usb_device', 'rented_days', 'overdue_days', 'overdue_rate'],
+            device_report,
+            ('usb_device_id', 'usb_device__name'),
+        ),
+    }
+
+    def get(self, request, group):
+        if group not in self.reports:
+            raise Http404("不明な集計の種類です。")
+        form, start_date, end_date = self.get_period(request)
+        if not start_date:
+            raise Http404("集計期間が不正です。")
+        columns, report, keys = self.reports[group]
+        rows = (
+            [*(row[key] for key in keys), row['rented_days'], row['overdue_days'], f"{row['overdue_rate']:.4f}"]
+            for row in report(start_date, end_date)
+        )
+        response = StreamingHttpResponse(stream_rows(columns, rows, 'csv'), content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="usage_{group}_{start_date}_{end_date}.csv"'
+        return response
+
+
+# ルートごとの処理時間のヒストグラム（Prometheus のテキスト形式）
+class RequestMetricsView(View):
+    def has_access(self, request):
+        # 送信元のIPアドレスでは判定しない（同じホストのリバースプロキシ経由では全員が 127.0.0.1 になる）
+        if request.user.is_staff:
+            return True
+        token = settings.METRICS_TOKEN
+        authorization = request.headers.get('Authorization', '')
+        return bool(token) and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+
+    def get(self, request):
+        if not self.has_access(request):
+            raise PermissionDenied
+        return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
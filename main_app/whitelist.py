@@ -0,0 +1,44 @@
+# rentals/whitelist.py
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import ManufacturerWhitelist
+
+CACHE_KEY = 'main_app:manufacturer_whitelist:ids'
+
+# プロセス内のコピー。共有キャッシュへの問い合わせも省くため、短い期間だけ保持する
+_local = {'ids': None, 'expires_at': 0.0}
+
+
+def whitelisted_manufacturer_ids():
+    """ホワイトリストに登録されたメーカーIDの集合（プロセス内→共有キャッシュ→DBの順に参照）"""
+    now = time.monotonic()
+    if _local['ids'] is not None and now < _local['expires_at']:
+        return _local['ids']
+
+    ids = cache.get(CACHE_KEY)
+    if ids is None:
+        ids = frozenset(ManufacturerWhitelist.objects.values_list('manufacturer_id', flat=True))
+        cache.set(CACHE_KEY, ids, timeout=None)
+
+    _local['ids'] = ids
+    _local['expires_at'] = now + settings.WHITELIST_LOCAL_CACHE_SECONDS
+    return ids
+
+
+def is_whitelisted(manufacturer_id):
+    return manufacturer_id is not None and manufacturer_id in whitelisted_manufacturer_ids()
+
+
+def invalidate():
+    """ホワイトリストの変更時に呼ぶ。コミット前に読み直された古い値も残らないよう、コミット後にも消す"""
+    _clear()
+    transaction.on_commit(_clear)
+
+
+def _clear():
+    _local['ids'] = None
+    cache.delete(CACHE_KEY)